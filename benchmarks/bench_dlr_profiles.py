@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Cost of DLR profile sampling per message, and of holding many pending
+receipts in the DLRScheduler.
+
+    python benchmarks/bench_dlr_profiles.py [--draws 1000000] [--pending 200000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_smsc  # noqa: E402
+from fake_smsc import DelayDistribution, DLRScheduler, OutcomeMix, PendingDLR  # noqa: E402
+
+DISTRIBUTIONS = {
+    'fixed': dict(kind='fixed', value=5),
+    'uniform': dict(kind='uniform', low=1, high=10),
+    'exponential': dict(kind='exponential', mean=5),
+    'lognormal': dict(kind='lognormal', mu=1.0, sigma=0.6),
+    'empirical': dict(kind='empirical', values=[0.5, 1, 2, 3, 5, 8, 13, 30, 60]),
+}
+
+
+def bench_sampling(draws):
+    print(f"sampling ({'numpy' if fake_smsc.numpy is not None else 'random'} blocks), {draws} draws")
+    for name, spec in DISTRIBUTIONS.items():
+        dist = DelayDistribution(**spec)
+        sample = dist.sample
+        started = time.perf_counter()
+        for _ in range(draws):
+            sample()
+        elapsed = time.perf_counter() - started
+        print(f"  {name:12s} {elapsed / draws * 1e9:7.0f} ns/draw")
+    mix = OutcomeMix({'DELIVRD': 90, 'UNDELIV:011': 4, 'EXPIRED': 3, 'REJECTD': 2, 'UNKNOWN': 1})
+    sample = mix.sample
+    started = time.perf_counter()
+    for _ in range(draws):
+        sample()
+    elapsed = time.perf_counter() - started
+    print(f"  {'outcomes':12s} {elapsed / draws * 1e9:7.0f} ns/draw")
+
+
+class CountingSession:
+    system_id = 'bench'
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_dlrs(self, dlrs):
+        self.sent += len(dlrs)
+
+
+def schedule_all(scheduler, session, pending, delays):
+    for i in range(pending):
+        scheduler.schedule(PendingDLR(session, 'BENCH', '593990000000', f'{i:08x}'), delays.sample())
+
+
+async def bench_scheduler(pending):
+    delays = DelayDistribution('lognormal', mu=0.5, sigma=0.5, max=5.0)
+
+    # Memory per pending receipt (timing is measured separately, tracemalloc is slow).
+    scheduler = DLRScheduler(resolution=0.1)
+    tracemalloc.start()
+    schedule_all(scheduler, CountingSession(), pending, delays)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    scheduler.close()
+    del scheduler
+
+    scheduler = DLRScheduler(resolution=0.1)
+    session = CountingSession()
+    started = time.perf_counter()
+    schedule_all(scheduler, session, pending, delays)
+    elapsed = time.perf_counter() - started
+    print(f"scheduled {pending} receipts in {elapsed:.2f}s "
+          f"({elapsed / pending * 1e6:.2f} us each, ~{size / pending:.0f} bytes each held)")
+    started = time.perf_counter()
+    while session.sent < pending:
+        await asyncio.sleep(0.1)
+    print(f"all fired {time.perf_counter() - started:.2f}s later "
+          f"(max lag behind due time {scheduler.max_lag * 1e3:.1f} ms, "
+          f"includes the {elapsed:.2f}s the loop was busy scheduling)")
+    scheduler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--draws', type=int, default=1000000, help='Samples per distribution')
+    parser.add_argument('--pending', type=int, default=200000, help='Receipts to hold in the scheduler')
+    args = parser.parse_args()
+    bench_sampling(args.draws)
+    asyncio.run(bench_scheduler(args.pending))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Compare event loops on the full bind -> submit_sm -> submit_sm_resp ->
+deliver_sm (DLR) -> deliver_sm_resp round trip against an in-process
+FakeSMSC with an in-memory Redis stand-in.
+
+    python benchmarks/bench_event_loops.py [--clients 8] [--messages 2000]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_smsc  # noqa: E402
+from fake_smsc import (  # noqa: E402
+    BIND_TRANSCEIVER, DELIVER_SM, DELIVER_SM_RESP, SUBMIT_SM, FakeSMSC,
+)
+
+
+class MemoryRedis:
+    """Just enough of redis.asyncio.Redis for the activation lookup path."""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+
+def cstring(value):
+    return value.encode('latin-1') + b'\x00'
+
+
+def build_bind(seq):
+    body = cstring('bench') + cstring('bench') + cstring('') + b'\x34\x00\x00' + cstring('')
+    return struct.pack('>IIII', 16 + len(body), BIND_TRANSCEIVER, 0, seq) + body
+
+
+def build_submit_sm(seq, dest):
+    message = b'benchmark'
+    body = cstring('') + b'\x05\x00' + cstring('BENCH') + b'\x01\x01' + cstring(dest)
+    body += b'\x00\x00\x00' + cstring('') + cstring('')
+    body += struct.pack('BBBBB', 1, 0, 0, 0, len(message)) + message
+    return struct.pack('>IIII', 16 + len(body), SUBMIT_SM, 0, seq) + body
+
+
+async def read_pdu(reader):
+    header = await reader.readexactly(16)
+    length, cmd, status, seq = struct.unpack('>IIII', header)
+    if length > 16:
+        await reader.readexactly(length - 16)
+    return cmd, seq
+
+
+async def client(port, messages, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(build_bind(1))
+    await read_pdu(reader)
+    for i in range(messages):
+        started = time.perf_counter()
+        writer.write(build_submit_sm(i + 2, f'59399{i % 100:07d}'))
+        await read_pdu(reader)          # submit_sm_resp
+        while True:
+            cmd, seq = await read_pdu(reader)
+            if cmd == DELIVER_SM:
+                writer.write(struct.pack('>IIII', 16, DELIVER_SM_RESP, 0, seq))
+                break
+        latencies.append(time.perf_counter() - started)
+    writer.close()
+
+
+async def run_once(clients, messages):
+    fake_smsc.rc_client = MemoryRedis({f'dlr:block:59399{i:07d}': b'1' for i in range(0, 100, 2)})
+    smsc = FakeSMSC(host='127.0.0.1', port=0, dlr_delay=0, dlr_resolution=0.001, cache_size=0)
+    server = asyncio.ensure_future(smsc.run())
+    while smsc.server is None:
+        await asyncio.sleep(0.01)
+    port = smsc.server.sockets[0].getsockname()[1]
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(client(port, messages, latencies) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    smsc._signal_handler()
+    await server
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent binds')
+    parser.add_argument('--messages', type=int, default=2000, help='Round trips per bind')
+    args = parser.parse_args()
+    logging.getLogger('fake_smsc').setLevel(logging.ERROR)
+
+    factories = [('asyncio', asyncio.new_event_loop)]
+    try:
+        import uvloop
+        factories.append(('uvloop', uvloop.new_event_loop))
+    except ImportError:
+        print('uvloop not installed; benchmarking the asyncio loop only')
+
+    for name, factory in factories:
+        loop = factory()
+        try:
+            rate, p50, p99 = loop.run_until_complete(run_once(args.clients, args.messages))
+        finally:
+            loop.close()
+        print(f"{name:8s} {rate:9.0f} round trips/s   p50 {p50 * 1e3:6.2f} ms   p99 {p99 * 1e3:6.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Regression suite for the PDU and DLR paths: runs smpp_loadgen against an
+in-process FakeSMSC (in-memory Redis) for a fixed set of scenarios and
+optionally compares the results with a saved baseline.
+
+    python benchmarks/bench_smpp_paths.py --save baseline.json
+    python benchmarks/bench_smpp_paths.py --baseline baseline.json [--tolerance 0.15]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from smpp_loadgen import run_in_process  # noqa: E402
+
+SCENARIOS = {
+    'stream-w1': dict(transport='stream', window=1),
+    'stream-w32': dict(transport='stream', window=32),
+    'buffered-w32': dict(transport='buffered', window=32),
+    'no-cache-w32': dict(transport='stream', window=32, cache_size=0),
+}
+
+
+def run_scenario(options, binds, messages):
+    options = dict(options)
+    window = options.pop('window')
+    result, _ = asyncio.run(run_in_process(binds, window, messages, numbers=1000,
+                                           active_ratio=0.5, seed=1, **options))
+    return result.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--binds', type=int, default=8, help='Concurrent binds per scenario')
+    parser.add_argument('--messages', type=int, default=2000, help='submit_sm per bind')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with a JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Allowed throughput drop / p99 growth before flagging')
+    args = parser.parse_args()
+    logging.getLogger('fake_smsc').setLevel(logging.ERROR)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    for name, options in SCENARIOS.items():
+        summary = run_scenario(options, args.binds, args.messages)
+        results[name] = summary
+        line = (f"{name:14s} {summary['submit_rate']:9.0f} msg/s   "
+                f"submit_resp p99 {summary['submit_resp_ms']['p99']:7.2f} ms   "
+                f"DLR p99 {summary['dlr_ms']['p99']:7.2f} ms   "
+                f"wrong DLRs {summary['dlr_wrong']}")
+        flags = []
+        if summary['dlr_wrong'] or summary['errors'] or summary['dlrs'] != summary['submitted']:
+            flags.append('INCORRECT')
+        previous = baseline.get(name)
+        if previous:
+            if summary['submit_rate'] < previous['submit_rate'] * (1 - args.tolerance):
+                flags.append(f"throughput {previous['submit_rate']:.0f} -> {summary['submit_rate']:.0f}")
+            if summary['submit_resp_ms']['p99'] > previous['submit_resp_ms']['p99'] * (1 + args.tolerance):
+                flags.append(f"p99 {previous['submit_resp_ms']['p99']:.2f} -> "
+                             f"{summary['submit_resp_ms']['p99']:.2f} ms")
+        if flags:
+            regressions += 1
+            line += '   REGRESSION: ' + '; '.join(flags)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-PDU cost of the compiled SubmitSM parser versus the
+original parse_cstring-based parser.
+
+    python benchmarks/bench_submit_sm_parser.py [-n 200000]
+"""
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_smsc import SubmitSM, TLV_SAR_MSG_REF_NUM, TLV_SAR_SEGMENT_SEQNUM, TLV_SAR_TOTAL_SEGMENTS  # noqa: E402
+
+
+def legacy_parse_cstring(data, offset):
+    end = data.index(b'\x00', offset)
+    return data[offset:end].decode('latin-1'), end + 1
+
+
+def legacy_parse_submit_sm(body):
+    """The parser SMPPSession used before SubmitSM (kept here for comparison)."""
+    offset = 0
+    service_type, offset = legacy_parse_cstring(body, offset)
+    offset += 2
+    source_addr, offset = legacy_parse_cstring(body, offset)
+    offset += 2
+    destination_addr, offset = legacy_parse_cstring(body, offset)
+    esm_class = body[offset]
+    offset += 3
+    schedule_delivery_time, offset = legacy_parse_cstring(body, offset)
+    validity_period, offset = legacy_parse_cstring(body, offset)
+    registered_delivery = body[offset]
+    data_coding = body[offset + 2]
+    sm_length = body[offset + 4]
+    offset += 5
+    short_message = body[offset:offset + sm_length]
+    return {
+        'source_addr': source_addr,
+        'destination_addr': destination_addr,
+        'short_message': short_message,
+        'registered_delivery': registered_delivery,
+        'data_coding': data_coding,
+        'esm_class': esm_class
+    }
+
+
+def build_body(with_tlvs=False):
+    message = b'Your NETFLIX verification code is 123456'
+    body = b'\x00' + b'\x05\x00' + b'NETFLIX\x00' + b'\x01\x01' + b'593996844442\x00'
+    body += b'\x00\x00\x00' + b'\x00' + b'\x00'
+    body += struct.pack('BBBBB', 1, 0, 0, 0, len(message)) + message
+    if with_tlvs:
+        for tag, value in ((TLV_SAR_MSG_REF_NUM, 42), (TLV_SAR_TOTAL_SEGMENTS, 2), (TLV_SAR_SEGMENT_SEQNUM, 1)):
+            size = 2 if tag == TLV_SAR_MSG_REF_NUM else 1
+            body += struct.pack('>HH', tag, size) + value.to_bytes(size, 'big')
+    return body
+
+
+def new_parse(body):
+    sm = SubmitSM(body)
+    return sm.source_addr, sm.destination_addr, sm.registered_delivery
+
+
+def legacy_parse(body):
+    sm = legacy_parse_submit_sm(body)
+    return sm['source_addr'], sm['destination_addr'], sm['registered_delivery']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=200000, help='PDUs per run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs (best is reported)')
+    args = parser.parse_args()
+
+    body = build_body()
+    view = memoryview(bytearray(build_body(with_tlvs=True)))
+    cases = [
+        ('legacy parser (bytes)', lambda: legacy_parse(body)),
+        ('SubmitSM (bytes)', lambda: new_parse(body)),
+        ('SubmitSM (memoryview)', lambda: new_parse(view)),
+        ('SubmitSM + TLVs (memoryview)', lambda: SubmitSM(view).options),
+    ]
+    baseline = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat))
+        per_pdu = best / args.number * 1e9
+        baseline = baseline or per_pdu
+        print(f"{name:32s} {per_pdu:8.0f} ns/PDU  ({baseline / per_pdu:4.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
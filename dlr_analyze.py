@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of FakeSMSC runs from capture files or server logs
+
+Streams a capture (fake_smsc.py --capture) or the [SUBMIT_SM],
+[ACCEPT]/[REJECT] and [DLR SENT] log lines (text or JSON, optionally
+gzipped) in chunks of columns, and reports throughput over time, DLR
+latency percentiles, accept/reject ratios per destination prefix and
+messages whose receipt never came. Columns are numpy arrays when numpy is
+installed; otherwise the same aggregates are computed with plain Python.
+Only messages still waiting for a receipt are kept between chunks.
+
+    python dlr_analyze.py smsc.cap
+    python dlr_analyze.py fake_smsc.log.2.gz fake_smsc.log.1 fake_smsc.log --prefix-digits 6
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import re
+import sys
+import time
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import smpp_capture
+from fake_smsc import (
+    CAPTURE_IN,
+    CAPTURE_MAGIC,
+    DELIVER_SM,
+    MESSAGE_STATES,
+    PDU_HEADER,
+    STATE_REJECTED,
+    SUBMIT_SM,
+    SUBMIT_SM_RESP,
+    SubmitSM,
+    normalize_msisdn,
+)
+
+STAT_NAMES = {code: stat for stat, code in MESSAGE_STATES.items()}
+# Latency histogram: 800 buckets from 1 ms to 1e5 s, each 2.3% wider than the last.
+LATENCY_EDGES = [10 ** (i / 100) / 1000 for i in range(801)]
+
+_RECEIPT = re.compile(rb'id:(\S+) .*stat:(\w+)')
+# One event of a text or JSON log: asctime, the level (and worker) tags,
+# then the tagged message. Unanchored, so the scan skips other lines in C.
+_LOG_EVENT = re.compile(
+    r'(?P<ts>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(?P<ms>\d{3})'
+    r'(?: \[\w+\]|", "level": "\w+", "msg": "| ?\[w\d+\])*? ?\['
+    r'(?:SUBMIT_SM\] [^\s"]+ -> (?P<dest>[^\s"]+) msg_id=(?P<submitted>[^\s"]+)'
+    r'|(?P<decision>ACCEPT|REJECT)\] dest=(?P<decided_dest>[^\s"]+) '
+    r'|DLR SENT\] msg_id=(?P<receipt>[^\s"]+) stat=(?P<stat>\w+))')
+LOG_BLOCK = 4 * 1024 * 1024
+
+
+class EventChunk:
+    """A chunk of submit, receipt and gate decision events as columns (lists)."""
+
+    __slots__ = ('submit_ids', 'submit_times', 'submit_prefixes', 'submit_expect',
+                 'receipt_ids', 'receipt_times', 'receipt_states',
+                 'decision_prefixes', 'decision_accepted')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, [])
+
+    def __len__(self):
+        return len(self.submit_ids) + len(self.receipt_ids) + len(self.decision_prefixes)
+
+
+def prefix_code(dest, digits):
+    """First `digits` digits of a destination as an int (a leading 1 keeps its zeros); -1 if not numeric"""
+    number = normalize_msisdn(dest)[:digits]
+    return int('1' + number) if number.isdigit() else -1
+
+
+def prefix_text(code):
+    return str(code)[1:] if code >= 0 else '(non-numeric)'
+
+
+def capture_events(path, prefix_digits=5, chunk_size=1000000):
+    """Yield EventChunks from a capture and its continuation files
+
+    A message is submitted when its submit_sm_resp is written (with the
+    submit_sm's time); a receipt is a deliver_sm carrying "id:... stat:...".
+    """
+    epoch = smpp_capture.read_epoch(path)
+    submits = {}    # (session, sequence) -> (time, prefix, receipt requested)
+    chunk = EventChunk()
+    for name in smpp_capture.capture_files(path):
+        for _, t_us, session_id, direction, pdu in smpp_capture.read_records(name):
+            _, cmd, status, seq = PDU_HEADER.unpack_from(pdu)
+            if cmd == SUBMIT_SM and direction == CAPTURE_IN:
+                try:
+                    sm = SubmitSM(memoryview(pdu)[16:])
+                except ValueError:
+                    continue
+                submits[(session_id, seq)] = (epoch + t_us / 1e6,
+                                              prefix_code(sm.destination_addr, prefix_digits),
+                                              bool(sm.registered_delivery & 0x01))
+            elif cmd == SUBMIT_SM_RESP:
+                submit = submits.pop((session_id, seq), None)
+                if submit is None or status:
+                    continue
+                chunk.submit_ids.append(pdu[16:].split(b'\x00', 1)[0])
+                chunk.submit_times.append(submit[0])
+                chunk.submit_prefixes.append(submit[1])
+                chunk.submit_expect.append(submit[2])
+            elif cmd == DELIVER_SM and direction != CAPTURE_IN:
+                match = _RECEIPT.search(pdu, 16)
+                if match is None:
+                    continue
+                chunk.receipt_ids.append(match.group(1))
+                chunk.receipt_times.append(epoch + t_us / 1e6)
+                chunk.receipt_states.append(MESSAGE_STATES.get(match.group(2).decode('latin-1'), 0))
+            else:
+                continue
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = EventChunk()
+    if len(chunk):
+        yield chunk
+
+
+def log_events(path, prefix_digits=5, chunk_size=1000000):
+    """Yield EventChunks from a text or JSON (--log-format json) server log
+
+    The file is read in blocks of LOG_BLOCK characters and each block is
+    scanned by one regex, so lines without an event cost no Python code;
+    timestamps are converted with one mktime per hour of log. Every logged
+    submit is taken to request a receipt: the log does not say. With
+    --log-sample N the lines of a kept message all survive, so the figures
+    describe a consistent 1-in-N sample.
+    """
+    chunk = EventChunk()
+    size = 0
+    hours = {}
+    dest, code = None, -1
+    carry = ''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        while True:
+            block = f.read(LOG_BLOCK)
+            text = carry + block
+            if not text:
+                break
+            cut = text.rfind('\n') + 1 if block else len(text)
+            carry = text[cut:]
+            for match in _LOG_EVENT.finditer(text, 0, cut):
+                stamp, ms, submitted, decision, receipt = match.group(
+                    'ts', 'ms', 'submitted', 'decision', 'receipt')
+                hour = stamp[:13]
+                if hour not in hours:
+                    hours[hour] = time.mktime(time.strptime(hour, '%Y-%m-%d %H'))
+                t = hours[hour] + int(stamp[14:16]) * 60 + int(stamp[17:]) + int(ms) / 1000
+                if submitted is not None:
+                    chunk.submit_ids.append(submitted.encode('latin-1'))
+                    chunk.submit_times.append(t)
+                    dest = match.group('dest')
+                    code = prefix_code(dest, prefix_digits)
+                    chunk.submit_prefixes.append(code)
+                    chunk.submit_expect.append(True)
+                elif decision is not None:
+                    # Gates settle asynchronously, so a decision may follow
+                    # other sessions' submits; it names its own destination.
+                    decided = match.group('decided_dest')
+                    if decided != dest:
+                        dest, code = decided, prefix_code(decided, prefix_digits)
+                    chunk.decision_prefixes.append(code)
+                    chunk.decision_accepted.append(decision == 'ACCEPT')
+                else:
+                    chunk.receipt_ids.append(receipt.encode('latin-1'))
+                    chunk.receipt_times.append(t)
+                    chunk.receipt_states.append(MESSAGE_STATES.get(match.group('stat'), 0))
+                size += 1
+                if size >= chunk_size:
+                    yield chunk
+                    chunk = EventChunk()
+                    size = 0
+            if not block:
+                break
+    if size:
+        yield chunk
+
+
+class DLRAnalysis:
+    """Running aggregates over EventChunks, in memory independent of run length.
+
+    Per chunk: submit and receipt counts per `bucket` seconds, a log-bucket
+    latency histogram, counts per stat and accepted/rejected per prefix.
+    Receipts are matched to earlier submits by message_id (a sort and a
+    binary search per chunk with numpy); only submits still waiting for
+    their receipt are carried over. With `receipt_decisions` (captures,
+    which have no [ACCEPT]/[REJECT] lines) a REJECTD receipt counts as a
+    rejection and any other stat as an acceptance.
+    """
+
+    def __init__(self, bucket=1.0, receipt_decisions=False):
+        self.bucket = bucket
+        self.receipt_decisions = receipt_decisions
+        self.origin = None
+        self.start = None
+        self.end = None
+        self.submitted = 0
+        self.receipts = 0
+        self.unmatched = 0
+        self.latency_max = 0.0
+        self.states = Counter()
+        self.decisions = Counter()      # prefix * 2 + accepted -> count
+        if numpy is not None:
+            self._edges = numpy.array(LATENCY_EDGES)
+            self.latency_counts = numpy.zeros(len(LATENCY_EDGES) + 1, dtype=numpy.int64)
+            self.submit_series = numpy.zeros(0, dtype=numpy.int64)
+            self.receipt_series = numpy.zeros(0, dtype=numpy.int64)
+            self._pending = (numpy.zeros(0, dtype='S1'), numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64))
+        else:
+            self.latency_counts = [0] * (len(LATENCY_EDGES) + 1)
+            self.submit_series = Counter()
+            self.receipt_series = Counter()
+            self._pending = {}          # message_id -> (time, prefix)
+
+    def add(self, chunk):
+        times = chunk.submit_times + chunk.receipt_times
+        if not times:
+            self._add_decisions(chunk.decision_prefixes, chunk.decision_accepted)
+            return
+        start, end = min(times), max(times)
+        if self.origin is None:
+            # Buckets are counted from the whole second of the first event.
+            self.origin = float(int(start))
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+        self.submitted += len(chunk.submit_ids)
+        self.receipts += len(chunk.receipt_ids)
+        if numpy is not None:
+            self._add_vectorized(chunk)
+        else:
+            self._add_python(chunk)
+        if not self.receipt_decisions:
+            self._add_decisions(chunk.decision_prefixes, chunk.decision_accepted)
+
+    def _add_vectorized(self, chunk):
+        submit_times = numpy.array(chunk.submit_times, dtype=numpy.float64)
+        receipt_times = numpy.array(chunk.receipt_times, dtype=numpy.float64)
+        self.submit_series = self._count(self.submit_series, submit_times)
+        self.receipt_series = self._count(self.receipt_series, receipt_times)
+        states = numpy.array(chunk.receipt_states, dtype=numpy.int64)
+        for state, count in enumerate(numpy.bincount(states, minlength=len(STAT_NAMES) + 1)):
+            if count:
+                self.states[state] += int(count)
+
+        expect = numpy.array(chunk.submit_expect, dtype=bool)
+        pending_ids, pending_times, pending_prefixes = self._pending
+        pending_ids = numpy.concatenate((pending_ids, numpy.array(chunk.submit_ids, dtype='S')[expect]))
+        pending_times = numpy.concatenate((pending_times, submit_times[expect]))
+        pending_prefixes = numpy.concatenate(
+            (pending_prefixes, numpy.array(chunk.submit_prefixes, dtype=numpy.int64)[expect]))
+
+        receipt_ids = numpy.array(chunk.receipt_ids, dtype='S')
+        if len(pending_ids) and len(receipt_ids):
+            order = numpy.argsort(pending_ids, kind='stable')
+            ordered = pending_ids[order]
+            position = numpy.minimum(numpy.searchsorted(ordered, receipt_ids), len(ordered) - 1)
+            hits = numpy.flatnonzero(ordered[position] == receipt_ids)
+            # A resent receipt matches the same submit again: keep the first.
+            matched, first = numpy.unique(order[position[hits]], return_index=True)
+            hits = hits[first]
+        else:
+            matched = hits = numpy.zeros(0, dtype=numpy.int64)
+        self.unmatched += len(receipt_ids) - len(hits)
+
+        latency = receipt_times[hits] - pending_times[matched]
+        if len(latency):
+            self.latency_max = max(self.latency_max, float(latency.max()))
+            self.latency_counts += numpy.bincount(numpy.searchsorted(self._edges, latency),
+                                                  minlength=len(self.latency_counts))
+        if self.receipt_decisions:
+            self._add_decisions(pending_prefixes[matched], states[hits] != STATE_REJECTED)
+
+        keep = numpy.ones(len(pending_ids), dtype=bool)
+        keep[matched] = False
+        self._pending = (pending_ids[keep], pending_times[keep], pending_prefixes[keep])
+
+    def _count(self, series, times):
+        if not len(times):
+            return series
+        counts = numpy.bincount(numpy.maximum((times - self.origin) // self.bucket, 0).astype(numpy.int64))
+        if len(counts) > len(series):
+            series = numpy.concatenate((series, numpy.zeros(len(counts) - len(series), dtype=numpy.int64)))
+        series[:len(counts)] += counts
+        return series
+
+    def _add_python(self, chunk):
+        origin, bucket = self.origin, self.bucket
+        self.submit_series.update(max(int((t - origin) // bucket), 0) for t in chunk.submit_times)
+        self.receipt_series.update(max(int((t - origin) // bucket), 0) for t in chunk.receipt_times)
+        self.states.update(chunk.receipt_states)
+        pending = self._pending
+        for message_id, t, prefix, expect in zip(chunk.submit_ids, chunk.submit_times,
+                                                 chunk.submit_prefixes, chunk.submit_expect):
+            if expect:
+                pending[message_id] = (t, prefix)
+        prefixes, accepted = [], []
+        for message_id, t, state in zip(chunk.receipt_ids, chunk.receipt_times, chunk.receipt_states):
+            submit = pending.pop(message_id, None)
+            if submit is None:
+                self.unmatched += 1
+                continue
+            latency = t - submit[0]
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_counts[bisect.bisect_left(LATENCY_EDGES, latency)] += 1
+            prefixes.append(submit[1])
+            accepted.append(state != STATE_REJECTED)
+        if self.receipt_decisions:
+            self._add_decisions(prefixes, accepted)
+
+    def _add_decisions(self, prefixes, accepted):
+        if numpy is not None and len(prefixes):
+            keys, counts = numpy.unique(numpy.asarray(prefixes, dtype=numpy.int64) * 2
+                                        + numpy.asarray(accepted, dtype=numpy.int64), return_counts=True)
+            self.decisions.update(dict(zip(keys.tolist(), counts.tolist())))
+        else:
+            self.decisions.update(prefix * 2 + bool(ok) for prefix, ok in zip(prefixes, accepted))
+
+    def pending(self):
+        """[(message_id, submit time)] of submits still without a receipt"""
+        if numpy is not None:
+            ids, times, _ = self._pending
+            return list(zip(ids.tolist(), times.tolist()))
+        return [(message_id, t) for message_id, (t, _) in self._pending.items()]
+
+    def percentile(self, fraction):
+        """Upper edge of the latency bucket holding `fraction` of the matched receipts"""
+        counts = [int(count) for count in self.latency_counts]
+        target = fraction * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return min(LATENCY_EDGES[i], self.latency_max) if i < len(LATENCY_EDGES) else self.latency_max
+        return 0.0
+
+    def series(self, which):
+        series = self.submit_series if which == 'submit' else self.receipt_series
+        if numpy is not None:
+            return series.tolist()
+        return [series.get(i, 0) for i in range(max(series) + 1)] if series else []
+
+    def summary(self, grace=60.0, top=20, sample=10):
+        """Everything as one dict; submits within `grace` seconds of the end still await their receipt"""
+        pending = self.pending()
+        cutoff = (self.end or 0.0) - grace
+        missing = sorted((t, message_id) for message_id, t in pending if t < cutoff)
+        by_prefix = Counter()
+        for key, count in self.decisions.items():
+            by_prefix[key // 2] += count
+        prefixes = []
+        for prefix, total in by_prefix.most_common(top):
+            accepted = self.decisions.get(prefix * 2 + 1, 0)
+            prefixes.append({'prefix': prefix_text(prefix), 'accepted': accepted,
+                             'rejected': total - accepted, 'reject_ratio': round(1 - accepted / total, 4)})
+        submit_series, receipt_series = self.series('submit'), self.series('receipt')
+        duration = self.end - self.start if self.end is not None else 0.0
+        return {
+            'duration_s': round(duration, 3),
+            'submitted': self.submitted,
+            'receipts': self.receipts,
+            'unmatched_receipts': self.unmatched,
+            'missing_receipts': len(missing),
+            'awaiting_at_end': len(pending) - len(missing),
+            'missing_sample': [message_id.decode('latin-1') for _, message_id in missing[:sample]],
+            'stats': {STAT_NAMES.get(state, 'unknown'): count for state, count in sorted(self.states.items())},
+            'latency_s': {name: round(self.percentile(fraction), 6) for name, fraction in
+                          (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))},
+            'latency_max_s': round(self.latency_max, 6),
+            'throughput': {
+                'bucket_s': self.bucket,
+                'submit_peak': max(submit_series, default=0) / self.bucket,
+                'submit_mean': round(self.submitted / duration, 1) if duration > 0 else 0.0,
+                'receipt_peak': max(receipt_series, default=0) / self.bucket,
+                'receipt_mean': round(self.receipts / duration, 1) if duration > 0 else 0.0,
+                'submit_series': submit_series,
+                'receipt_series': receipt_series,
+            },
+            'prefixes': prefixes,
+        }
+
+
+def is_capture(path):
+    with open(path, 'rb') as f:
+        return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def analyze(paths, prefix_digits=5, bucket=1.0, chunk_size=1000000):
+    """Feed every file (all captures or all logs, in time order) to one DLRAnalysis"""
+    kinds = {is_capture(path) for path in paths}
+    if len(kinds) > 1:
+        raise ValueError("give either capture files or log files, not both")
+    captures = kinds.pop()
+    analysis = DLRAnalysis(bucket=bucket, receipt_decisions=captures)
+    events = capture_events if captures else log_events
+    for path in paths:
+        for chunk in events(path, prefix_digits, chunk_size):
+            analysis.add(chunk)
+    return analysis
+
+
+def format_report(summary):
+    latency, rates = summary['latency_s'], summary['throughput']
+    lines = [
+        f"{summary['submitted']} submitted, {summary['receipts']} receipts "
+        f"({summary['unmatched_receipts']} unmatched) over {summary['duration_s']:.1f}s",
+        f"throughput  submit mean {rates['submit_mean']:.0f}/s peak {rates['submit_peak']:.0f}/s   "
+        f"receipts mean {rates['receipt_mean']:.0f}/s peak {rates['receipt_peak']:.0f}/s",
+        f"DLR latency p50 {latency['p50'] * 1e3:.1f} ms  p90 {latency['p90'] * 1e3:.1f} ms  "
+        f"p99 {latency['p99'] * 1e3:.1f} ms  p99.9 {latency['p999'] * 1e3:.1f} ms  "
+        f"max {summary['latency_max_s'] * 1e3:.1f} ms",
+        f"stats {summary['stats']}",
+        f"missing receipts {summary['missing_receipts']}  still awaited at the end "
+        f"{summary['awaiting_at_end']}" + (f"  e.g. {', '.join(summary['missing_sample'])}"
+                                          if summary['missing_sample'] else ''),
+    ]
+    if summary['prefixes']:
+        lines.append(f"{'prefix':>16s} {'accepted':>10s} {'rejected':>10s} {'reject %':>9s}")
+        for row in summary['prefixes']:
+            lines.append(f"{row['prefix']:>16s} {row['accepted']:10d} {row['rejected']:10d} "
+                         f"{row['reject_ratio'] * 100:8.1f}%")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='+',
+                        help='Capture files, or log files (.gz allowed) oldest first')
+    parser.add_argument('--prefix-digits', type=int, default=5,
+                        help='Destination digits that make up a prefix (max 15)')
+    parser.add_argument('--bucket', type=float, default=1.0, help='Seconds per throughput bucket')
+    parser.add_argument('--grace', type=float, default=60.0,
+                        help='Submits this close to the end are still awaited, not missing')
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='Events per chunk')
+    parser.add_argument('--top', type=int, default=20, help='Prefixes to list, by volume')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the summary (with per-bucket series) as JSON')
+    args = parser.parse_args()
+    if not 1 <= args.prefix_digits <= 15:
+        parser.error("--prefix-digits must be between 1 and 15")
+
+    started = time.perf_counter()
+    analysis = analyze(args.files, args.prefix_digits, args.bucket, args.chunk_size)
+    summary = analysis.summary(grace=args.grace, top=args.top)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(format_report(summary))
+        print(f"analyzed in {time.perf_counter() - started:.2f}s "
+              f"({'numpy' if numpy is not None else 'pure Python'})", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
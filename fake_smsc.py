@@ -5,21 +5,108 @@ Accepts submit_sm, responds with submit_sm_resp, sends DLR after N seconds
 """
 
 import asyncio
+import bisect
+from array import array
+import concurrent.futures
+import itertools
+import json
+import math
+import re
 import struct
 import time
 import uuid
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import signal
 import sys
+from collections import Counter, OrderedDict, deque
 import redis.asyncio as redis
 
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s'
+    format=LOG_FORMAT
 )
 logger = logging.getLogger('fake_smsc')
 
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per log line."""
+
+    def __init__(self, worker=None):
+        super().__init__()
+        self.worker = worker
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+        if self.worker is not None:
+            entry['worker'] = self.worker
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class LogSampler:
+    """Keep the per-message log lines of 1 in `every` message ids.
+
+    The choice is a function of the message id, so the [SUBMIT_SM],
+    [ACCEPT]/[REJECT] and [DLR SENT] lines of a kept message all survive.
+    """
+
+    def __init__(self, every=1):
+        self.every = every
+
+    def keep(self, message_id):
+        return self.every <= 1 or hash(message_id) % self.every == 0
+
+
+log_sampler = LogSampler()
+
+
+def configure_logging(mode='sync', fmt='text', sample=1, worker=None):
+    """(Re)build the root logging handlers; return the QueueListener, if any.
+
+    In 'async' mode records are queued from the event loop and formatted and
+    written by a background thread.
+    """
+    if fmt == 'json':
+        formatter = JsonLogFormatter(worker)
+    elif worker is not None:
+        formatter = logging.Formatter(f'%(asctime)s [%(levelname)s] [w{worker}] %(message)s')
+    else:
+        formatter = logging.Formatter(LOG_FORMAT)
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    log_sampler.every = sample
+
+    if mode == 'async':
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+        root.addHandler(_DeferredQueueHandler(records))
+        listener.start()
+        return listener
+    root.addHandler(stream)
+    return None
+
 # SMPP Command IDs
 GENERIC_NACK = 0x80000000
 BIND_RECEIVER = 0x00000001
@@ -30,6 +117,8 @@ BIND_TRANSCEIVER = 0x00000009
 BIND_TRANSCEIVER_RESP = 0x80000009
 SUBMIT_SM = 0x00000004
 SUBMIT_SM_RESP = 0x80000004
+QUERY_SM = 0x00000003
+QUERY_SM_RESP = 0x80000003
 DELIVER_SM = 0x00000005
 DELIVER_SM_RESP = 0x80000005
 UNBIND = 0x00000006
@@ -38,25 +127,112 @@ ENQUIRE_LINK = 0x00000015
 ENQUIRE_LINK_RESP = 0x80000015
 ESME_RINVSRCADR = 0x0000000A  # Invalid Source Address
 
+TLV_USER_MESSAGE_REFERENCE = 0x0204
+ESM_UDHI = 0x40
+UDH_CONCAT_8BIT = 0x00
+UDH_CONCAT_16BIT = 0x08
+TLV_SAR_MSG_REF_NUM = 0x020C
+TLV_SAR_TOTAL_SEGMENTS = 0x020E
+TLV_SAR_SEGMENT_SEQNUM = 0x020F
+TLV_MESSAGE_PAYLOAD = 0x0424
 TLV_MESSAGE_STATE = 0x0427
 STATE_DELIVERED = 0x02
 STATE_REJECTED  = 0x08
 
+# DLR stat text -> SMPP message_state
+MESSAGE_STATES = {
+    'ENROUTE': 1,
+    'DELIVRD': STATE_DELIVERED,
+    'EXPIRED': 3,
+    'DELETED': 4,
+    'UNDELIV': 5,
+    'ACCEPTD': 6,
+    'UNKNOWN': 7,
+    'REJECTD': STATE_REJECTED,
+}
+
 # SMPP Status
 ESME_ROK = 0x00000000
+ESME_RINVCMDLEN = 0x00000002  # Command Length is invalid
+ESME_RMSGQFUL = 0x00000014  # Message Queue Full
+ESME_RTHROTTLED = 0x00000058  # Throttling error (ESME has exceeded allowed message limits)
+ESME_RQUERYFAIL = 0x00000067  # query_sm request failed
+
+COMMAND_NAMES = {
+    GENERIC_NACK: 'generic_nack',
+    BIND_RECEIVER: 'bind_receiver',
+    BIND_RECEIVER_RESP: 'bind_receiver_resp',
+    BIND_TRANSMITTER: 'bind_transmitter',
+    BIND_TRANSMITTER_RESP: 'bind_transmitter_resp',
+    BIND_TRANSCEIVER: 'bind_transceiver',
+    BIND_TRANSCEIVER_RESP: 'bind_transceiver_resp',
+    SUBMIT_SM: 'submit_sm',
+    SUBMIT_SM_RESP: 'submit_sm_resp',
+    QUERY_SM: 'query_sm',
+    QUERY_SM_RESP: 'query_sm_resp',
+    DELIVER_SM: 'deliver_sm',
+    DELIVER_SM_RESP: 'deliver_sm_resp',
+    UNBIND: 'unbind',
+    UNBIND_RESP: 'unbind_resp',
+    ENQUIRE_LINK: 'enquire_link',
+    ENQUIRE_LINK_RESP: 'enquire_link_resp',
+}
+
+PDU_HEADER = struct.Struct('>IIII')
+MAX_PDU_SIZE = 65536
+READ_CHUNK = 65536
+_NUL = re.compile(b'\x00')
+TLV_HEADER = struct.Struct('>HH')
+
+# Mandatory part of a submit_sm body up to sm_length. Only source_addr and
+# destination_addr are captured; the other C-strings are skipped in place.
+_SUBMIT_SM = re.compile(
+    rb'[^\x00]*\x00'              # service_type
+    rb'..([^\x00]*)\x00'          # source_addr_ton, source_addr_npi, source_addr
+    rb'..([^\x00]*)\x00'          # dest_addr_ton, dest_addr_npi, destination_addr
+    rb'...'                       # esm_class, protocol_id, priority_flag
+    rb'[^\x00]*\x00[^\x00]*\x00'  # schedule_delivery_time, validity_period
+    rb'.....',                    # registered_delivery .. sm_length
+    re.S,
+)
+
+class TimedConnectionPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool that records how long callers wait for a connection."""
+
+    wait_histogram = None
+
+    async def get_connection(self, *args, **kwargs):
+        started = time.perf_counter()
+        connection = await super().get_connection(*args, **kwargs)
+        if self.wait_histogram is not None:
+            self.wait_histogram.observe(time.perf_counter() - started)
+        return connection
+
 
 # Async client: a blocking sync GET would stall the whole asyncio loop (and every
 # other session) for the Redis RTT on every submit_sm. Short timeouts make a dead
 # Redis fail fast into the fail-open path instead of hanging the DLR.
-rc_client = redis.Redis(
-    host=os.environ.get('REDIS_HOST', 'localhost'),
-    port=int(os.environ.get('REDIS_PORT', 6379)),
-    db=int(os.environ.get('REDIS_DB', 0)),
-    password=os.environ.get('REDIS_PASSWORD', ''),
-    username=os.environ.get('REDIS_USERNAME', 'default'),
-    socket_timeout=2,
-    socket_connect_timeout=2,
-)
+def make_redis_client(max_connections=64, socket_timeout=2.0, protocol=2):
+    """Redis client from REDIS_* env vars with a bounded, timed connection pool.
+
+    A caller waits at most `socket_timeout` for a free connection too.
+    """
+    pool = TimedConnectionPool(
+        max_connections=max_connections,
+        timeout=socket_timeout,
+        host=os.environ.get('REDIS_HOST', 'localhost'),
+        port=int(os.environ.get('REDIS_PORT', 6379)),
+        db=int(os.environ.get('REDIS_DB', 0)),
+        password=os.environ.get('REDIS_PASSWORD', ''),
+        username=os.environ.get('REDIS_USERNAME', 'default'),
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_timeout,
+        protocol=protocol,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+rc_client = make_redis_client()
 
 
 def normalize_msisdn(addr):
@@ -66,46 +242,2361 @@ def normalize_msisdn(addr):
     return addr.strip().lstrip('+')
 
 
+class RedisCircuitBreaker:
+    """Stop calling Redis after `threshold` consecutive errors.
+
+    While the circuit is open every activation lookup fails open (DELIVRD)
+    at once instead of waiting for a socket timeout; a background probe
+    PINGs Redis every `probe_interval` seconds and closes the circuit on
+    the first success. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=5, probe_interval=1.0):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.is_open = False
+        self.failures = 0
+        self.opens = 0
+        self.short_circuited = 0
+        self._probe = None
+
+    def allow(self):
+        """False (and counted) while the circuit is open"""
+        if self.is_open:
+            self.short_circuited += 1
+            return False
+        return True
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.threshold and not self.is_open and self.failures >= self.threshold:
+            self.is_open = True
+            self.opens += 1
+            logger.error(f"[REDIS CIRCUIT] open after {self.failures} consecutive errors; "
+                         f"failing open until a probe succeeds")
+            self._probe = asyncio.ensure_future(self._run_probe())
+
+    async def _run_probe(self):
+        while self.is_open:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await rc_client.ping()
+            except Exception as e:
+                logger.debug(f"[REDIS CIRCUIT] probe failed: {e}")
+                continue
+            self.is_open = False
+            self.failures = 0
+            logger.info(f"[REDIS CIRCUIT] closed ({self.short_circuited} lookups failed open so far)")
+
+    def close(self):
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+
+    def stats(self):
+        return {
+            'open': int(self.is_open),
+            'opens': self.opens,
+            'short_circuited': self.short_circuited,
+        }
+
+
+class ActivationCache:
+    """In-process LRU of `dlr:block:*` lookup results.
+
+    Positive entries live for the key's real remaining TTL (PTTL at fill
+    time); negative entries for `negative_ttl` seconds. `watch()` subscribes
+    to keyspace notifications so a SET/DEL/EXPIRE on a key drops its entry
+    immediately. Until that subscription is live, positive entries are also
+    capped at `negative_ttl` so a DEL we cannot see is not trusted for the
+    full 20-minute window.
+
+    Keyspace notifications require `notify-keyspace-events` to include `K`
+    plus the generic (`g`), string (`$`) and expired (`x`) classes, e.g.
+    `Kg$x`. With `tracking=True` invalidations come from server-assisted
+    client-side caching instead (CLIENT TRACKING in BCAST mode, Redis 6+),
+    which needs no server configuration.
+    """
+
+    def __init__(self, max_size=100000, negative_ttl=1.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.live = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+        # Keys with a lookup in flight -> [fills, invalidation count], and an
+        # epoch bumped by clear(), so a reply that raced an invalidation is
+        # not cached.
+        self._fills = {}
+        self._epoch = 0
+
+    def get(self, key):
+        """Return the cached bool for `key`, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            active, expires_at = entry
+            if expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return active
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def begin_fill(self, keys):
+        """Mark `keys` as being looked up; return their generations for `put`."""
+        generations = []
+        for key in keys:
+            slot = self._fills.get(key)
+            if slot is None:
+                slot = self._fills[key] = [0, 0]
+            slot[0] += 1
+            generations.append((self._epoch, slot[1]))
+        return generations
+
+    def end_fill(self, keys):
+        for key in keys:
+            slot = self._fills[key]
+            slot[0] -= 1
+            if not slot[0]:
+                del self._fills[key]
+
+    def put(self, key, active, pttl=None, generation=None):
+        """Cache a lookup result; `pttl` is the key's PTTL in ms for positives.
+
+        `generation` comes from `begin_fill()`; if the key was invalidated
+        since, the result predates the change and is dropped.
+        """
+        if generation is not None:
+            slot = self._fills.get(key)
+            if slot is None or generation != (self._epoch, slot[1]):
+                self.stale_fills += 1
+                return
+        if active:
+            if pttl is None or pttl == -2:
+                # Key vanished between MGET and PTTL: don't trust it.
+                return
+            ttl = pttl / 1000.0 if pttl >= 0 else None
+            if not self.live:
+                ttl = self.negative_ttl if ttl is None else min(ttl, self.negative_ttl)
+            elif ttl is None:
+                ttl = float('inf')  # no expiry; rely on DEL notifications
+        else:
+            ttl = self.negative_ttl
+        if ttl <= 0:
+            return
+
+        entries = self._entries
+        entries[key] = (active, self._clock() + ttl)
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        slot = self._fills.get(key)
+        if slot is not None:
+            slot[1] += 1
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._epoch += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'stale_fills': self.stale_fills,
+        }
+
+    async def watch(self, pattern='dlr:block:*', tracking=False):
+        """Invalidate entries from Redis keyspace notifications (or CLIENT
+        TRACKING invalidations) until cancelled."""
+        db = rc_client.connection_pool.connection_kwargs.get('db', 0)
+        channel = f'__keyspace@{db}__:{pattern}'
+        backoff = 1.0
+        while True:
+            pubsub = rc_client.pubsub()
+            holder = None
+            try:
+                if tracking:
+                    try:
+                        holder = await self._start_tracking(pubsub, pattern.rstrip('*'))
+                    except redis.ResponseError as e:
+                        logger.warning(f"[CACHE] CLIENT TRACKING unsupported ({e}); "
+                                       f"using keyspace notifications")
+                        tracking = False
+                        continue
+                    source = f"CLIENT TRACKING BCAST PREFIX {pattern.rstrip('*')}"
+                    self.clear()
+                    self.live = True
+                else:
+                    await pubsub.psubscribe(channel)
+                    source = channel
+                    # Anything cached before the subscription may have missed events.
+                    self.clear()
+                    self.live = await self._notifications_enabled()
+                backoff = 1.0
+                logger.info(f"[CACHE] watching {source} (invalidation live={self.live})")
+                async for message in pubsub.listen():
+                    self._on_invalidation(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[CACHE] invalidation subscription lost, retrying in {backoff:g}s: {e}")
+            finally:
+                self.live = False
+                self.clear()
+                if holder is not None:
+                    # Tracking state dies with the connection that enabled it.
+                    await holder.disconnect()
+                    await rc_client.connection_pool.release(holder)
+                try:
+                    await getattr(pubsub, 'aclose', pubsub.close)()
+                except Exception:
+                    pass
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    async def _start_tracking(self, pubsub, prefix):
+        """Redirect BCAST invalidations for `prefix` to `pubsub`; return the
+        connection holding the tracking state."""
+        await pubsub.connect()
+        await pubsub.connection.send_command('CLIENT', 'ID')
+        client_id = await pubsub.connection.read_response()
+        await pubsub.subscribe('__redis__:invalidate')
+        holder = await rc_client.connection_pool.get_connection()
+        try:
+            await holder.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id,
+                                      'BCAST', 'PREFIX', prefix)
+            await holder.read_response()
+        except Exception:
+            await holder.disconnect()
+            await rc_client.connection_pool.release(holder)
+            raise
+        return holder
+
+    def _on_invalidation(self, message):
+        kind = message.get('type')
+        if kind == 'pmessage':
+            name = message['channel']
+            if isinstance(name, bytes):
+                name = name.decode('latin-1')
+            self.invalidate(name.split('__:', 1)[1])
+        elif kind == 'message':
+            # __redis__:invalidate carries the changed keys, or nil on FLUSHALL.
+            keys = message['data']
+            if keys is None:
+                self.clear()
+                return
+            for key in keys if isinstance(keys, list) else [keys]:
+                self.invalidate(key.decode('latin-1') if isinstance(key, bytes) else key)
+
+    async def _notifications_enabled(self):
+        """Check notify-keyspace-events; assume on if CONFIG is not allowed."""
+        try:
+            reply = await rc_client.config_get('notify-keyspace-events')
+        except Exception:
+            return True
+        flags = next(iter(reply.values()), '') if reply else ''
+        if isinstance(flags, bytes):
+            flags = flags.decode('latin-1')
+        classes = set(flags.replace('A', 'g$lshzxet'))
+        if 'K' in classes and {'g', '$', 'x'} <= classes:
+            return True
+        logger.warning(
+            f"[CACHE] notify-keyspace-events={flags!r} lacks K/g/$/x; "
+            f"positive entries capped at {self.negative_ttl:g}s"
+        )
+        return False
+
+
+class ActivationLookupBatcher:
+    """Coalesce `dlr:block:*` lookups from every session into one MGET.
+
+    Lookups are parked for up to `window` seconds (or until `max_batch`
+    distinct keys are pending) and then resolved with a single round trip.
+    Duplicate keys inside a window share one slot. Fail-open is applied per
+    batch: if the MGET errors, every waiter in that batch gets True (DELIVRD).
+
+    With a `cache` attached, hits never reach Redis and each batch pipelines
+    a PTTL per key behind the MGET so positives are cached for their real
+    remaining lifetime. Fail-open results are never cached.
+    """
+
+    def __init__(self, window=0.001, max_batch=256, cache=None, breaker=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.cache = cache
+        self.breaker = breaker
+        self._pending = {}
+        self._timer = None
+        self._inflight = set()
+        self.batches = 0
+        self.lookups = 0
+
+    async def lookup(self, key):
+        """Return True if `key` exists in Redis."""
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        if self.breaker is not None and not self.breaker.allow():
+            return True     # circuit open: fail open without touching Redis
+        return await self._enqueue(key)
+
+    def _enqueue(self, key):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiters = self._pending.get(key)
+        if waiters is None:
+            self._pending[key] = [fut]
+        else:
+            waiters.append(fut)
+        self.lookups += 1
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            if self.window > 0:
+                self._timer = loop.call_later(self.window, self._flush)
+            else:
+                # Still coalesce everything queued in this loop iteration.
+                self._timer = loop.call_soon(self._flush)
+        return fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._resolve(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _resolve(self, batch):
+        keys = list(batch)
+        self.batches += 1
+        cache = self.cache
+        try:
+            if cache is None:
+                values = await rc_client.mget(keys)
+            else:
+                pipe = rc_client.pipeline(transaction=False)
+                pipe.mget(keys)
+                for key in keys:
+                    pipe.pttl(key)
+                generations = cache.begin_fill(keys)
+                try:
+                    replies = await pipe.execute()
+                    values = replies[0]
+                    for key, value, pttl, generation in zip(keys, values, replies[1:], generations):
+                        cache.put(key, value is not None, pttl, generation)
+                finally:
+                    cache.end_fill(keys)
+            results = [value is not None for value in values]
+            if self.breaker is not None:
+                self.breaker.success()
+        except Exception as e:
+            logger.error(f"[REDIS ERROR] fail-open (DELIVRD) for batch of {len(keys)} keys: {e}")
+            results = [True] * len(keys)
+            if self.breaker is not None:
+                self.breaker.failure()
+
+        for key, result in zip(keys, results):
+            for fut in batch[key]:
+                if not fut.done():
+                    fut.set_result(result)
+
+
+class PDUFramingError(Exception):
+    """The peer sent a command_length we refuse to buffer."""
+
+    def __init__(self, command_length, sequence_number):
+        super().__init__(f"invalid command_length {command_length}")
+        self.command_length = command_length
+        self.sequence_number = sequence_number
+
+
+class PDUFramer:
+    """Reusable receive buffer that yields complete PDUs as memoryview slices.
+
+    Data is read in bulk into one bytearray (either copied in with `feed()`
+    or written straight into `get_buffer()` by a BufferedProtocol transport)
+    and every complete PDU already in the buffer is handed out by
+    `next_pdu()` without further copies. A body view is only valid until the
+    next `feed()`/`get_buffer()` call, so callers must copy out anything they
+    keep across an await that can read more data.
+    """
+
+    def __init__(self, max_pdu_size=MAX_PDU_SIZE, size=READ_CHUNK):
+        self.max_pdu_size = max_pdu_size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._want = 0
+
+    def get_buffer(self, sizehint=-1):
+        """Return a writable view of the free tail of the buffer"""
+        pending = self._end - self._start
+        need = max(sizehint, self._want - pending, 4096)
+        if pending == 0:
+            self._start = self._end = 0
+        if len(self._buf) - self._end < need:
+            if len(self._buf) - pending >= need:
+                self._buf[:pending] = self._buf[self._start:self._end]
+            else:
+                # Never resize in place: older body views may still export it.
+                grown = bytearray(max(len(self._buf) * 2, pending + need))
+                grown[:pending] = self._view[self._start:self._end]
+                self._buf = grown
+                self._view = memoryview(grown)
+            self._start = 0
+            self._end = pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    @property
+    def pending(self):
+        """Bytes received but not yet handed out as PDUs"""
+        return self._end - self._start
+
+    def feed(self, data):
+        self.get_buffer(len(data))[:len(data)] = data
+        self._end += len(data)
+
+    def next_pdu(self):
+        """Return (command_id, status, sequence, body view) or None if incomplete"""
+        start = self._start
+        available = self._end - start
+        if available < 16:
+            return None
+        command_length, command_id, status, sequence = PDU_HEADER.unpack_from(self._buf, start)
+        if command_length < 16 or command_length > self.max_pdu_size:
+            raise PDUFramingError(command_length, sequence)
+        if available < command_length:
+            self._want = command_length
+            return None
+        self._start = start + command_length
+        self._want = 0
+        return command_id, status, sequence, self._view[start + 16:start + command_length]
+
+
+class SMPPBufferedProtocol(asyncio.BufferedProtocol):
+    """Transport mode where the socket reads straight into the session framer.
+
+    Also stands in for the StreamReader/StreamWriter pair, so SMPPSession
+    runs unchanged on top of it.
+
+    Reading is paused once more than `read_high_water` bytes (at least two
+    maximum-size PDUs) are buffered but not consumed, e.g. while the session
+    waits for its write window, and resumed by the session once they drain
+    below a quarter of that.
+    """
+
+    def __init__(self, smsc, read_high_water=4 * READ_CHUNK):
+        self.smsc = smsc
+        self.transport = None
+        self.session = None
+        self._task = None
+        self._data_waiter = None
+        self._drain_waiter = None
+        self._paused = False
+        self._eof = False
+        self._closed = None
+        self.read_high_water = read_high_water
+        self.read_low_water = read_high_water // 4
+        self.reading_paused = False
+
+    # -- asyncio.BufferedProtocol --
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._closed = asyncio.get_running_loop().create_future()
+        self.session = self.smsc.new_session(self, self)
+        # Always room for a complete PDU before reading pauses.
+        self.read_high_water = max(self.read_high_water, 2 * self.session.framer.max_pdu_size)
+        self.read_low_water = self.read_high_water // 4
+        self.smsc.sessions.add(self.session)
+        self._task = asyncio.ensure_future(self.session.handle())
+        self._task.add_done_callback(lambda _: self.smsc.sessions.discard(self.session))
+
+    def get_buffer(self, sizehint):
+        return self.session.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        framer = self.session.framer
+        framer.buffer_updated(nbytes)
+        if framer.pending > self.read_high_water and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self._wake_reader()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+        return False
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._wake_reader()
+        self.resume_writing()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _wake_reader(self):
+        if self._data_waiter is not None and not self._data_waiter.done():
+            self._data_waiter.set_result(None)
+
+    # -- reader side used by SMPPSession --
+
+    def resume_reading(self):
+        self.reading_paused = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    async def fill(self):
+        """Wait for buffer_updated(); raise IncompleteReadError at EOF"""
+        if self._eof:
+            raise asyncio.IncompleteReadError(b'', None)
+        if self.reading_paused:
+            # No complete PDU is left, so the rest of one has to be read.
+            self.resume_reading()
+        self._data_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._data_waiter
+        finally:
+            self._data_waiter = None
+
+    # -- writer side used by SMPPSession --
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        if self._paused and not self.transport.is_closing():
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            await self._drain_waiter
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self._closed
+
+
+class SubmitSMOptions:
+    """The optional TLVs of a submit_sm that the server cares about."""
+
+    __slots__ = ('message_payload', 'sar_msg_ref_num', 'sar_total_segments',
+                 'sar_segment_seqnum', 'user_message_reference')
+
+    def __init__(self):
+        self.message_payload = None
+        self.sar_msg_ref_num = None
+        self.sar_total_segments = None
+        self.sar_segment_seqnum = None
+        self.user_message_reference = None
+
+
+class SubmitSM:
+    """submit_sm parsed in place over a PDU body (bytes or memoryview).
+
+    One precompiled regex locates the mandatory fields; the integers the
+    gate needs are read eagerly, the addresses are decoded on first access,
+    and short_message and the TLV section are only sliced when asked for.
+    Like the framer's body views, an instance is only valid until the
+    session reads more data, so take what you need before awaiting.
+    """
+
+    __slots__ = ('_body', '_source', '_destination', '_source_addr', '_destination_addr',
+                 'esm_class', 'registered_delivery', 'data_coding',
+                 '_sm_start', '_sm_end', '_options')
+
+    def __init__(self, body):
+        m = _SUBMIT_SM.match(body)
+        if m is None:
+            raise ValueError('malformed submit_sm body')
+        _, self._source, self._destination = m.regs
+        end = m.end()
+        self._body = body
+        self._source_addr = None
+        self._destination_addr = None
+        self.esm_class = body[self._destination[1] + 1]
+        self.registered_delivery = body[end - 5]
+        self.data_coding = body[end - 3]
+        self._sm_start = end
+        self._sm_end = end + body[end - 1]
+        self._options = None
+
+    @property
+    def source_addr(self):
+        if self._source_addr is None:
+            start, end = self._source
+            self._source_addr = str(self._body[start:end], 'latin-1')
+        return self._source_addr
+
+    @property
+    def destination_addr(self):
+        if self._destination_addr is None:
+            start, end = self._destination
+            self._destination_addr = str(self._body[start:end], 'latin-1')
+        return self._destination_addr
+
+    @property
+    def short_message(self):
+        return bytes(self._body[self._sm_start:self._sm_end])
+
+    @property
+    def options(self):
+        """Parse the TLV section on first use"""
+        if self._options is None:
+            options = SubmitSMOptions()
+            body = self._body
+            pos, end = self._sm_end, len(body)
+            while pos + 4 <= end:
+                tag, length = TLV_HEADER.unpack_from(body, pos)
+                pos += 4
+                value = body[pos:pos + length]
+                pos += length
+                if tag == TLV_MESSAGE_PAYLOAD:
+                    options.message_payload = bytes(value)
+                elif tag == TLV_SAR_MSG_REF_NUM:
+                    options.sar_msg_ref_num = int.from_bytes(value, 'big')
+                elif tag == TLV_SAR_TOTAL_SEGMENTS:
+                    options.sar_total_segments = int.from_bytes(value, 'big')
+                elif tag == TLV_SAR_SEGMENT_SEQNUM:
+                    options.sar_segment_seqnum = int.from_bytes(value, 'big')
+                elif tag == TLV_USER_MESSAGE_REFERENCE:
+                    options.user_message_reference = int.from_bytes(value, 'big')
+            self._options = options
+        return self._options
+
+    @property
+    def message(self):
+        """message_payload when present, otherwise short_message"""
+        if self._sm_end == len(self._body):
+            return self.short_message
+        payload = self.options.message_payload
+        return payload if payload is not None else self.short_message
+
+    @property
+    def concat(self):
+        """(ref, total, seqnum) if this is one segment of a longer message, else None.
+
+        Read from a UDH concatenation element (8- or 16-bit reference) when
+        esm_class has UDHI set, otherwise from the sar_* TLVs.
+        """
+        body = self._body
+        if self.esm_class & ESM_UDHI and self._sm_start < self._sm_end:
+            pos = self._sm_start + 1
+            udh_end = min(pos + body[pos - 1], self._sm_end)
+            while pos + 2 <= udh_end:
+                iei, length = body[pos], body[pos + 1]
+                pos += 2
+                if pos + length > udh_end:
+                    break
+                if iei == UDH_CONCAT_8BIT and length == 3:
+                    return _segment(body[pos], body[pos + 1], body[pos + 2])
+                if iei == UDH_CONCAT_16BIT and length == 4:
+                    return _segment((body[pos] << 8) | body[pos + 1], body[pos + 2], body[pos + 3])
+                pos += length
+        if self._sm_end == len(body):
+            return None
+        options = self.options
+        if options.sar_msg_ref_num is None:
+            return None
+        return _segment(options.sar_msg_ref_num, options.sar_total_segments or 0,
+                        options.sar_segment_seqnum or 0)
+
+
+def _segment(ref, total, seqnum):
+    # A "set" of one, or a seqnum outside it, is treated as a plain message.
+    return (ref, total, seqnum) if total > 1 and 0 < seqnum <= total else None
+
+
+class SegmentSet:
+    """Segments of one concatenated message seen so far, and its shared gate decision."""
+
+    __slots__ = ('total', 'received', 'decided', 'created', 'requested_dlr',
+                 'session', 'source_addr', 'dest_addr', 'message_id')
+
+    def __init__(self, total, created):
+        self.total = total
+        self.received = 0           # bit n-1 set once seqnum n arrived
+        # Set by the first segment: (accept, (stat, err, message_state, delay))
+        self.decided = asyncio.get_running_loop().create_future()
+        self.created = created
+        self.requested_dlr = False
+        self.session = None
+        self.source_addr = None
+        self.dest_addr = None
+        self.message_id = None
+
+    @property
+    def complete(self):
+        return self.received == (1 << self.total) - 1
+
+
+class SegmentReassembler:
+    """Group submit_sm segments by (system_id, source, destination, ref).
+
+    The first segment of a set to arrive makes the activation lookup and
+    draws the outcome; the others wait for and reuse that decision, so a
+    long message costs one Redis lookup. With `dlr_policy='segment'` every
+    segment still gets its own receipt (carrying the shared outcome); with
+    'message' only the segment completing the set does, and a set still
+    incomplete after `timeout` seconds gets an EXPIRED (or REJECTD) receipt
+    for its last segment. At most `max_sets` incomplete sets are kept; the
+    oldest is expired first.
+    """
+
+    def __init__(self, max_sets=100000, timeout=60.0, dlr_policy='segment', clock=time.monotonic):
+        if dlr_policy not in ('segment', 'message'):
+            raise ValueError(f"unknown concatenated DLR policy {dlr_policy!r}")
+        self.max_sets = max_sets
+        self.timeout = timeout
+        self.dlr_policy = dlr_policy
+        self.clock = clock
+        self.sets = OrderedDict()   # oldest first
+        self.segments = 0
+        self.completed = 0
+        self.expired = 0
+        self.shared_decisions = 0
+
+    def segment(self, system_id, source_addr, dest_number, ref, total, seqnum):
+        """Record one segment; return (set, is_first, completes_set)."""
+        now = self.clock()
+        self.sweep(now)
+        key = (system_id, source_addr, dest_number, ref)
+        segments = self.sets.get(key)
+        first = segments is None or segments.total != total
+        if first:
+            if segments is not None:
+                # Same reference reused with another size: the old set is lost.
+                self._expire(self.sets.pop(key))
+            elif len(self.sets) >= self.max_sets:
+                self._expire(self.sets.popitem(last=False)[1])
+            segments = self.sets[key] = SegmentSet(total, now)
+        else:
+            self.shared_decisions += 1
+        self.segments += 1
+        segments.received |= 1 << (seqnum - 1)
+        complete = segments.complete
+        if complete:
+            del self.sets[key]
+            self.completed += 1
+        return segments, first, complete
+
+    def sweep(self, now=None):
+        """Expire sets older than `timeout`"""
+        if now is None:
+            now = self.clock()
+        cutoff = now - self.timeout
+        sets = self.sets
+        while sets:
+            segments = next(iter(sets.values()))
+            if segments.created > cutoff:
+                break
+            sets.popitem(last=False)
+            self._expire(segments)
+
+    def _expire(self, segments):
+        self.expired += 1
+        decided = segments.decided
+        if self.dlr_policy != 'message' or not segments.requested_dlr or not decided.done():
+            return
+        accept, _ = decided.result()
+        stat = 'EXPIRED' if accept else 'REJECTD'
+        segments.session.schedule_dlr(segments.source_addr, segments.dest_addr, segments.message_id,
+                                      stat=stat, message_state=MESSAGE_STATES[stat], delay=0)
+
+    async def run_sweeper(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def stats(self):
+        return {
+            'pending': len(self.sets),
+            'segments': self.segments,
+            'completed': self.completed,
+            'expired': self.expired,
+            'shared_decisions': self.shared_decisions,
+        }
+
+
+class DLREncoder:
+    """Encode DLR deliver_sm PDUs from cached constant byte segments.
+
+    Everything except the addresses, message id, stat/err and the receipt
+    date is fixed (empty service_type and schedule fields, TON/NPI 0,
+    esm_class 0x04), so a PDU is one bytearray sized up front with the
+    header packed in place and the variable parts copied in. The date is
+    formatted at most once per second. Output is byte-for-byte what
+    make_deliver_sm() plus a header produces.
+    """
+
+    # service_type "", source_addr_ton, source_addr_npi
+    _HEAD = b'\x00\x00\x00'
+    # source_addr NUL, dest_addr_ton, dest_addr_npi
+    _SEP = b'\x00\x00\x00'
+    # dest_addr NUL, esm_class, protocol_id, priority_flag, schedule_delivery_time,
+    # validity_period, registered_delivery, replace_if_present, data_coding, sm_default_msg_id
+    _MID = b'\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00'
+    _ID = b'id:'
+    _SUB = b' sub:001 dlvrd:001 submit date:'
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._second = None
+        self._dates = b''
+        self._tails = {}
+        self._states = {}
+
+    def _date_segment(self, now):
+        second = int(now)
+        if second != self._second:
+            date = time.strftime('%y%m%d%H%M', time.localtime(second)).encode('latin-1')
+            self._dates = date + b' done date:' + date
+            self._second = second
+        return self._dates
+
+    def _tail(self, stat, err):
+        tail = self._tails.get((stat, err))
+        if tail is None:
+            tail = f' stat:{stat} err:{err} text:'.encode('latin-1')
+            self._tails[(stat, err)] = tail
+        return tail
+
+    def _state_tlv(self, message_state):
+        tlv = self._states.get(message_state)
+        if tlv is None:
+            tlv = struct.pack('>HHB', TLV_MESSAGE_STATE, 1, message_state)
+            self._states[message_state] = tlv
+        return tlv
+
+    def encode(self, sequence, source_addr, dest_addr, message_id, stat, err='000',
+               message_state=None, now=None):
+        """Return the whole deliver_sm PDU (header included) as one bytearray"""
+        source = source_addr.encode('latin-1')
+        dest = dest_addr.encode('latin-1')
+        msg_id = message_id.encode('latin-1')
+        dates = self._date_segment(self._clock() if now is None else now)
+        tail = self._tail(stat, err)
+        tlv = self._state_tlv(message_state) if message_state is not None else b''
+        text_length = len(self._ID) + len(msg_id) + len(self._SUB) + len(dates) + len(tail)
+
+        length = 16 + 3 + len(source) + 3 + len(dest) + 10 + 1 + text_length + len(tlv)
+        pdu = bytearray(length)
+        PDU_HEADER.pack_into(pdu, 0, length, DELIVER_SM, ESME_ROK, sequence)
+        pos = 16
+        for segment in (self._HEAD, source, self._SEP, dest, self._MID):
+            end = pos + len(segment)
+            pdu[pos:end] = segment
+            pos = end
+        pdu[pos] = text_length
+        pos += 1
+        for segment in (self._ID, msg_id, self._SUB, dates, tail, tlv):
+            end = pos + len(segment)
+            pdu[pos:end] = segment
+            pos = end
+        return pdu
+
+
+DLR_ENCODER = DLREncoder()
+
+
+class MessageIdGenerator:
+    """Compact, sortable, collision-free submit_sm_resp message_ids.
+
+    An id is `[timestamp][worker][counter]`, each field fixed-width in the
+    chosen base, so ids sort by issue order as plain strings:
+
+        hex      8-digit epoch seconds, 2-digit worker, counter
+        decimal  10-digit epoch seconds, 3-digit worker, counter
+        uuid     the old random uuid4().hex[:8] (for comparison only)
+
+    The timestamp is taken when the generator starts and again whenever the
+    counter runs out of digits, never going backwards, and the worker field
+    keeps processes sharing a port apart. A worker restarted within the same
+    second as its predecessor could repeat ids; the supervisor's restart
+    backoff (>= 1s) rules that out. Issuing an id is a counter increment and
+    one format() call: no syscall, no lock.
+    """
+
+    FORMATS = {'hex': (16, 8, 2, 'x'), 'decimal': (10, 10, 3, 'd')}
+
+    def __init__(self, worker_id=0, fmt='hex', width=18, timestamp=True, clock=time.time):
+        if not 0 < width <= 64:
+            raise ValueError(f"message_id width {width} outside 1..64 (message_id is a C-Octet String(65))")
+        self.fmt = fmt
+        self.width = width
+        self.timestamp = timestamp
+        self.clock = clock
+        if fmt == 'uuid':
+            self.next = self._next_uuid
+            return
+        if fmt not in self.FORMATS:
+            raise ValueError(f"unknown message_id format {fmt!r}")
+        base, ts_digits, worker_digits, code = self.FORMATS[fmt]
+        if not 0 <= worker_id < base ** worker_digits:
+            raise ValueError(f"worker id {worker_id} does not fit {worker_digits} {fmt} digits")
+        self._ts_digits = ts_digits if timestamp else 0
+        counter_digits = width - self._ts_digits - worker_digits
+        if counter_digits < 4:
+            raise ValueError(f"message_id width {width} leaves {counter_digits} counter digits (need >= 4)")
+        self._worker = format(worker_id, f'0{worker_digits}{code}')
+        self._ts_code = f'0{ts_digits}{code}'
+        self._spec = f'0{counter_digits}{code}'
+        self._limit = base ** counter_digits
+        self._epoch = -1
+        self._prefix = ''
+        self._counter = 0
+        self._roll()
+
+    def _roll(self):
+        """Start a new counter run under a fresh, strictly later timestamp."""
+        self._counter = 0
+        if not self.timestamp:
+            # Without a timestamp the counter wraps (after base**digits ids).
+            self._prefix = self._worker
+            return
+        self._epoch = max(int(self.clock()), self._epoch + 1)
+        self._prefix = format(self._epoch, self._ts_code) + self._worker
+
+    def next(self):
+        counter = self._counter
+        if counter >= self._limit:
+            self._roll()
+            counter = 0
+        self._counter = counter + 1
+        return self._prefix + format(counter, self._spec)
+
+    def _next_uuid(self):
+        return uuid.uuid4().hex[:8]
+
+
+MESSAGE_IDS = MessageIdGenerator()
+
+
+class MessageStateIndex:
+    """Bounded message_id -> (state, error, submitted, done) index for query_sm.
+
+    Records are kept in parallel arrays used as a ring of `capacity` entries,
+    so the oldest message is forgotten first. An open-addressing table of
+    ring positions, probed linearly from hash(message_id), finds a record in
+    O(1). A record costs 8 bytes of hash, 2x8 bytes of timestamps and one
+    byte each for state and error, plus two 4-byte table slots: about 34
+    bytes per message and no Python object per message. Ids are matched by
+    their 64-bit hash only.
+
+    A hash of 0 marks a dead ring entry (an id that was submitted again).
+    """
+
+    def __init__(self, capacity=1000000):
+        if not 0 < capacity < 2 ** 31:
+            raise ValueError(f"message index capacity {capacity} outside 1..2**31-1")
+        self.capacity = capacity
+        self.hashes = array('q')
+        self.states = array('B')
+        self.errors = array('B')
+        self.submitted = array('d')
+        self.done = array('d')
+        self.position = 0   # next ring entry to write
+        self.evicted = 0
+        self._resize(1024)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _resize(self, size):
+        self.table = array('i', bytes(4 * size))    # ring position + 1, 0 = empty
+        self.mask = size - 1
+        for position, h in enumerate(self.hashes):
+            if h:
+                self._insert(h, position)
+
+    def _insert(self, h, position):
+        table, mask = self.table, self.mask
+        i = h & mask
+        while table[i]:
+            i = (i + 1) & mask
+        table[i] = position + 1
+
+    def _find(self, h):
+        """Table slot holding the record with hash `h`, or -1"""
+        table, hashes, mask = self.table, self.hashes, self.mask
+        i = h & mask
+        while True:
+            entry = table[i]
+            if not entry:
+                return -1
+            if hashes[entry - 1] == h:
+                return i
+            i = (i + 1) & mask
+
+    def _delete(self, i):
+        """Empty table slot `i`, shifting later entries of the probe run back
+        so no tombstones are needed."""
+        table, hashes, mask = self.table, self.hashes, self.mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            entry = table[j]
+            if not entry:
+                break
+            home = hashes[entry - 1] & mask
+            # The entry may fill the hole unless its home lies in (i, j].
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                table[i] = entry
+                i = j
+        table[i] = 0
+
+    def add(self, message_id, state, error, submitted, done):
+        h = hash(message_id) or 1
+        slot = self._find(h)
+        if slot >= 0:
+            # Same id again (only possible with random ids): the new record wins.
+            self.hashes[self.table[slot] - 1] = 0
+            self._delete(slot)
+        position = self.position
+        if len(self.hashes) < self.capacity:
+            if 2 * (len(self.hashes) + 1) > self.mask + 1:
+                self._resize(2 * (self.mask + 1))
+            self.hashes.append(h)
+            self.states.append(state)
+            self.errors.append(error)
+            self.submitted.append(submitted)
+            self.done.append(done)
+        else:
+            old = self.hashes[position]
+            if old:
+                self._delete(self._find(old))
+                self.evicted += 1
+            self.hashes[position] = h
+            self.states[position] = state
+            self.errors[position] = error
+            self.submitted[position] = submitted
+            self.done[position] = done
+        self._insert(h, position)
+        self.position = (position + 1) % self.capacity
+
+    def get(self, message_id):
+        """(state, error, submitted, done) for `message_id`, or None"""
+        slot = self._find(hash(message_id) or 1)
+        if slot < 0:
+            return None
+        position = self.table[slot] - 1
+        return (self.states[position], self.errors[position],
+                self.submitted[position], self.done[position])
+
+    def stats(self):
+        arrays = (self.hashes, self.states, self.errors, self.submitted, self.done, self.table)
+        return {
+            'size': len(self.hashes),
+            'evicted': self.evicted,
+            'bytes': sum(a.itemsize * len(a) for a in arrays),
+        }
+
+
+class Histogram:
+    """Fixed-bucket histogram: observe() is one bisect and three adds.
+
+    Buckets are preallocated and only touched from the event loop thread,
+    so there is no lock and no allocation per observation.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Per-bucket (non-cumulative) counts keyed by upper bound"""
+        buckets = {f'{bound:g}': count for bound, count in zip(self.bounds, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """Counters and latency histograms shared by every session of a server."""
+
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    DELAY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0,
+                     30.0, 60.0, 120.0, 300.0)
+
+    def __init__(self):
+        self.counters = Counter()
+        self.pdus = Counter()
+        self.submit_resp_latency = Histogram(self.LATENCY_BUCKETS)
+        self.redis_lookup_latency = Histogram(self.LATENCY_BUCKETS)
+        self.dlr_delay = Histogram(self.DELAY_BUCKETS)
+        self.redis_pool_wait = Histogram(self.LATENCY_BUCKETS)
+
+    def snapshot(self):
+        return {
+            'pdus': {COMMAND_NAMES.get(cmd, f'0x{cmd:08x}'): count
+                     for cmd, count in self.pdus.items()},
+            'histograms': {
+                'submit_sm_resp_latency_seconds': self.submit_resp_latency.snapshot(),
+                'redis_lookup_latency_seconds': self.redis_lookup_latency.snapshot(),
+                'dlr_delay_seconds': self.dlr_delay.snapshot(),
+                'redis_pool_wait_seconds': self.redis_pool_wait.snapshot(),
+            },
+        }
+
+
+_numpy = False     # not imported yet
+
+
+def _load_numpy():
+    """numpy, or None if it is not installed.
+
+    Imported on first use rather than at module load: it adds ~70 ms to
+    startup and only DLR profiles with non-fixed delays need it.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:  # optional: block sampling falls back to the random module
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+class DelayDistribution:
+    """DLR delays drawn from a distribution, generated in blocks.
+
+    Samples are produced `block_size` at a time (vectorized with numpy when
+    it is installed) and handed out with list.pop(), so a draw costs about
+    as much as reading a constant. Kinds and their parameters:
+
+        fixed        value
+        uniform      low, high
+        exponential  mean
+        lognormal    mu, sigma (of the underlying normal)
+        empirical    values, or file (one delay per line)
+
+    `min` / `max` clamp every sample.
+    """
+
+    # Required parameters of each kind; empirical takes values or file instead.
+    KINDS = {
+        'fixed': ('value',),
+        'uniform': ('low', 'high'),
+        'exponential': ('mean',),
+        'lognormal': ('mu', 'sigma'),
+        'empirical': (),
+    }
+
+    def __init__(self, kind='fixed', block_size=4096, seed=None, min=0.0, max=None, **params):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown delay distribution {kind!r}")
+        allowed = ('values', 'file') if kind == 'empirical' else self.KINDS[kind]
+        unknown = sorted(set(params) - set(allowed))
+        if unknown:
+            raise ValueError(f"{kind} delay distribution does not take {', '.join(unknown)} "
+                             f"(expected {', '.join(allowed)})")
+        self.kind = kind
+        self.block_size = block_size
+        self.minimum = self._number('min', min)
+        self.maximum = None if max is None else self._number('max', max)
+        if self.maximum is not None and self.maximum < self.minimum:
+            raise ValueError(f"delay max {max} is below min {min}")
+        if kind == 'empirical':
+            values = params.get('values')
+            if values is None:
+                if 'file' not in params:
+                    raise ValueError("empirical delay distribution needs values or file")
+                with open(params['file']) as f:
+                    values = [line for line in f if line.strip()]
+            if not values:
+                raise ValueError("empirical delay distribution needs at least one value")
+            params = {'values': [self._number('value', value) for value in values]}
+        else:
+            missing = [name for name in self.KINDS[kind] if name not in params]
+            if missing:
+                raise ValueError(f"{kind} delay distribution needs {', '.join(missing)}")
+            params = {name: self._number(name, value) for name, value in params.items()}
+        if kind == 'uniform' and params['low'] > params['high']:
+            raise ValueError(f"uniform delay low {params['low']:g} is above high {params['high']:g}")
+        if kind == 'exponential' and params['mean'] <= 0:
+            raise ValueError("exponential delay mean must be positive")
+        if kind == 'lognormal' and params['sigma'] < 0:
+            raise ValueError("lognormal delay sigma must not be negative")
+        self.params = params
+        self._fixed = params['value'] if kind == 'fixed' else None
+        self._rng = random.Random(seed)
+        self._numpy = _load_numpy() if self._fixed is None else None
+        self._np_rng = self._numpy.random.default_rng(seed) if self._numpy is not None else None
+        # The first block is drawn now, so a spec that cannot be sampled is
+        # refused at load (or reload) time, not on a session's first submit.
+        self._block = self._generate(block_size) if self._fixed is None else []
+
+    @staticmethod
+    def _number(name, value):
+        if isinstance(value, bool):
+            raise ValueError(f"delay {name} must be a number, not {value!r}")
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"delay {name} must be a number, not {value!r}") from None
+        if not math.isfinite(number):
+            raise ValueError(f"delay {name} must be finite, not {value!r}")
+        return number
+
+    @classmethod
+    def from_spec(cls, spec):
+        """A number (fixed delay) or a dict like {"dist": "exponential", "mean": 5}"""
+        if isinstance(spec, (int, float)):
+            return cls('fixed', value=spec)
+        spec = dict(spec)
+        return cls(spec.pop('dist', 'fixed'), **spec)
+
+    def sample(self):
+        if self._fixed is not None:
+            return self._fixed
+        if not self._block:
+            self._block = self._generate(self.block_size)
+        return self._block.pop()
+
+    def _generate(self, n):
+        p = self.params
+        if self._np_rng is not None:
+            rng = self._np_rng
+            if self.kind == 'uniform':
+                values = rng.uniform(p['low'], p['high'], n)
+            elif self.kind == 'exponential':
+                values = rng.exponential(p['mean'], n)
+            elif self.kind == 'lognormal':
+                values = rng.lognormal(p['mu'], p['sigma'], n)
+            else:
+                values = rng.choice(self._numpy.asarray(p['values']), n)
+            return self._numpy.clip(values, self.minimum, self.maximum).tolist()
+        rng = self._rng
+        if self.kind == 'uniform':
+            values = [rng.uniform(p['low'], p['high']) for _ in range(n)]
+        elif self.kind == 'exponential':
+            rate = 1.0 / p['mean']
+            values = [rng.expovariate(rate) for _ in range(n)]
+        elif self.kind == 'lognormal':
+            values = [rng.lognormvariate(p['mu'], p['sigma']) for _ in range(n)]
+        else:
+            values = rng.choices(p['values'], k=n)
+        low, high = self.minimum, self.maximum
+        if high is None:
+            return [value if value > low else low for value in values]
+        return [low if value < low else high if value > high else value for value in values]
+
+
+class OutcomeMix:
+    """Weighted DLR outcomes for accepted messages, drawn in blocks.
+
+    `weights` maps a stat, optionally with an error code ("UNDELIV:011"),
+    to its relative weight. Each draw returns (stat, err, message_state).
+    """
+
+    def __init__(self, weights, block_size=4096, seed=None):
+        self.outcomes = []
+        self.weights = []
+        for key, weight in weights.items():
+            stat, _, err = key.partition(':')
+            if stat not in MESSAGE_STATES:
+                raise ValueError(f"unknown DLR stat {stat!r}")
+            if err and not (err.isdigit() and len(err) <= 3):
+                raise ValueError(f"DLR err {err!r} is not a 3-digit code")
+            self.outcomes.append((stat, err or '000', MESSAGE_STATES[stat]))
+            self.weights.append(float(weight))
+        if not self.outcomes or sum(self.weights) <= 0:
+            raise ValueError("outcome mix needs at least one positive weight")
+        self.block_size = block_size
+        self._rng = random.Random(seed)
+        self._block = []
+
+    def sample(self):
+        if len(self.outcomes) == 1:
+            return self.outcomes[0]
+        if not self._block:
+            self._block = self._rng.choices(self.outcomes, self.weights, k=self.block_size)
+        return self._block.pop()
+
+
+class DLRProfile:
+    """Delay distribution and outcome mix applied to one class of messages."""
+
+    def __init__(self, delay, outcomes=None):
+        self.delay = delay
+        self.outcomes = outcomes or OutcomeMix({'DELIVRD': 1})
+
+    @classmethod
+    def from_spec(cls, spec, default_delay=5):
+        return cls(
+            DelayDistribution.from_spec(spec.get('delay', default_delay)),
+            OutcomeMix(spec['outcomes']) if spec.get('outcomes') else None,
+        )
+
+
+class DLRProfiles:
+    """Pick the DLR profile of a message: longest matching destination
+    prefix first, then its system_id, then the default.
+
+    Loaded from a JSON file:
+
+        {"default": {"delay": {"dist": "lognormal", "mu": 1.0, "sigma": 0.6, "max": 120},
+                     "outcomes": {"DELIVRD": 90, "UNDELIV:011": 5, "EXPIRED": 5}},
+         "system_id": {"jasmin": {"delay": 2}},
+         "prefix": {"59399": {"delay": {"dist": "exponential", "mean": 10}}}}
+
+    Rejected messages (no active activation) always get REJECTD; the
+    outcome mix applies to accepted ones.
+    """
+
+    def __init__(self, default, systems=None, prefixes=None):
+        self.default = default
+        self.systems = systems or {}
+        self.prefixes = prefixes or {}
+        self._prefix_lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+
+    @classmethod
+    def from_dict(cls, data, default_delay=5):
+        def build(spec):
+            return DLRProfile.from_spec(spec, default_delay)
+        return cls(
+            build(data.get('default', {})),
+            {system_id: build(spec) for system_id, spec in data.get('system_id', {}).items()},
+            {prefix: build(spec) for prefix, spec in data.get('prefix', {}).items()},
+        )
+
+    @classmethod
+    def load(cls, path, default_delay=5):
+        with open(path) as f:
+            return cls.from_dict(json.load(f), default_delay)
+
+    def resolve(self, system_id, number):
+        for length in self._prefix_lengths:
+            profile = self.prefixes.get(number[:length])
+            if profile is not None:
+                return profile
+        return self.systems.get(system_id, self.default)
+
+
+class RuntimeConfig:
+    """Immutable snapshot of the settings that can change without a restart.
+
+    A reload builds a new snapshot and swaps it into the shared LiveConfig
+    with one assignment on the event loop thread. A session takes
+    `live_config.current` once per submit_sm and uses that snapshot for the
+    whole message, so no lock is needed and a message never sees a mix of
+    old and new settings. Receipts already scheduled keep their due time.
+
+    The JSON config file may contain any of:
+
+        {"dlr_delay": 5,
+         "dlr_profile": "profiles.json",        (or the profile object inline)
+         "throttle": {"rate": 100, "burst": 200, "system_rate": 20,
+                      "system_burst": 40, "msgqful_pending": 50000},
+         "log_sample": 10,
+         "redis_key_prefix": "dlr:block:"}
+
+    Keys it leaves out keep their current value. A relative profile path is
+    resolved against the config file's directory.
+    """
+
+    __slots__ = ('dlr_delay', 'dlr_profile', 'profiles', 'key_prefix', 'log_sample')
+    KEYS = ('dlr_delay', 'dlr_profile', 'throttle', 'log_sample', 'redis_key_prefix')
+    THROTTLE_KEYS = ('rate', 'burst', 'system_rate', 'system_burst', 'msgqful_pending')
+
+    def __init__(self, dlr_delay=5, dlr_profile=None, profiles=None, key_prefix='dlr:block:',
+                 log_sample=1):
+        for name, value in (('dlr_delay', dlr_delay), ('dlr_profile', dlr_profile),
+                            ('profiles', profiles), ('key_prefix', key_prefix),
+                            ('log_sample', log_sample)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuntimeConfig is immutable; build a new one")
+
+    @classmethod
+    def load(cls, path, base):
+        """Read `path` over `base`; return (new snapshot, throttle changes).
+
+        Profiles are always rebuilt, so edits to the profile file itself
+        are picked up by a reload too.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"{path}: expected a JSON object")
+        unknown = sorted(set(data) - set(cls.KEYS))
+        if unknown:
+            raise ValueError(f"{path}: unknown keys {unknown} (allowed: {', '.join(cls.KEYS)})")
+        dlr_delay = float(data.get('dlr_delay', base.dlr_delay))
+        if dlr_delay < 0:
+            raise ValueError(f"{path}: dlr_delay must be >= 0")
+        dlr_profile = data.get('dlr_profile', base.dlr_profile)
+        if isinstance(dlr_profile, str) and 'dlr_profile' in data:
+            dlr_profile = os.path.join(os.path.dirname(os.path.abspath(path)), dlr_profile)
+        profiles = None
+        if isinstance(dlr_profile, dict):
+            profiles = DLRProfiles.from_dict(dlr_profile, dlr_delay)
+        elif dlr_profile:
+            profiles = DLRProfiles.load(dlr_profile, dlr_delay)
+        log_sample = int(data.get('log_sample', base.log_sample))
+        if log_sample < 1:
+            raise ValueError(f"{path}: log_sample must be >= 1")
+        key_prefix = data.get('redis_key_prefix', base.key_prefix)
+        if not isinstance(key_prefix, str) or not key_prefix:
+            raise ValueError(f"{path}: redis_key_prefix must be a non-empty string")
+        throttle = data.get('throttle', {})
+        if not isinstance(throttle, dict) or set(throttle) - set(cls.THROTTLE_KEYS):
+            raise ValueError(f"{path}: throttle takes {', '.join(cls.THROTTLE_KEYS)}")
+        try:
+            limits = SubmitThrottle.validate(**throttle)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+        throttle = {key: limits[key] for key in throttle}
+        return cls(dlr_delay, dlr_profile, profiles, key_prefix, log_sample), throttle
+
+    def describe(self):
+        return {
+            'dlr_delay': self.dlr_delay,
+            'dlr_profile': 'inline' if isinstance(self.dlr_profile, dict) else self.dlr_profile,
+            'redis_key_prefix': self.key_prefix,
+            'log_sample': self.log_sample,
+        }
+
+
+class LiveConfig:
+    """The RuntimeConfig currently in force, shared by a server's sessions."""
+
+    __slots__ = ('current',)
+
+    def __init__(self, current):
+        self.current = current
+
+
+class PendingDLR:
+    """A receipt waiting in the DLR scheduler (a few slots, no coroutine).
+
+    With `short_message` set it is an injected MO message instead: sent as a
+    plain deliver_sm from source_addr to dest_addr, windowed and retried
+    like a receipt.
+    """
+
+    __slots__ = ('session', 'source_addr', 'dest_addr', 'message_id',
+                 'stat', 'err', 'message_state', 'created', 'due', 'attempts', 'sent_at',
+                 'short_message')
+
+    def __init__(self, session, source_addr, dest_addr, message_id,
+                 stat='DELIVRD', err='000', message_state=None, short_message=None):
+        self.session = session
+        self.source_addr = source_addr
+        self.dest_addr = dest_addr
+        self.message_id = message_id
+        self.stat = stat
+        self.err = err
+        self.message_state = message_state
+        self.short_message = short_message
+        self.created = 0.0
+        self.due = 0.0
+        self.attempts = 0
+        self.sent_at = 0.0
+
+
+class DLRScheduler:
+    """Bucketed timer wheel for delivery receipts, shared by every session.
+
+    Pending receipts are grouped into buckets keyed by due tick
+    (`resolution` seconds wide). One driver task wakes once per tick, pops
+    every bucket that is due and writes its receipts grouped by session, so
+    there is no sleeping task or heap timer per message.
+    """
+
+    def __init__(self, resolution=0.1, clock=time.monotonic, delay_histogram=None):
+        self.resolution = resolution
+        self._clock = clock
+        self.delay_histogram = delay_histogram
+        self._buckets = {}
+        self._cursor = None
+        self._task = None
+        self._wakeup = None
+        self.pending = 0
+        self.fired = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def schedule(self, dlr, delay):
+        """Queue `dlr` to be written to its session after `delay` seconds."""
+        now = self._clock()
+        if not dlr.attempts:
+            # Retries keep their first schedule time for the delay histogram.
+            dlr.created = now
+        dlr.due = now + delay
+        tick = math.ceil(dlr.due / self.resolution)
+        if self._cursor is not None and tick < self._cursor:
+            tick = self._cursor
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            self._buckets[tick] = [dlr]
+        else:
+            bucket.append(dlr)
+        self.pending += 1
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        elif self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        resolution = self.resolution
+        while True:
+            if not self._buckets:
+                self._wakeup = loop.create_future()
+                await self._wakeup
+                self._wakeup = None
+                self._cursor = None
+            now = self._clock()
+            now_tick = int(now / resolution)
+            if self._cursor is None:
+                self._cursor = min(min(self._buckets), now_tick)
+            while self._cursor <= now_tick:
+                bucket = self._buckets.pop(self._cursor, None)
+                self._cursor += 1
+                if bucket:
+                    self._fire(bucket, now)
+            await asyncio.sleep(max(self._cursor * resolution - self._clock(), 0))
+
+    def _fire(self, bucket, now):
+        self.pending -= len(bucket)
+        self.fired += len(bucket)
+        by_session = {}
+        delays = self.delay_histogram
+        for dlr in bucket:
+            lag = now - dlr.due
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if delays is not None:
+                delays.observe(now - dlr.created)
+            by_session.setdefault(dlr.session, []).append(dlr)
+        self.last_lag = now - bucket[-1].due
+        for session, dlrs in by_session.items():
+            try:
+                session.send_dlrs(dlrs)
+            except Exception as e:
+                logger.error(f"[DLR ERROR] {len(dlrs)} receipts for {session.system_id}: {e}")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'fired': self.fired,
+            'last_lag': round(self.last_lag, 4),
+            'max_lag': round(self.max_lag, 4),
+        }
+
+
+class DLRStore:
+    """Receipts of closed sessions, kept per system_id for its next bind.
+
+    Due receipts whose session is gone, and deliver_sm still waiting for a
+    resp when the connection dropped, are handed to the next session that
+    binds with the same system_id instead of being dropped. In memory only;
+    RedisDLRStore also keeps every pending receipt across restarts.
+    """
+
+    def __init__(self, max_orphans=100000, max_age=3600.0, clock=time.monotonic):
+        self.max_orphans = max_orphans
+        self.max_age = max_age
+        self._clock = clock
+        self.orphans = {}
+        self.size = 0
+        self.dropped = 0
+        self.handed_over = 0
+
+    def add(self, system_id, dlr, delay):
+        """A receipt was scheduled `delay` seconds from now"""
+
+    def remove(self, system_id, dlr):
+        """A receipt was acknowledged or given up on"""
+
+    def orphan(self, system_id, dlrs):
+        """Keep receipts whose session closed until `system_id` binds again"""
+        room = self.max_orphans - self.size
+        if room < len(dlrs):
+            self.dropped += len(dlrs) - max(room, 0)
+            logger.warning(f"[DLR DROPPED] {len(dlrs) - max(room, 0)} receipts for "
+                           f"{system_id}: orphan queue full")
+            dlrs = dlrs[:max(room, 0)]
+        if dlrs:
+            self.orphans.setdefault(system_id, []).extend(dlrs)
+            self.size += len(dlrs)
+
+    async def claim(self, system_id):
+        """Return [(dlr, delay)] to (re)deliver to a session bound as `system_id`"""
+        dlrs = self.orphans.pop(system_id, [])
+        self.size -= len(dlrs)
+        self.handed_over += len(dlrs)
+        return [(dlr, 0.0) for dlr in dlrs]
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self.flush()
+
+    async def compact(self):
+        """Forget orphans older than max_age (their system_id never came back)"""
+        cutoff = self._clock() - self.max_age
+        for system_id, dlrs in list(self.orphans.items()):
+            kept = [dlr for dlr in dlrs if dlr.created >= cutoff]
+            self.dropped += len(dlrs) - len(kept)
+            self.size -= len(dlrs) - len(kept)
+            if kept:
+                self.orphans[system_id] = kept
+            else:
+                del self.orphans[system_id]
+
+    async def run_compaction(self, interval=60.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error(f"[DLR STORE] compaction failed: {e}")
+
+    def stats(self):
+        return {'orphans': self.size, 'handed_over': self.handed_over, 'dropped': self.dropped}
+
+
+class RedisDLRStore(DLRStore):
+    """DLRStore that also persists every pending receipt in Redis.
+
+    Each process writes its receipts for a system_id to the sorted set
+    `dlr:pending:{system_id}:{owner}`, scored by due time (epoch seconds),
+    where `owner` is unique per process start. Receipts are added when
+    scheduled and removed once acknowledged or expired; both are buffered
+    and written in one pipeline per `flush_interval` (or every `max_batch`
+    operations), and an add that is removed before it was flushed never
+    reaches Redis. A failed write is put back and retried.
+
+    The owner keeps `dlr:owner:{owner}` alive (TTL `lease` seconds) while
+    it runs and deletes it on a clean stop. A receiver bind takes over the
+    sets of its system_id whose owner has no lease - those of a previous
+    run, or of a worker that died - so delivery is at-least-once, but never
+    the receipts another live process (or this one) still holds.
+    """
+
+    OWNER = re.compile(r'\d+\.[0-9a-f]{8}\Z')
+
+    def __init__(self, prefix='dlr:pending:', lease_prefix='dlr:owner:', lease=30.0,
+                 flush_interval=0.05, max_batch=1000, retry_interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix
+        self.owner = f'{os.getpid()}.{uuid.uuid4().hex[:8]}'
+        self.lease_key = lease_prefix + self.owner
+        self.lease_prefix = lease_prefix
+        self.lease = lease
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        self._adds = {}
+        self._removes = {}
+        self._buffered = 0
+        self._retrying = False
+        self._flush_handle = None
+        self._flush_task = None
+        self.flushes = 0
+        self.recovered = 0
+        self.errors = 0
+
+    @staticmethod
+    def member(dlr):
+        return '\x1f'.join((dlr.message_id, dlr.source_addr, dlr.dest_addr, dlr.stat,
+                            dlr.err, '' if dlr.message_state is None else str(dlr.message_state)))
+
+    @staticmethod
+    def from_member(member, session=None):
+        message_id, source_addr, dest_addr, stat, err, state = member.split('\x1f')
+        return PendingDLR(session, source_addr, dest_addr, message_id, stat, err,
+                          int(state) if state else None)
+
+    def key(self, system_id):
+        return f'{self.prefix}{system_id}:{self.owner}'
+
+    def add(self, system_id, dlr, delay):
+        key = self.key(system_id)
+        self._adds.setdefault(key, {})[self.member(dlr)] = time.time() + delay
+        self._buffered += 1
+        self._schedule_flush()
+
+    def remove(self, system_id, dlr):
+        key = self.key(system_id)
+        member = self.member(dlr)
+        adds = self._adds.get(key)
+        if adds is not None and adds.pop(member, None) is not None:
+            return
+        self._removes.setdefault(key, set()).add(member)
+        self._buffered += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._buffered >= self.max_batch and not self._retrying:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Write the buffered adds/removes in one pipeline (put them back if it fails)"""
+        adds, removes = self._adds, self._removes
+        self._adds, self._removes, self._buffered = {}, {}, 0
+        if not any(adds.values()) and not removes:
+            return
+        pipe = rc_client.pipeline(transaction=False)
+        # Renewed with every write, so no set of ours is ever seen without a lease.
+        pipe.set(self.lease_key, 1, ex=max(int(math.ceil(self.lease)), 1))
+        for key, mapping in adds.items():
+            if mapping:
+                pipe.zadd(key, mapping)
+        for key, members in removes.items():
+            pipe.zrem(key, *members)
+        try:
+            await pipe.execute()
+            self.flushes += 1
+            self._retrying = False
+        except Exception as e:
+            self.errors += 1
+            count = sum(map(len, adds.values())) + sum(map(len, removes.values()))
+            logger.error(f"[DLR STORE] flush of {count} updates failed, retrying in "
+                         f"{self.retry_interval:g}s: {e}")
+            self._restore(adds, removes, count)
+
+    def _restore(self, adds, removes, count):
+        """Put a failed flush back in front of what was buffered since"""
+        for key, mapping in adds.items():
+            newer = self._adds.get(key)
+            if newer:
+                mapping.update(newer)
+            self._adds[key] = mapping
+        for key, members in removes.items():
+            self._removes.setdefault(key, set()).update(members)
+        self._buffered += count
+        self._retrying = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(
+            self.retry_interval, self._start_flush)
+
+    async def run_lease(self):
+        """Keep this process's lease alive so no other bind claims its receipts"""
+        while True:
+            try:
+                await rc_client.set(self.lease_key, 1, ex=max(int(math.ceil(self.lease)), 1))
+            except Exception as e:
+                logger.error(f"[DLR STORE] lease renewal failed: {e}")
+            await asyncio.sleep(self.lease / 3)
+
+    async def close(self):
+        """Flush, then give up the lease so the next run can claim what is left at once"""
+        await self.flush()
+        if self._buffered:
+            return
+        try:
+            await rc_client.delete(self.lease_key)
+        except Exception as e:
+            logger.error(f"[DLR STORE] lease release failed: {e}")
+
+    async def _unowned_keys(self, system_id):
+        """Sets of `system_id` whose owner holds no lease (plus the pre-owner key)"""
+        base = self.prefix + system_id
+        keys, owners = [], []
+        async for key in rc_client.scan_iter(match=re.sub(r'([*?\[\]\\])', r'\\\1', base) + ':*'):
+            if isinstance(key, bytes):
+                key = key.decode('latin-1')
+            owner = key[len(base) + 1:]
+            if owner != self.owner and self.OWNER.match(owner):
+                keys.append(key)
+                owners.append(owner)
+        if owners:
+            pipe = rc_client.pipeline(transaction=False)
+            for owner in owners:
+                pipe.exists(self.lease_prefix + owner)
+            alive = await pipe.execute()
+            keys = [key for key, live in zip(keys, alive) if not live]
+        keys.append(base)
+        return keys
+
+    async def claim(self, system_id):
+        claimed = await super().claim(system_id)
+        try:
+            entries = []
+            for key in await self._unowned_keys(system_id):
+                # One MULTI per set: of two binds racing for it, one gets it all.
+                pipe = rc_client.pipeline(transaction=True)
+                pipe.zrange(key, 0, -1, withscores=True)
+                pipe.delete(key)
+                taken, _ = await pipe.execute()
+                entries.extend(taken)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"[DLR STORE] recovery for {system_id} failed: {e}")
+            return claimed
+        now = time.time()
+        for member, due in entries:
+            if isinstance(member, bytes):
+                member = member.decode('latin-1')
+            dlr = self.from_member(member)
+            delay = max(due - now, 0.0)
+            # Back in a set under this process until it is acknowledged.
+            self.add(system_id, dlr, delay)
+            claimed.append((dlr, delay))
+        self.recovered += len(entries)
+        if entries:
+            logger.info(f"[DLR STORE] recovered {len(entries)} pending receipts for {system_id}")
+        return claimed
+
+    async def compact(self):
+        """Also drop persisted receipts that have been due for longer than max_age"""
+        await super().compact()
+        cutoff = time.time() - self.max_age
+        async for key in rc_client.scan_iter(match=self.prefix + '*'):
+            await rc_client.zremrangebyscore(key, '-inf', cutoff)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(flushes=self.flushes, recovered=self.recovered, errors=self.errors)
+        return stats
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`; take() is O(1)."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None, now=0.0):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1.0)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def take(self, now):
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return True
+        self.tokens = tokens
+        return False
+
+
+class SubmitThrottle:
+    """submit_sm admission: a global and a per-system_id token bucket.
+
+    check() returns the command_status for the submit_sm_resp: ESME_RTHROTTLED
+    when a bucket is empty, ESME_RMSGQFUL while the pending DLR count is at
+    `msgqful_pending`, ESME_ROK otherwise. A rate of 0 disables that bucket.
+    """
+
+    def __init__(self, rate=0.0, burst=None, system_rate=0.0, system_burst=None,
+                 msgqful_pending=0, clock=time.monotonic):
+        self._clock = clock
+        self._global = None
+        self._systems = {}
+        self.configure(rate=rate, burst=burst, system_rate=system_rate,
+                       system_burst=system_burst, msgqful_pending=msgqful_pending)
+
+    @staticmethod
+    def validate(rate=None, burst=None, system_rate=None, system_burst=None,
+                 msgqful_pending=None):
+        """Check new limits; return them as numbers, None where not given.
+
+        Raises ValueError unless each one is a non-negative number (a whole
+        one for msgqful_pending).
+        """
+        limits = {}
+        for name, value in (('rate', rate), ('burst', burst), ('system_rate', system_rate),
+                            ('system_burst', system_burst), ('msgqful_pending', msgqful_pending)):
+            if value is not None:
+                try:
+                    if isinstance(value, bool):
+                        raise ValueError
+                    number = float(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"throttle {name} must be a number, not {value!r}") from None
+                if not 0 <= number < math.inf:
+                    raise ValueError(f"throttle {name} must be a non-negative number, not {value!r}")
+                if name == 'msgqful_pending':
+                    if not number.is_integer():
+                        raise ValueError(f"throttle msgqful_pending must be a whole number, not {value!r}")
+                    number = int(number)
+                value = number
+            limits[name] = value
+        return limits
+
+    def configure(self, rate=None, burst=None, system_rate=None, system_burst=None,
+                  msgqful_pending=None):
+        """Change limits at runtime; arguments left as None keep their value.
+
+        A new rate without a burst gets one second's worth of tokens. Every
+        value is checked before any is applied, so a ValueError leaves the
+        limits unchanged.
+        """
+        limits = self.validate(rate, burst, system_rate, system_burst, msgqful_pending)
+        rate, burst = limits['rate'], limits['burst']
+        system_rate, system_burst = limits['system_rate'], limits['system_burst']
+        msgqful_pending = limits['msgqful_pending']
+        now = self._clock()
+        if rate is not None:
+            self.rate = rate
+            self._global = TokenBucket(rate, burst, now) if rate > 0 else None
+        elif burst is not None and self._global is not None:
+            self._global.burst = burst
+        if system_rate is not None:
+            self.system_rate = system_rate
+            self.system_burst = system_burst
+            self._systems.clear()
+        elif system_burst is not None:
+            self.system_burst = system_burst
+            for bucket in self._systems.values():
+                bucket.burst = system_burst
+        if msgqful_pending is not None:
+            self.msgqful_pending = msgqful_pending
+
+    def check(self, system_id, pending):
+        if self.msgqful_pending and pending >= self.msgqful_pending:
+            return ESME_RMSGQFUL
+        if self._global is None and not self.system_rate:
+            return ESME_ROK
+        now = self._clock()
+        if self.system_rate:
+            bucket = self._systems.get(system_id)
+            if bucket is None:
+                bucket = self._systems[system_id] = TokenBucket(self.system_rate, self.system_burst, now)
+            if not bucket.take(now):
+                return ESME_RTHROTTLED
+        if self._global is not None and not self._global.take(now):
+            return ESME_RTHROTTLED
+        return ESME_ROK
+
+    def config(self):
+        return {
+            'rate': self.rate,
+            'burst': self._global.burst if self._global is not None else None,
+            'system_rate': self.system_rate,
+            'system_burst': self.system_burst,
+            'msgqful_pending': self.msgqful_pending,
+        }
+
+
+# PDU capture file: CAPTURE_HEADER (magic, wall-clock epoch of t=0), then
+# records of CAPTURE_RECORD (PDU length, microseconds since t=0, session id,
+# direction) each followed by the PDU itself.
+CAPTURE_MAGIC = b'SMPPCAP\x01'
+CAPTURE_HEADER = struct.Struct('>8sd')
+CAPTURE_RECORD = struct.Struct('>IQIB')
+CAPTURE_IN = 0
+CAPTURE_OUT = 1
+
+
+class PDUCapture:
+    """Append every PDU received and sent to a compact binary capture file.
+
+    Records are buffered on the event loop and handed as one chunk per
+    `flush_interval` (or `buffer_size` bytes) to a background thread that
+    does the file I/O. Once a file reaches `max_bytes` the next chunk
+    starts `path.1`, then `path.2` and so on, each with its own header and
+    the same t=0, so records never straddle two files. See smpp_capture.py
+    for reading, indexing and replaying captures.
+
+    Existing files are never overwritten or removed: if `path` or one of
+    its continuations is there (say from the run before a restart) this
+    capture goes to `path.YYYYmmddTHHMMSS-pid` instead, with a `-N` suffix
+    if that is taken too.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, buffer_size=1024 * 1024,
+                 flush_interval=0.1, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self.started = clock()
+        self.epoch = time.time()
+        self.path = self._free_path(path, self.epoch)
+        self._buffer = []
+        self._buffered = 0
+        self._flush_handle = None
+        self._chunks = queue.SimpleQueue()
+        self._thread = None
+        self.records = 0
+        self.written = 0
+        self.files = 0
+        self.errors = 0
+
+    @staticmethod
+    def _free_path(path, epoch):
+        def taken(candidate):
+            # A leftover continuation counts too: ours would collide with it.
+            directory, name = os.path.split(candidate)
+            try:
+                names = os.listdir(directory or '.')
+            except OSError:
+                return os.path.exists(candidate)
+            prefix = name + '.'
+            return name in names or any(
+                other.startswith(prefix) and other[len(prefix):].isdigit() for other in names)
+
+        if not taken(path):
+            return path
+        base = f"{path}.{time.strftime('%Y%m%dT%H%M%S', time.localtime(epoch))}-{os.getpid()}"
+        candidate, number = base, 1
+        while taken(candidate):
+            number += 1
+            candidate = f'{base}-{number}'
+        logger.warning(f"[CAPTURE] {path} is taken, capturing to {candidate}")
+        return candidate
+
+    def record(self, session_id, direction, pdu):
+        """Buffer one PDU (bytes, header included)"""
+        self._buffer.append(CAPTURE_RECORD.pack(
+            len(pdu), int((self._clock() - self.started) * 1e6), session_id, direction))
+        self._buffer.append(pdu)
+        self._buffered += CAPTURE_RECORD.size + len(pdu)
+        self.records += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buffer:
+            self._chunks.put(b''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered = 0
+
+    def start(self):
+        import threading
+        self._thread = threading.Thread(target=self._write_chunks, name='fake-smsc-capture', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Write what is buffered and stop the writer thread"""
+        self.flush()
+        if self._thread is not None:
+            self._chunks.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _write_chunks(self):
+        f = None
+        size = 0
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is None:
+                    break
+                try:
+                    if f is None or size >= self.max_bytes:
+                        if f is not None:
+                            f.close()
+                            f = None
+                        name = self.path if not self.files else f'{self.path}.{self.files}'
+                        f = open(name, 'xb')
+                        f.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, self.epoch))
+                        size = CAPTURE_HEADER.size
+                        self.files += 1
+                    f.write(chunk)
+                    size += len(chunk)
+                    self.written += len(chunk)
+                except OSError as e:
+                    self.errors += 1
+                    logger.error(f"[CAPTURE] write to {self.path} failed, {len(chunk)} bytes lost: {e}")
+        finally:
+            if f is not None:
+                f.close()
+
+    def stats(self):
+        return {'records': self.records, 'bytes': self.written, 'files': self.files, 'errors': self.errors}
+
+
+class SessionRegistry:
+    """Bound sessions by system_id and bind type; routes receipts to receivers.
+
+    A system_id's receipts go to its receiver-capable binds (receiver and
+    transceiver, never transmitter), each batch spread over them by fewest
+    outstanding receipts (in flight + queued) so DLR throughput scales with
+    the number of receiver binds.
+    """
+
+    BIND_NAMES = {
+        BIND_TRANSMITTER: 'transmitter',
+        BIND_RECEIVER: 'receiver',
+        BIND_TRANSCEIVER: 'transceiver',
+    }
+
+    def __init__(self):
+        self.by_system_id = {}
+
+    def add(self, session):
+        binds = self.by_system_id.setdefault(session.system_id, {})
+        binds.setdefault(session.bind_type, []).append(session)
+
+    def remove(self, session):
+        binds = self.by_system_id.get(session.system_id)
+        sessions = binds.get(session.bind_type) if binds else None
+        if not sessions or session not in sessions:
+            return
+        sessions.remove(session)
+        if not sessions:
+            del binds[session.bind_type]
+            if not binds:
+                del self.by_system_id[session.system_id]
+
+    def receivers(self, system_id):
+        binds = self.by_system_id.get(system_id)
+        if not binds:
+            return []
+        return binds.get(BIND_RECEIVER, []) + binds.get(BIND_TRANSCEIVER, [])
+
+    def deliver(self, origin, dlrs):
+        """Queue `dlrs` (submitted on `origin`) on the least loaded receivers"""
+        if not self.route(origin.system_id, dlrs):
+            origin.orphan_dlrs(dlrs)
+
+    def route(self, system_id, dlrs):
+        """Queue `dlrs` on the least loaded receivers of `system_id`; False if it has none"""
+        receivers = [session for session in self.receivers(system_id)
+                     if not session.writer.is_closing()]
+        if not receivers:
+            return False
+        if len(receivers) == 1:
+            receivers[0].queue_dlrs(dlrs)
+            return True
+        load = [session.outstanding_dlrs() for session in receivers]
+        batches = [[] for _ in receivers]
+        for dlr in dlrs:
+            target = load.index(min(load))
+            batches[target].append(dlr)
+            load[target] += 1
+        for session, batch in zip(receivers, batches):
+            if batch:
+                session.queue_dlrs(batch)
+        return True
+
+    def stats(self):
+        counts = Counter()
+        for binds in self.by_system_id.values():
+            for bind_type, sessions in binds.items():
+                counts[self.BIND_NAMES[bind_type]] += len(sessions)
+        return dict(counts)
+
+
 class SMPPSession:
-    def __init__(self, reader, writer, dlr_delay=5):
+    _ids = itertools.count(1)
+
+    def __init__(self, reader, writer, dlr_delay=5, lookup=None, scheduler=None,
+                 write_high_water=65536, max_pdu_size=MAX_PDU_SIZE, metrics=None,
+                 dlr_window=64, dlr_resp_timeout=10.0, dlr_retries=3, dlr_retry_backoff=1.0,
+                 dlr_store=None, registry=None, throttle=None, profiles=None, message_ids=None,
+                 message_index=None, reassembler=None, live_config=None, capture=None,
+                 max_pending_gates=1024):
         self.reader = reader
         self.writer = writer
-        self.dlr_delay = dlr_delay
+        self.framer = PDUFramer(max_pdu_size)
+        # BufferedProtocol readers fill the framer themselves, and pause
+        # reading until the session has consumed what they buffered.
+        self._fill = getattr(reader, 'fill', None) or self._fill_from_stream
+        self._pausable = reader if hasattr(reader, 'reading_paused') else None
+        if live_config is None:
+            live_config = LiveConfig(RuntimeConfig(dlr_delay=dlr_delay, profiles=profiles))
+        self.live_config = live_config
+        self.lookup = lookup
+        self.scheduler = scheduler if scheduler is not None else DLRScheduler()
+        # Outgoing PDUs are coalesced here and handed to the transport in one
+        # write at the end of the current read batch (or at the high-water mark).
+        self.write_high_water = write_high_water
+        self._out = []
+        self._out_size = 0
+        self._flush_handle = None
+        transport = writer.transport
+        self._transport_limit = transport.get_write_buffer_limits()[1] if transport else 0
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.counters = self.metrics.counters
+        # deliver_sm sent but not yet answered, by sequence number (in send
+        # order, so the first entry is always the next one to time out), and
+        # the receipts waiting for a free slot in the window.
+        self.dlr_window = dlr_window
+        self.dlr_resp_timeout = dlr_resp_timeout
+        self.dlr_retries = dlr_retries
+        self.dlr_retry_backoff = dlr_retry_backoff
+        self.dlr_in_flight = {}
+        self.dlr_queue = deque()
+        self._dlr_timer = None
+        self.dlr_store = dlr_store
+        self.registry = registry
+        self.throttle = throttle
+        self.message_ids = message_ids if message_ids is not None else MESSAGE_IDS
+        self.message_index = message_index
+        self.reassembler = reassembler
+        self.capture = capture
+        # Gate decisions of answered submit_sm still waiting for Redis; the
+        # tail task finishes last, since each one waits for its predecessor.
+        self.max_pending_gates = max_pending_gates
+        self._gates = 0
+        self._gate_tail = None
         self.sequence_number = 0
         self.bound = False
+        self.bind_type = None
         self.system_id = None
-        
+        # Identity and per-session counts for the admin routes.
+        self.session_id = next(self._ids)
+        get_extra_info = getattr(writer, 'get_extra_info', None)
+        self.peer = get_extra_info('peername') if get_extra_info is not None else None
+        self.connected_at = time.time()
+        self.submitted = 0
+        self.dlrs_sent = 0
+        self.dlrs_acked = 0
+        self.mo_sent = 0
+
     def next_sequence(self):
         self.sequence_number += 1
         return self.sequence_number
 
+    async def _fill_from_stream(self):
+        """Bulk-read whatever the socket has into the framer"""
+        data = await self.reader.read(READ_CHUNK)
+        if not data:
+            raise asyncio.IncompleteReadError(b'', None)
+        self.framer.feed(data)
+
     async def read_pdu(self):
-        """Read PDU from socket"""
-        header = await self.reader.readexactly(16)
-        command_length, command_id, command_status, sequence_number = struct.unpack('>IIII', header)
-        
-        body = b''
-        if command_length > 16:
-            body = await self.reader.readexactly(command_length - 16)
-        
-        return {
-            'command_length': command_length,
-            'command_id': command_id,
-            'command_status': command_status,
-            'sequence_number': sequence_number,
-            'body': body
-        }
+        """Read the next complete PDU as (command_id, status, sequence, body view)"""
+        while True:
+            pdu = self.framer.next_pdu()
+            if pdu is not None:
+                pausable = self._pausable
+                if (pausable is not None and pausable.reading_paused
+                        and self.framer.pending <= pausable.read_low_water):
+                    pausable.resume_reading()
+                if self.capture is not None:
+                    cmd, status, seq, body = pdu
+                    self.capture.record(self.session_id, CAPTURE_IN,
+                                        PDU_HEADER.pack(16 + len(body), cmd, status, seq) + body)
+                return pdu
+            # End of the current read batch: send what it produced.
+            self.flush()
+            await self._fill()
 
     def write_pdu(self, command_id, sequence_number, status=ESME_ROK, body=b''):
-        """Send PDU"""
+        """Queue PDU on the session's output buffer"""
         command_length = 16 + len(body)
         header = struct.pack('>IIII', command_length, command_id, status, sequence_number)
-        self.writer.write(header + body)
+        self._out.append(header)
+        if body:
+            self._out.append(body)
+        if self.capture is not None:
+            self.capture.record(self.session_id, CAPTURE_OUT, header + body)
+        self._queued(command_length)
+
+    def write_raw(self, pdu):
+        """Queue an already encoded PDU (header included)"""
+        self._out.append(pdu)
+        if self.capture is not None:
+            self.capture.record(self.session_id, CAPTURE_OUT, bytes(pdu))
+        self._queued(len(pdu))
+
+    def _queued(self, size):
+        self._out_size += size
+        if self._out_size >= self.write_high_water:
+            self.flush()
+        elif self._flush_handle is None:
+            # Everything written before the loop gets control back (i.e. the
+            # rest of the current read batch) goes out in the same write.
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Hand buffered PDUs to the transport in one write"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._out:
+            return
+        data = b''.join(self._out)
+        self._out.clear()
+        self._out_size = 0
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def wait_writable(self):
+        """Apply backpressure only once the transport buffer is actually full"""
+        transport = self.writer.transport
+        if transport is not None and transport.get_write_buffer_size() > self._transport_limit:
+            await self.writer.drain()
 
     def parse_cstring(self, data, offset):
         """Parse C-string (null-terminated)"""
-        end = data.index(b'\x00', offset)
-        return data[offset:end].decode('latin-1'), end + 1
+        end = _NUL.search(data, offset).start()
+        return str(data[offset:end], 'latin-1'), end + 1
 
     def parse_bind(self, body):
         """Parse bind PDU"""
@@ -127,44 +2618,38 @@ class SMPPSession:
 
     def parse_submit_sm(self, body):
         """Parse submit_sm PDU"""
-        offset = 0
-        
-        service_type, offset = self.parse_cstring(body, offset)
-        source_addr_ton = body[offset]
-        source_addr_npi = body[offset + 1]
-        offset += 2
-        source_addr, offset = self.parse_cstring(body, offset)
-        
-        dest_addr_ton = body[offset]
-        dest_addr_npi = body[offset + 1]
-        offset += 2
-        destination_addr, offset = self.parse_cstring(body, offset)
-        
-        esm_class = body[offset]
-        protocol_id = body[offset + 1]
-        priority_flag = body[offset + 2]
-        offset += 3
-        
-        schedule_delivery_time, offset = self.parse_cstring(body, offset)
-        validity_period, offset = self.parse_cstring(body, offset)
-        
-        registered_delivery = body[offset]
-        replace_if_present_flag = body[offset + 1]
-        data_coding = body[offset + 2]
-        sm_default_msg_id = body[offset + 3]
-        sm_length = body[offset + 4]
-        offset += 5
-        
-        short_message = body[offset:offset + sm_length]
-        
-        return {
-            'source_addr': source_addr,
-            'destination_addr': destination_addr,
-            'short_message': short_message,
-            'registered_delivery': registered_delivery,
-            'data_coding': data_coding,
-            'esm_class': esm_class
-        }
+        return SubmitSM(body)
+
+    def draw_outcome(self, accept, dest_number, config):
+        """(stat, err, message_state, delay) of a message after the gate decision.
+
+        Drawn even when no DLR was requested, so query_sm can report it.
+        """
+        profiles = config.profiles
+        profile = profiles.resolve(self.system_id, dest_number) if profiles is not None else None
+        if not accept:
+            stat, err, message_state = 'REJECTD', '000', STATE_REJECTED
+        elif profile is not None:
+            stat, err, message_state = profile.outcomes.sample()
+        else:
+            stat, err, message_state = 'DELIVRD', '000', STATE_DELIVERED
+        return stat, err, message_state, profile.delay.sample() if profile is not None else config.dlr_delay
+
+    def query_message(self, body):
+        """Return (status, body) of the query_sm_resp for a query_sm body"""
+        message_id, _ = self.parse_cstring(body, 0)
+        record = self.message_index.get(message_id) if self.message_index is not None else None
+        if record is None:
+            self.counters['query_sm_unknown'] += 1
+            return ESME_RQUERYFAIL, b''
+        message_state, error, _, done = record
+        if done > time.time():
+            # Not final yet: no final_date, no error.
+            message_state, error, final_date = MESSAGE_STATES['ENROUTE'], 0, b''
+        else:
+            final_date = time.strftime('%y%m%d%H%M%S000+', time.gmtime(done)).encode('latin-1')
+        return ESME_ROK, (self.make_cstring(message_id) + final_date + b'\x00'
+                          + bytes((message_state, error)))
 
     def make_cstring(self, s):
         """Create C-string"""
@@ -196,66 +2681,336 @@ class SMPPSession:
             )
         return body
 
-    async def has_active_activation(self, number):
+    async def has_active_activation(self, number, config=None):
         """True if the destination number currently has an active activation.
 
         The gateway sets `dlr:block:{number}` (digits only, 20-min TTL) when it
         creates an activation. Fail-open: on any Redis error we accept (DELIVRD)
         rather than reject legit upstream traffic on an infra blip.
+
+        When the session has a shared `lookup` batcher the GET is folded into
+        a server-wide MGET; the batcher applies the same fail-open rule.
         """
-        key = f'dlr:block:{number}'
+        if config is None:
+            config = self.live_config.current
+        key = f'{config.key_prefix}{number}'
+        started = time.perf_counter()
         try:
+            if self.lookup is not None:
+                return await self.lookup.lookup(key)
             return await rc_client.get(key) is not None
         except Exception as e:
             logger.error(f"[REDIS ERROR] fail-open (DELIVRD) for {key}: {e}")
             return True
+        finally:
+            self.metrics.redis_lookup_latency.observe(time.perf_counter() - started)
+
+    def schedule_dlr(self, source_addr, dest_addr, message_id, stat='DELIVRD', err='000',
+                     message_state=None, delay=None):
+        """Queue a DLR to be sent after `delay` (default dlr_delay) seconds"""
+        if delay is None:
+            delay = self.live_config.current.dlr_delay
+        dlr = PendingDLR(self, source_addr, dest_addr, message_id, stat, err, message_state)
+        self.scheduler.schedule(dlr, delay)
+        if self.dlr_store is not None and self.system_id is not None:
+            self.dlr_store.add(self.system_id, dlr, delay)
+
+    @property
+    def can_receive(self):
+        """Receiver and transceiver binds get deliver_sm; transmitter binds do not"""
+        return self.bind_type in (BIND_RECEIVER, BIND_TRANSCEIVER)
+
+    def outstanding_dlrs(self):
+        return len(self.dlr_in_flight) + len(self.dlr_queue)
+
+    async def claim_dlrs(self):
+        """Take over receipts left for this system_id by closed sessions (or a previous run)"""
+        if self.dlr_store is None or not self.can_receive:
+            return
+        due = []
+        for dlr, delay in await self.dlr_store.claim(self.system_id):
+            dlr.session = self
+            if delay > 0:
+                self.scheduler.schedule(dlr, delay)
+            else:
+                due.append(dlr)
+        if due:
+            logger.info(f"[DLR HANDOVER] {len(due)} receipts to system_id={self.system_id}")
+            self.queue_dlrs(due)
 
-    async def send_dlr(self, source_addr, dest_addr, message_id, stat='DELIVRD', err='000', message_state=None):
-        """Send DLR after dlr_delay seconds"""
-        await asyncio.sleep(self.dlr_delay)
+    def describe(self):
+        """One session for GET /sessions"""
+        return {
+            'session': self.session_id,
+            'peer': '%s:%s' % self.peer[:2] if self.peer else None,
+            'system_id': self.system_id,
+            'bind_type': SessionRegistry.BIND_NAMES.get(self.bind_type),
+            'connected_at': round(self.connected_at, 3),
+            'submitted': self.submitted,
+            'dlrs_sent': self.dlrs_sent,
+            'dlrs_acked': self.dlrs_acked,
+            'mo_sent': self.mo_sent,
+            'dlr_in_flight': len(self.dlr_in_flight),
+            'dlr_queued': len(self.dlr_queue),
+        }
 
-        dlr_text = (
-            f"id:{message_id} "
-            f"sub:001 dlvrd:001 "
-            f"submit date:{time.strftime('%y%m%d%H%M')} "
-            f"done date:{time.strftime('%y%m%d%H%M')} "
-            f"stat:{stat} err:{err} text:"
-        )
+    def force_unbind(self, grace=2.0):
+        """Send an unbind to the ESME; close the connection if it is still open after `grace` seconds
 
-        body = self.make_deliver_sm(
-            source_addr=dest_addr,  # swap: DLR comes from recipient
-            dest_addr=source_addr,
-            short_message=dlr_text,
-            esm_class=0x04,  # DLR flag,
-            message_state=message_state
-        )
+        The session leaves the registry at once, so nothing new is routed to
+        it; receipts it still holds are re-routed when it closes.
+        """
+        if self.writer.is_closing():
+            return False
+        if self.registry is not None and self.bound:
+            self.registry.remove(self)
+        self.bound = False
+        self.write_pdu(UNBIND, self.next_sequence())
+        self.flush()
+        self.counters['forced_unbind'] += 1
+        logger.info(f"[FORCED UNBIND] system_id={self.system_id} session={self.session_id}")
+        asyncio.get_running_loop().call_later(grace, self._close_unbound)
+        return True
+
+    def _close_unbound(self):
+        if not self.writer.is_closing():
+            logger.warning(f"[FORCED UNBIND] session={self.session_id} did not unbind, closing")
+            self.writer.close()
+
+    def send_dlrs(self, dlrs):
+        """Deliver a batch of due DLRs submitted on this session (called by the scheduler)
 
+        With a registry they go to the system_id's receiver binds, which need
+        not include this session.
+        """
+        if self.registry is not None and self.system_id is not None:
+            self.registry.deliver(self, dlrs)
+        else:
+            self.queue_dlrs(dlrs)
+
+    def queue_dlrs(self, dlrs):
+        """Queue DLRs on this session and send as many as the window allows"""
+        if self.writer.is_closing():
+            # Connection dropped while the receipts were pending.
+            self.orphan_dlrs(dlrs)
+            return
+        for dlr in dlrs:
+            dlr.session = self
+        self.dlr_queue.extend(dlrs)
+        self._pump_dlrs()
+
+    def _pump_dlrs(self):
+        """Send queued DLRs while the deliver_sm window has free slots"""
+        queue, in_flight, window = self.dlr_queue, self.dlr_in_flight, self.dlr_window
+        while queue and (window <= 0 or len(in_flight) < window):
+            self.send_dlr(queue.popleft())
+
+    def send_dlr(self, dlr):
+        """Write one DLR deliver_sm now and track it until its deliver_sm_resp"""
         seq = self.next_sequence()
         try:
-            self.write_pdu(DELIVER_SM, seq, body=body)
-            await self.writer.drain()
+            if dlr.short_message is None:
+                self.write_raw(DLR_ENCODER.encode(
+                    seq,
+                    source_addr=dlr.dest_addr,  # swap: DLR comes from recipient
+                    dest_addr=dlr.source_addr,
+                    message_id=dlr.message_id,
+                    stat=dlr.stat,
+                    err=dlr.err,
+                    message_state=dlr.message_state,
+                ))
+            else:
+                # Injected MO: addressed as given, not a receipt.
+                self.write_pdu(DELIVER_SM, seq, body=self.make_deliver_sm(
+                    dlr.source_addr, dlr.dest_addr, dlr.short_message, esm_class=0))
         except Exception as e:
-            # Connection may have dropped during the dlr_delay sleep.
-            logger.warning(f"[DLR DROPPED] msg_id={message_id} stat={stat}: {e}")
+            logger.warning(f"[DLR DROPPED] msg_id={dlr.message_id} stat={dlr.stat}: {e}")
+            self.counters['dlr_dropped'] += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        dlr.sent_at = loop.time()
+        self.dlr_in_flight[seq] = dlr
+        if self._dlr_timer is None:
+            self._dlr_timer = loop.call_at(dlr.sent_at + self.dlr_resp_timeout, self._expire_dlrs)
+
+        if dlr.short_message is not None:
+            self.mo_sent += 1
+            self.counters['mo_sent'] += 1
+            if log_sampler.keep(dlr.message_id):
+                logger.info("[MO SENT] %s -> %s id=%s", dlr.source_addr, dlr.dest_addr, dlr.message_id)
+            return
+        self.dlrs_sent += 1
+        self.counters['dlr_sent'] += 1
+        self.counters['dlr_' + dlr.stat] += 1
+        if log_sampler.keep(dlr.message_id):
+            logger.info("[DLR SENT] msg_id=%s stat=%s", dlr.message_id, dlr.stat)
+
+    def dlr_acknowledged(self, sequence, status):
+        """deliver_sm_resp received: free the window slot (retry on an error status)"""
+        dlr = self.dlr_in_flight.pop(sequence, None)
+        if dlr is None:
+            logger.debug(f"[DELIVER_SM_RESP] seq={sequence} (not in flight)")
+            return
+        if status == ESME_ROK:
+            if dlr.short_message is not None:
+                self.counters['mo_acked'] += 1
+            else:
+                self.dlrs_acked += 1
+                self.counters['dlr_acked'] += 1
+                if self.dlr_store is not None and self.system_id is not None:
+                    self.dlr_store.remove(self.system_id, dlr)
+        else:
+            logger.warning(f"[DLR NACK] msg_id={dlr.message_id} status=0x{status:08x}")
+            self.counters['dlr_nacked'] += 1
+            self._retry_dlr(dlr)
+        self._pump_dlrs()
+
+    def _expire_dlrs(self):
+        """Retry every deliver_sm whose resp is overdue; re-arm for the next one"""
+        self._dlr_timer = None
+        now = asyncio.get_running_loop().time()
+        in_flight = self.dlr_in_flight
+        while in_flight:
+            sequence = next(iter(in_flight))
+            dlr = in_flight[sequence]
+            deadline = dlr.sent_at + self.dlr_resp_timeout
+            if deadline > now:
+                self._dlr_timer = asyncio.get_running_loop().call_at(deadline, self._expire_dlrs)
+                break
+            del in_flight[sequence]
+            logger.warning(f"[DLR TIMEOUT] msg_id={dlr.message_id} seq={sequence}")
+            self.counters['dlr_timeouts'] += 1
+            self._retry_dlr(dlr)
+        self._pump_dlrs()
+
+    def _retry_dlr(self, dlr):
+        dlr.attempts += 1
+        if dlr.attempts > self.dlr_retries:
+            logger.error(f"[DLR EXPIRED] msg_id={dlr.message_id} after {dlr.attempts} attempts")
+            self.counters['dlr_expired'] += 1
+            if self.dlr_store is not None and self.system_id is not None:
+                self.dlr_store.remove(self.system_id, dlr)
+            return
+        self.counters['dlr_retried'] += 1
+        # Back off exponentially; the scheduler hands it back to send_dlrs().
+        self.scheduler.schedule(dlr, self.dlr_retry_backoff * 2 ** (dlr.attempts - 1))
+
+    def _abandon_dlrs(self):
+        """Session closed: re-route what is still in flight or queued"""
+        if self._dlr_timer is not None:
+            self._dlr_timer.cancel()
+            self._dlr_timer = None
+        left = list(self.dlr_in_flight.values())
+        left.extend(self.dlr_queue)
+        self.dlr_in_flight.clear()
+        self.dlr_queue.clear()
+        if not left:
             return
+        if self.registry is not None and self.system_id is not None:
+            # Other receivers of the system_id take them, else the store does.
+            self.registry.deliver(self, left)
+        else:
+            self.orphan_dlrs(left)
+
+    def orphan_dlrs(self, dlrs):
+        """No receiver for these DLRs: keep them for the next bind, or drop them"""
+        if self.dlr_store is not None and self.system_id is not None:
+            logger.info(f"[DLR ORPHANED] {len(dlrs)} receipts kept for the next bind of {self.system_id}")
+            self.counters['dlr_orphaned'] += len(dlrs)
+            self.dlr_store.orphan(self.system_id, dlrs)
+            return
+        for dlr in dlrs:
+            logger.warning(f"[DLR DROPPED] msg_id={dlr.message_id} stat={dlr.stat}: connection closed")
+        self.counters['dlr_dropped'] += len(dlrs)
+
+    async def _settle_submit(self, previous, config, message_id, source_addr, destination_addr,
+                             dest_number, requested_dlr, segment, log_message):
+        """Gate decision, query_sm state and DLR of an answered submit_sm
 
-        logger.info(f"[DLR SENT] msg_id={message_id} stat={stat}")
+        The lookup starts at once; the outcome is applied only after the
+        previous submit's, so receipts keep the submit order of the session.
+        """
+        try:
+            segments = None
+            if segment is not None:
+                segments, first_segment, completes_set = segment
+            if segments is None:
+                accept = await self.has_active_activation(dest_number, config)
+                outcome = self.draw_outcome(accept, dest_number, config)
+            elif first_segment:
+                # One gate decision for all segments of the message.
+                decided = segments.decided
+                try:
+                    accept = await self.has_active_activation(dest_number, config)
+                except BaseException:
+                    decided.set_result((True, self.draw_outcome(True, dest_number, config)))
+                    raise
+                outcome = self.draw_outcome(accept, dest_number, config)
+                decided.set_result((accept, outcome))
+            else:
+                accept, outcome = await segments.decided
+            stat, err, message_state, delay = outcome
+            if previous is not None and not previous.done():
+                await asyncio.wait((previous,))
+
+            if accept:
+                self.counters['accepted'] += 1
+                if log_message:
+                    logger.info("[ACCEPT] dest=%s (active activation) msg_id=%s", dest_number, message_id)
+            else:
+                self.counters['rejected'] += 1
+                if log_message:
+                    logger.warning("[REJECT] dest=%s (no active activation) msg_id=%s", dest_number, message_id)
+
+            if self.message_index is not None:
+                now = time.time()
+                self.message_index.add(message_id, message_state, int(err) & 0xff, now, now + delay)
+            if segments is not None and self.reassembler.dlr_policy == 'message':
+                # One receipt per message, for the segment that completes it.
+                segments.requested_dlr |= requested_dlr
+                segments.session = self
+                segments.source_addr = source_addr
+                segments.dest_addr = destination_addr
+                segments.message_id = message_id
+                requested_dlr = completes_set and segments.requested_dlr
+            if requested_dlr:
+                self.schedule_dlr(
+                    source_addr=source_addr,
+                    dest_addr=destination_addr,
+                    message_id=message_id,
+                    stat=stat,
+                    err=err,
+                    message_state=message_state,
+                    delay=delay
+                )
+        except Exception as e:
+            logger.error(f"[ERROR] msg_id={message_id}: {e}, closing")
+            self.writer.close()
+        finally:
+            self._gates -= 1
 
     async def handle(self):
         """Main processing loop"""
         addr = self.writer.get_extra_info('peername')
         logger.info(f"[CONNECT] {addr}")
 
+        pdus = self.metrics.pdus
         try:
             while True:
-                pdu = await self.read_pdu()
-                cmd = pdu['command_id']
-                seq = pdu['sequence_number']
+                cmd, status, seq, body = await self.read_pdu()
+                pdus[cmd] += 1
                 
                 if cmd in (BIND_TRANSCEIVER, BIND_TRANSMITTER, BIND_RECEIVER):
-                    bind_data = self.parse_bind(pdu['body'])
+                    bind_data = self.parse_bind(body)
+                    if self.registry is not None and self.bound:
+                        self.registry.remove(self)
                     self.system_id = bind_data['system_id']
+                    self.bind_type = cmd
                     self.bound = True
+                    if self.registry is not None:
+                        self.registry.add(self)
+                    self.counters['bind'] += 1
                     
                     resp_cmd = {
                         BIND_TRANSCEIVER: BIND_TRANSCEIVER_RESP,
@@ -265,104 +3020,440 @@ class SMPPSession:
                     
                     body = self.make_cstring('FAKESMSC')
                     self.write_pdu(resp_cmd, seq, body=body)
-                    await self.writer.drain()
+                    await self.wait_writable()
                     
-                    logger.info(f"[BIND] system_id={self.system_id}")
+                    logger.info(f"[BIND] system_id={self.system_id} type={SessionRegistry.BIND_NAMES[cmd]}")
+                    await self.claim_dlrs()
                 
                 elif cmd == SUBMIT_SM:
-                    sm = self.parse_submit_sm(pdu['body'])
-                    message_id = uuid.uuid4().hex[:8]
-
-                    logger.info(f"[SUBMIT_SM] {sm['source_addr']} -> {sm['destination_addr']} msg_id={message_id}")
+                    received = time.perf_counter()
+                    if self.throttle is not None:
+                        status = self.throttle.check(self.system_id, self.scheduler.pending)
+                        if status != ESME_ROK:
+                            # Pushed back: no message_id, no DLR.
+                            self.counters['throttled' if status == ESME_RTHROTTLED else 'queue_full'] += 1
+                            self.write_pdu(SUBMIT_SM_RESP, seq, status=status)
+                            await self.wait_writable()
+                            continue
+                    # One snapshot for the whole message, however long it waits.
+                    config = self.live_config.current
+                    sm = self.parse_submit_sm(body)
+                    message_id = self.message_ids.next()
+                    self.submitted += 1
+                    self.counters['submit_sm'] += 1
+
+                    # The parsed PDU is a view over the read buffer; copy out
+                    # what the DLR needs before awaiting Redis.
+                    source_addr = sm.source_addr
+                    destination_addr = sm.destination_addr
+                    requested_dlr = bool(sm.registered_delivery & 0x01)
+                    concat = sm.concat if self.reassembler is not None else None
+
+                    log_message = log_sampler.keep(message_id)
+                    if log_message:
+                        logger.info("[SUBMIT_SM] %s -> %s msg_id=%s", source_addr, destination_addr, message_id)
 
                     # Always acknowledge the submit_sm itself.
                     body = self.make_cstring(message_id)
                     self.write_pdu(SUBMIT_SM_RESP, seq, body=body)
-                    await self.writer.drain()
+                    self.metrics.submit_resp_latency.observe(time.perf_counter() - received)
+                    await self.wait_writable()
 
                     # DLR gating is keyed on the DESTINATION (the number we gave
                     # for the activation), NOT the source (the external sender
                     # like "NETFLIX"). The gateway sets dlr:block:{our_number}
                     # on activation creation.
-                    dest_number = normalize_msisdn(sm['destination_addr'])
-                    accept = await self.has_active_activation(dest_number)
-                    requested_dlr = bool(sm['registered_delivery'] & 0x01)
-
-                    if accept:
-                        if requested_dlr:
-                            asyncio.create_task(self.send_dlr(
-                                source_addr=sm['source_addr'],
-                                dest_addr=sm['destination_addr'],
-                                message_id=message_id,
-                                stat='DELIVRD',
-                                message_state=STATE_DELIVERED
-                            ))
-                        logger.info(f"[ACCEPT] dest={dest_number} (active activation) msg_id={message_id}")
-                    else:
-                        if requested_dlr:
-                            asyncio.create_task(self.send_dlr(
-                                source_addr=sm['source_addr'],
-                                dest_addr=sm['destination_addr'],
-                                message_id=message_id,
-                                stat='REJECTD',
-                                message_state=STATE_REJECTED
-                            ))
-                        logger.warning(f"[REJECT] dest={dest_number} (no active activation) msg_id={message_id}")
+                    dest_number = normalize_msisdn(destination_addr)
+                    segment = None
+                    if concat is not None:
+                        segment = self.reassembler.segment(
+                            self.system_id, source_addr, dest_number, *concat)
+                    # The decision is settled off the read loop, so the next
+                    # PDUs are read (and their lookups batched) meanwhile.
+                    if self._gates >= self.max_pending_gates:
+                        await asyncio.wait((self._gate_tail,))
+                    self._gates += 1
+                    self._gate_tail = asyncio.ensure_future(self._settle_submit(
+                        self._gate_tail, config, message_id, source_addr, destination_addr,
+                        dest_number, requested_dlr, segment, log_message))
+
+                elif cmd == QUERY_SM:
+                    self.counters['query_sm'] += 1
+                    self.write_pdu(QUERY_SM_RESP, seq, *self.query_message(body))
+                    await self.wait_writable()
 
 
                 elif cmd == ENQUIRE_LINK:
                     self.write_pdu(ENQUIRE_LINK_RESP, seq)
-                    await self.writer.drain()
+                    await self.wait_writable()
                     logger.debug("[ENQUIRE_LINK]")
                 
                 elif cmd == UNBIND:
                     self.write_pdu(UNBIND_RESP, seq)
-                    await self.writer.drain()
+                    await self.wait_writable()
                     logger.info("[UNBIND]")
                     break
+
+                elif cmd == UNBIND_RESP:
+                    # The ESME accepted a forced unbind.
+                    logger.info(f"[UNBIND_RESP] system_id={self.system_id}")
+                    break
                 
                 elif cmd == DELIVER_SM_RESP:
                     # Jasmin acknowledged DLR receipt
-                    logger.debug(f"[DELIVER_SM_RESP] seq={seq}")
+                    self.dlr_acknowledged(seq, status)
                 
                 else:
                     logger.warning(f"[UNKNOWN CMD] {hex(cmd)}")
+                    self.counters['generic_nack'] += 1
                     self.write_pdu(GENERIC_NACK, seq)
-                    await self.writer.drain()
+                    await self.wait_writable()
                     
         except asyncio.IncompleteReadError:
             logger.info(f"[DISCONNECT] {addr}")
+        except PDUFramingError as e:
+            logger.error(f"[FRAMING ERROR] {addr}: {e} (max {self.framer.max_pdu_size}), closing")
+            self.write_pdu(GENERIC_NACK, e.sequence_number, status=ESME_RINVCMDLEN)
         except Exception as e:
             logger.error(f"[ERROR] {e}")
         finally:
+            if self._gate_tail is not None and not self._gate_tail.done():
+                # Receipts of submits answered before the unbind are still due.
+                await asyncio.wait((self._gate_tail,))
+            if self.registry is not None and self.bound:
+                self.registry.remove(self)
+            self._abandon_dlrs()
+            self.flush()
             self.writer.close()
             await self.writer.wait_closed()
 
 
+def parse_injection(body):
+    """Parse a POST /inject body into [(system_id, PendingDLR)].
+
+    The body is one JSON object, a JSON list of them, or NDJSON (one per
+    line). Every object names the `system_id` to deliver to and has
+    `source_addr` and `dest_addr`. A receipt ("type": "dlr", the default)
+    takes the addresses of the original submit_sm plus `message_id` and
+    optional `stat`/`err`; an MO message ("type": "mo", or any object with
+    `short_message`) is sent from source_addr to dest_addr as given.
+    Raises ValueError naming the first bad item.
+    """
+    text = body.decode('utf-8') if isinstance(body, (bytes, bytearray)) else body
+    text = text.strip()
+    if not text:
+        raise ValueError("empty body")
+    try:
+        items = json.loads(text)
+    except ValueError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(items, dict):
+        items = [items]
+    elif not isinstance(items, list):
+        raise ValueError("body must be a JSON object, a list of them or NDJSON")
+    parsed = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            raise ValueError(f"item {number}: not a JSON object")
+        kind = item.get('type') or ('mo' if 'short_message' in item else 'dlr')
+        required = ('system_id', 'source_addr', 'dest_addr') + (
+            ('message_id',) if kind == 'dlr' else ('short_message',))
+        missing = [field for field in required if not item.get(field)]
+        if kind not in ('dlr', 'mo'):
+            raise ValueError(f"item {number}: type must be 'dlr' or 'mo', got {kind!r}")
+        if missing:
+            raise ValueError(f"item {number}: missing {', '.join(missing)}")
+        if kind == 'mo':
+            short_message = str(item['short_message']).encode('latin-1')
+            if len(short_message) > 254:
+                raise ValueError(f"item {number}: short_message is over 254 bytes")
+            dlr = PendingDLR(None, str(item['source_addr']), str(item['dest_addr']),
+                             item.get('message_id'), short_message=short_message)
+        else:
+            stat = item.get('stat', 'DELIVRD')
+            err = str(item.get('err', '000'))
+            if stat not in MESSAGE_STATES:
+                raise ValueError(f"item {number}: unknown DLR stat {stat!r}")
+            if not (err.isdigit() and len(err) <= 3):
+                raise ValueError(f"item {number}: DLR err {err!r} is not a 3-digit code")
+            dlr = PendingDLR(None, str(item['source_addr']), str(item['dest_addr']),
+                             str(item['message_id']), stat, err.zfill(3), MESSAGE_STATES[stat])
+        parsed.append((str(item['system_id']), dlr))
+    return parsed
+
+
 class FakeSMSC:
-    def __init__(self, host='0.0.0.0', port=2776, dlr_delay=5):
+    def __init__(self, host='0.0.0.0', port=2776, dlr_delay=5,
+                 redis_batch_window=0.001, redis_batch_size=256,
+                 cache_size=100000, cache_negative_ttl=1.0, dlr_resolution=0.1,
+                 write_high_water=65536, max_pdu_size=MAX_PDU_SIZE, transport='stream',
+                 reuse_port=False, summary_interval=0, metrics_host=None, metrics_port=None,
+                 dlr_window=64, dlr_resp_timeout=10.0, dlr_retries=3, dlr_retry_backoff=1.0,
+                 dlr_store='memory', dlr_store_max_age=3600.0,
+                 throttle_rate=0.0, throttle_burst=None, system_throttle_rate=0.0,
+                 system_throttle_burst=None, msgqful_pending=0, dlr_profile=None,
+                 redis_breaker_threshold=5, redis_probe_interval=1.0, cache_tracking=False,
+                 worker_id=0, message_id_format='hex', message_id_width=18,
+                 message_id_timestamp=True, query_index_size=1000000,
+                 concat_max_sets=100000, concat_timeout=60.0, concat_dlr='segment',
+                 config_path=None, throttle_share=1.0, admin_host='127.0.0.1', admin_port=None,
+                 capture_path=None, capture_max_bytes=256 * 1024 * 1024):
         self.host = host
         self.port = port
-        self.dlr_delay = dlr_delay
+        self.reuse_port = reuse_port
+        self.write_high_water = write_high_water
+        self.max_pdu_size = max_pdu_size
+        self.transport = transport
+        self.dlr_window = dlr_window
+        self.dlr_resp_timeout = dlr_resp_timeout
+        self.dlr_retries = dlr_retries
+        self.dlr_retry_backoff = dlr_retry_backoff
+        self.metrics = Metrics()
+        self.scheduler = DLRScheduler(resolution=dlr_resolution,
+                                      delay_histogram=self.metrics.dlr_delay)
+        if dlr_store == 'redis':
+            self.dlr_store = RedisDLRStore(max_age=dlr_store_max_age)
+        elif dlr_store == 'memory':
+            self.dlr_store = DLRStore(max_age=dlr_store_max_age)
+        else:
+            self.dlr_store = None
+        self._store_tasks = []
+        self.cache = None
+        self.cache_tracking = cache_tracking
+        if cache_size > 0:
+            self.cache = ActivationCache(max_size=cache_size, negative_ttl=cache_negative_ttl)
+        self.breaker = RedisCircuitBreaker(threshold=redis_breaker_threshold,
+                                           probe_interval=redis_probe_interval)
+        self.lookup = ActivationLookupBatcher(
+            window=redis_batch_window,
+            max_batch=redis_batch_size,
+            cache=self.cache,
+            breaker=self.breaker,
+        )
+        self.counters = self.metrics.counters
+        self.sessions = set()
+        self.registry = SessionRegistry()
+        # Profiles are loaded here rather than passed in so every worker
+        # seeds its own RNGs.
+        self.live_config = LiveConfig(RuntimeConfig(
+            dlr_delay=dlr_delay,
+            dlr_profile=dlr_profile,
+            profiles=DLRProfiles.load(dlr_profile, dlr_delay) if dlr_profile else None,
+            log_sample=log_sampler.every,
+        ))
+        self.throttle = SubmitThrottle(
+            rate=throttle_rate, burst=throttle_burst,
+            system_rate=system_throttle_rate, system_burst=system_throttle_burst,
+            msgqful_pending=msgqful_pending,
+        )
+        # Rates in the config file are for the whole server; with --workers N
+        # each process enforces its share.
+        self.throttle_share = throttle_share
+        self.config_path = config_path
+        self.message_ids = MessageIdGenerator(worker_id=worker_id, fmt=message_id_format,
+                                              width=message_id_width, timestamp=message_id_timestamp)
+        self.message_index = MessageStateIndex(query_index_size) if query_index_size > 0 else None
+        self.reassembler = None
+        if concat_max_sets > 0:
+            self.reassembler = SegmentReassembler(max_sets=concat_max_sets, timeout=concat_timeout,
+                                                  dlr_policy=concat_dlr)
+        self._concat_sweeper = None
+        self.capture = PDUCapture(capture_path, max_bytes=capture_max_bytes) if capture_path else None
+        self.summary_interval = summary_interval
+        self.metrics_host = metrics_host or host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.admin_host = admin_host
+        self.admin_port = admin_port
+        self.admin_server = None
+        self._injections = set()
         self.server = None
         self._shutdown_event = None
+        self._cache_watch = None
+        self._summary_task = None
+        if config_path is not None:
+            self._apply_config(*RuntimeConfig.load(config_path, self.live_config.current))
     
+    def new_session(self, reader, writer):
+        return SMPPSession(reader, writer,
+                           lookup=self.lookup, scheduler=self.scheduler,
+                           write_high_water=self.write_high_water,
+                           max_pdu_size=self.max_pdu_size,
+                           metrics=self.metrics,
+                           dlr_window=self.dlr_window,
+                           dlr_resp_timeout=self.dlr_resp_timeout,
+                           dlr_retries=self.dlr_retries,
+                           dlr_retry_backoff=self.dlr_retry_backoff,
+                           dlr_store=self.dlr_store,
+                           registry=self.registry,
+                           throttle=self.throttle,
+                           live_config=self.live_config,
+                           message_ids=self.message_ids,
+                           message_index=self.message_index,
+                           reassembler=self.reassembler,
+                           capture=self.capture)
+
     async def handle_client(self, reader, writer):
-        session = SMPPSession(reader, writer, self.dlr_delay)
-        await session.handle()
+        session = self.new_session(reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.handle()
+        finally:
+            self.sessions.discard(session)
+
+    def stats(self, histograms=False):
+        stats = {
+            'sessions': len(self.sessions),
+            'bound_sessions': sum(1 for session in self.sessions if session.bound),
+            'binds': self.registry.stats(),
+            'dlr_in_flight': sum(len(session.dlr_in_flight) for session in self.sessions),
+            'dlr_queued': sum(len(session.dlr_queue) for session in self.sessions),
+            'counters': dict(self.counters),
+            'dlr_scheduler': self.scheduler.stats(),
+            'redis_batches': self.lookup.batches,
+            'redis_lookups': self.lookup.lookups,
+            'redis_circuit': self.breaker.stats(),
+        }
+        if self.cache is not None:
+            stats['activation_cache'] = self.cache.stats()
+        if self.dlr_store is not None:
+            stats['dlr_store'] = self.dlr_store.stats()
+        if self.message_index is not None:
+            stats['message_index'] = self.message_index.stats()
+        if self.reassembler is not None:
+            stats['concat'] = self.reassembler.stats()
+        if self.capture is not None:
+            stats['capture'] = self.capture.stats()
+        if histograms:
+            stats.update(self.metrics.snapshot())
+        return stats
     
+    async def log_summaries(self):
+        """Log one line of per-counter deltas every summary_interval seconds"""
+        previous = Counter()
+        while True:
+            await asyncio.sleep(self.summary_interval)
+            current = Counter(self.counters)
+            delta = current - previous
+            previous = current
+            rate = delta['submit_sm'] / self.summary_interval
+            counts = ' '.join(f"{key}={delta[key]}" for key in sorted(delta))
+            logger.info(
+                f"[SUMMARY] last {self.summary_interval:g}s: {counts or 'idle'} "
+                f"submit_rate={rate:.1f}/s pending_dlrs={self.scheduler.pending} "
+                f"sessions={len(self.sessions)}"
+            )
+
     async def run(self):
         # Create shutdown event in the current event loop
         self._shutdown_event = asyncio.Event()
 
-        self.server = await asyncio.start_server(
-            self.handle_client,
-            self.host,
-            self.port
-        )
+        if self.transport == 'buffered':
+            self.server = await asyncio.get_running_loop().create_server(
+                lambda: SMPPBufferedProtocol(self),
+                self.host,
+                self.port,
+                reuse_port=self.reuse_port or None
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_client,
+                self.host,
+                self.port,
+                reuse_port=self.reuse_port or None
+            )
 
-        logger.info(f"Fake SMSC listening on {self.host}:{self.port}")
-        logger.info(f"DLR delay: {self.dlr_delay} seconds")
+        loop_name = type(asyncio.get_running_loop()).__module__.split('.')[0]
+        logger.info(f"Fake SMSC listening on {self.host}:{self.port} (event loop: {loop_name})")
+        logger.info(f"Transport: {self.transport} (max PDU {self.max_pdu_size} bytes)")
+        config = self.live_config.current
+        logger.info(f"DLR delay: {config.dlr_delay} seconds (scheduler tick {self.scheduler.resolution * 1000:g}ms)")
+        self._log_profiles(config)
+        if self.config_path is not None:
+            logger.info(f"Config: {self.config_path} (reload with SIGHUP or POST /reload) {config.describe()}")
+        logger.info(
+            f"Message ids: {self.message_ids.fmt}"
+            f"{'' if self.message_ids.fmt == 'uuid' else f' width={self.message_ids.width}'}"
+            f"{' (timestamped)' if self.message_ids.timestamp and self.message_ids.fmt != 'uuid' else ''}"
+        )
+        if self.message_index is not None:
+            logger.info(f"query_sm index: last {self.message_index.capacity} messages")
+        if self.reassembler is not None:
+            logger.info(
+                f"Concatenated messages: one gate decision per message, DLR per "
+                f"{self.reassembler.dlr_policy}, incomplete sets expire after "
+                f"{self.reassembler.timeout:g}s (max {self.reassembler.max_sets})"
+            )
+            self._concat_sweeper = asyncio.create_task(self.reassembler.run_sweeper())
+        if self.capture is not None:
+            self.capture.start()
+            logger.info(
+                f"Capturing every PDU to {self.capture.path} "
+                f"(new file every {self.capture.max_bytes / 1048576:g} MB)"
+            )
+        logger.info(
+            f"DLR window: {self.dlr_window or 'unlimited'} per session, "
+            f"resp timeout {self.dlr_resp_timeout:g}s, {self.dlr_retries} retries "
+            f"(backoff from {self.dlr_retry_backoff:g}s)"
+        )
+        logger.info(
+            f"Redis lookup batching: window={self.lookup.window * 1000:g}ms "
+            f"max_batch={self.lookup.max_batch}"
+        )
+        pool = getattr(rc_client, 'connection_pool', None)
+        if isinstance(pool, TimedConnectionPool):
+            pool.wait_histogram = self.metrics.redis_pool_wait
+            logger.info(
+                f"Redis pool: max_connections={pool.max_connections} "
+                f"timeout={pool.timeout:g}s protocol={pool.connection_kwargs.get('protocol', 2)}"
+            )
+        if self.breaker.threshold:
+            logger.info(
+                f"Redis circuit breaker: open after {self.breaker.threshold} consecutive errors, "
+                f"probe every {self.breaker.probe_interval:g}s"
+            )
+        if self.throttle.rate or self.throttle.system_rate or self.throttle.msgqful_pending:
+            logger.info(f"Throttle: {self.throttle.config()}")
+        if self.cache is not None:
+            logger.info(
+                f"Activation cache: max_size={self.cache.max_size} "
+                f"negative_ttl={self.cache.negative_ttl:g}s"
+                f"{' (CLIENT TRACKING invalidation)' if self.cache_tracking else ''}"
+            )
+            self._start_cache_watch()
+        if self.dlr_store is not None:
+            logger.info(f"DLR store: {type(self.dlr_store).__name__} (max age {self.dlr_store.max_age:g}s)")
+            self._store_tasks = [asyncio.create_task(self.dlr_store.run_compaction())]
+            if isinstance(self.dlr_store, RedisDLRStore):
+                self._store_tasks.append(asyncio.create_task(self.dlr_store.run_lease()))
+        if self.summary_interval:
+            self._summary_task = asyncio.create_task(self.log_summaries())
+        loop = asyncio.get_running_loop()
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(
+                self.metrics_host, self.metrics_port,
+                lambda: call_in_loop(loop, self.stats, True),
+                dlr_delay=config.dlr_delay,
+            )
+            self._add_read_routes(self.metrics_server, loop)
+            self.metrics_server.start()
+            logger.info(f"Metrics: http://{self.metrics_host}:{self.metrics_server.port}/metrics")
+        if self.admin_port is not None:
+            # Unauthenticated and mutating: its own listener, on loopback
+            # unless --admin-host says otherwise.
+            self.admin_server = MetricsServer(self.admin_host, self.admin_port, name='fake-smsc-admin')
+            routes = self.admin_server.routes
+            self._add_read_routes(self.admin_server, loop)
+            routes[('POST', '/throttle')] = lambda body, query: self._throttle_route(loop, body)
+            routes[('POST', '/reload')] = lambda body, query: self._reload_route(loop)
+            routes[('GET', '/sessions')] = (
+                lambda body, query: (200, 'application/json',
+                                     json.dumps(call_in_loop(loop, self.describe_sessions)).encode()))
+            routes[('POST', '/sessions/unbind')] = lambda body, query: self._unbind_route(loop, body)
+            routes[('POST', '/inject')] = lambda body, query: self._inject_route(loop, body, query)
+            self.admin_server.start()
+            logger.info(f"Admin: http://{self.admin_host}:{self.admin_server.port} "
+                        f"(POST /throttle, /reload, /sessions/unbind, /inject; GET /sessions)")
         
         # Set up signal handlers for graceful shutdown (Unix only)
         if sys.platform != 'win32':
@@ -370,6 +3461,7 @@ class FakeSMSC:
                 loop = asyncio.get_event_loop()
                 for sig in (signal.SIGTERM, signal.SIGINT):
                     loop.add_signal_handler(sig, self._signal_handler)
+                loop.add_signal_handler(signal.SIGHUP, self._reload_signal)
             except (NotImplementedError, ValueError):
                 # Signal handlers not available on this platform
                 pass
@@ -381,1045 +3473,908 @@ class FakeSMSC:
             logger.info("Server cancelled, shutting down...")
         finally:
             logger.info("Shutting down server...")
+            if self._cache_watch is not None:
+                self._cache_watch.cancel()
+            if self._summary_task is not None:
+                self._summary_task.cancel()
+            if self._concat_sweeper is not None:
+                self._concat_sweeper.cancel()
+            for task in self._injections:
+                task.cancel()
+            self.breaker.close()
+            self.scheduler.close()
+            if self.dlr_store is not None:
+                for task in self._store_tasks:
+                    task.cancel()
+                # Pending receipts already scheduled stay in Redis for the next run.
+                await self.dlr_store.close()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            if self.admin_server is not None:
+                self.admin_server.stop()
+            logger.info(f"Stats: {self.stats()}")
             if self.server:
                 self.server.close()
                 await self.server.wait_closed()
+            if self.capture is not None:
+                self.capture.close()
+                logger.info(f"[CAPTURE] {self.capture.stats()}")
             logger.info("Server stopped.")
     
-    def _signal_handler(self):
-        """Handle shutdown signals."""
-        logger.info("Received shutdown signal, shutting down gracefully...")
-        if self._shutdown_event:
-            self._shutdown_event.set()
-
-
-if __name__ == '__main__':
-    import argparse
-
-    #
-    # smpplib -- SMPP Library for Python
-    # Copyright (c) 2005 Martynas Jocius <mjoc@akl.lt>
-    #
-    # This library is free software; you can redistribute it and/or
-    # modify it under the terms of the GNU Lesser General Public
-    # License as published by the Free Software Foundation; either
-    # version 2.1 of the License, or (at your option) any later version.
-    #
-    # This library is distributed in the hope that it will be useful,
-    # but WITHOUT ANY WARRANTY; without even the implied warranty of
-    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
-    # Lesser General Public License for more details.
-    #
-    # You should have received a copy of the GNU Lesser General Public
-    # License along with this library; if not, write to the Free Software
-    # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
-
-    """SMPP Commands module"""
-
-    import logging
-    import struct
-
-    import six
-
-    try:
-        from smpplib import consts, exceptions, pdu
-        from smpplib.ptypes import flag, ostr
-    except ImportError:
-        # smpplib not installed - this embedded code is not used by the main SMSC server
-        # Define minimal stubs to prevent errors
-        class consts:
-            SMPP_ESME_ROK = 0x00000000
-            EMPTY_STRING = ''
-            NULL_STRING = b'\x00'
-            OPTIONAL_PARAMS = {}
-            INT_PACK_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
-        
-        class exceptions:
-            class UnknownCommandError(Exception):
-                pass
-        
-        class pdu:
-            class PDU:
-                pass
-        
-        class flag:
-            pass
-        
-        class ostr:
-            pass
-
-    logger = logging.getLogger('smpplib.command')
+    def _throttle_route(self, loop, body):
+        """GET /throttle (metrics or admin listener) shows the limits, POST (admin only) changes them"""
+        if body:
+            try:
+                changes = json.loads(body)
+                call_in_loop(loop, lambda: self.throttle.configure(**changes))
+            except (ValueError, TypeError) as e:
+                return 400, 'text/plain', f'{e}\n'.encode()
+            logger.info(f"[THROTTLE] reconfigured: {changes}")
+        config = call_in_loop(loop, self.throttle.config)
+        return 200, 'application/json', json.dumps(config).encode()
+
+    def _log_profiles(self, config):
+        profiles = config.profiles
+        if profiles is not None:
+            logger.info(
+                f"DLR profiles: {config.describe()['dlr_profile']} ({len(profiles.systems)} system_id, "
+                f"{len(profiles.prefixes)} prefix rules, sampling with "
+                f"{'numpy' if _numpy else 'random'})"
+            )
 
+    def _start_cache_watch(self):
+        if self._cache_watch is not None:
+            self._cache_watch.cancel()
+        pattern = self.live_config.current.key_prefix + '*'
+        self._cache_watch = asyncio.create_task(self.cache.watch(pattern, tracking=self.cache_tracking))
+
+    def _apply_config(self, config, throttle):
+        previous = self.live_config.current
+        self.live_config.current = config
+        log_sampler.every = config.log_sample
+        if throttle:
+            share = self.throttle_share
+            self.throttle.configure(**{
+                key: value * share if value is not None and key != 'msgqful_pending' else value
+                for key, value in throttle.items()
+            })
+        if config.key_prefix != previous.key_prefix and self.cache is not None:
+            # Cached entries and the invalidation subscription are per prefix.
+            self.cache.clear()
+            if self._cache_watch is not None:
+                self._start_cache_watch()
+        if self.metrics_server is not None:
+            self.metrics_server.dlr_delay = config.dlr_delay
+
+    def reload(self):
+        """Re-read the config file and switch to it; return the new settings.
+
+        Bound sessions and receipts already scheduled are left alone. On an
+        error the running configuration stays in force and the error is raised.
+        """
+        if self.config_path is None:
+            raise ValueError("no config file to reload (start with --config)")
+        previous = self.live_config.current.describe()
+        self._apply_config(*RuntimeConfig.load(self.config_path, self.live_config.current))
+        current = self.describe_config()
+        changes = {key: value for key, value in current.items() if previous.get(key) != value}
+        logger.info(f"[RELOAD] {self.config_path}: {changes or 'no changes'}")
+        self._log_profiles(self.live_config.current)
+        return current
+
+    def describe_config(self):
+        config = self.live_config.current.describe()
+        config['throttle'] = self.throttle.config()
+        return config
+
+    def _reload_signal(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error(f"[RELOAD] failed, keeping the running configuration: {e}")
 
-    def factory(command_name, **kwargs):
-        """Return instance of a specific command class"""
+    def _add_read_routes(self, server, loop):
+        """GET /throttle and GET /config, served by the metrics and the admin listener"""
+        server.routes[('GET', '/throttle')] = lambda body, query: self._throttle_route(loop, None)
+        server.routes[('GET', '/config')] = (
+            lambda body, query: (200, 'application/json', json.dumps(call_in_loop(loop, self.describe_config)).encode()))
 
+    def _reload_route(self, loop):
+        """POST /reload on the admin listener"""
         try:
-            return {
-                'bind_transmitter': BindTransmitter,
-                'bind_transmitter_resp': BindTransmitterResp,
-                'bind_receiver': BindReceiver,
-                'bind_receiver_resp': BindReceiverResp,
-                'bind_transceiver': BindTransceiver,
-                'bind_transceiver_resp': BindTransceiverResp,
-                'data_sm': DataSM,
-                'data_sm_resp': DataSMResp,
-                'generic_nack': GenericNAck,
-                'submit_sm': SubmitSM,
-                'submit_sm_resp': SubmitSMResp,
-                'deliver_sm': DeliverSM,
-                'deliver_sm_resp': DeliverSMResp,
-                'query_sm': QuerySM,
-                'query_sm_resp': QuerySMResp,
-                'unbind': Unbind,
-                'unbind_resp': UnbindResp,
-                'enquire_link': EnquireLink,
-                'enquire_link_resp': EnquireLinkResp,
-                'alert_notification': AlertNotification,
-            }[command_name](command_name, **kwargs)
-        except KeyError:
-            raise exceptions.UnknownCommandError('Command "%s" is not supported' % command_name)
-
-
-    def get_optional_name(code):
-        """Return optional_params name by given code. If code is unknown, raise
-        UnkownCommandError exception"""
-
-        for key, value in six.iteritems(consts.OPTIONAL_PARAMS):
-            if value == code:
-                return key
-
-        raise exceptions.UnknownCommandError('Unknown SMPP command code "0x%x"' % code)
-
-
-    def get_optional_code(name):
-        """Return optional_params code by given command name. If name is unknown,
-        raise UnknownCommandError exception"""
+            config = call_in_loop(loop, self.reload)
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.error(f"[RELOAD] failed, keeping the running configuration: {e}")
+            return 400, 'text/plain', f'{e}\n'.encode()
+        return 200, 'application/json', json.dumps(config).encode()
+
+    def describe_sessions(self):
+        """Every connection, bound or not, with its counters"""
+        return sorted((session.describe() for session in self.sessions), key=lambda s: s['session'])
+
+    def unbind_sessions(self, session=None, system_id=None, grace=2.0):
+        """Force-unbind session id `session`, or every bind of `system_id`; return how many"""
+        if session is None and system_id is None:
+            raise ValueError("give a session id or a system_id")
+        targets = [s for s in self.sessions if s.session_id == session
+                   or (s.bound and system_id is not None and s.system_id == system_id)]
+        return sum(1 for target in targets if target.force_unbind(grace))
+
+    def inject(self, items, rate=0.0):
+        """Send parsed (system_id, PendingDLR) items to their receivers, `rate` per second
+
+        A rate of 0 hands them all over at once. Either way they go through
+        each receiver's deliver_sm window like scheduled receipts; items for a
+        system_id with no receiver bound are kept in the DLR store for its
+        next bind (or dropped without one). Returns the number accepted.
+        """
+        for _, dlr in items:
+            if dlr.message_id is None:
+                dlr.message_id = self.message_ids.next()
+        self.counters['injected'] += len(items)
+        task = asyncio.ensure_future(self._run_injection(deque(items), rate))
+        self._injections.add(task)
+        task.add_done_callback(self._injections.discard)
+        logger.info(f"[INJECT] {len(items)} deliver_sm at {f'{rate:g}/s' if rate else 'full speed'}")
+        return len(items)
+
+    async def _run_injection(self, items, rate, tick=0.01):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        released = 0
+        while items:
+            if rate > 0:
+                count = int((loop.time() - started) * rate) + 1 - released
+            else:
+                count = len(items)
+            batches = {}
+            now = time.monotonic()
+            for _ in range(min(count, len(items))):
+                system_id, dlr = items.popleft()
+                dlr.created = now
+                batches.setdefault(system_id, []).append(dlr)
+                released += 1
+            for system_id, dlrs in batches.items():
+                if self.registry.route(system_id, dlrs):
+                    continue
+                if self.dlr_store is not None:
+                    self.counters['injected_orphaned'] += len(dlrs)
+                    self.dlr_store.orphan(system_id, dlrs)
+                else:
+                    logger.warning(f"[INJECT] {len(dlrs)} dropped: no receiver bound as {system_id}")
+                    self.counters['injected_dropped'] += len(dlrs)
+            if items:
+                await asyncio.sleep(tick)
 
+    def _unbind_route(self, loop, body):
+        """POST /sessions/unbind: {"session": id} or {"system_id": ...}, optional "grace" seconds"""
         try:
-            return consts.OPTIONAL_PARAMS[name]
-        except KeyError:
-            raise exceptions.UnknownCommandError('Unknown SMPP command name "%s"' % name)
-
-
-    def unpack_short(data, pos):
-        return struct.unpack('>H', data[pos:pos + 2])[0], pos + 2
-
-
-    class Command(pdu.PDU):
-        """SMPP PDU Command class"""
-
-        params = {}
-
-        def __init__(self, command, need_sequence=True, allow_unknown_opt_params=False, **kwargs):
-            super(Command, self).__init__(**kwargs)
-
-            self.allow_unknown_opt_params = allow_unknown_opt_params
-
-            self.command = command
-            if need_sequence and (kwargs.get('sequence') is None):
-                self.sequence = self._next_seq()
-
-            if kwargs.get('status') is None:
-                self.status = consts.SMPP_ESME_ROK
-
-            self._set_vars(**kwargs)
-
-        def _set_vars(self, **kwargs):
-            """set attributes accordingly to kwargs"""
-            for key, value in six.iteritems(kwargs):
-                if not hasattr(self, key) or getattr(self, key) is None:
-                    setattr(self, key, value)
+            request = json.loads(body or b'{}')
+            unbound = call_in_loop(loop, lambda: self.unbind_sessions(**request))
+        except (ValueError, TypeError) as e:
+            return 400, 'text/plain', f'{e}\n'.encode()
+        return 200, 'application/json', json.dumps({'unbound': unbound}).encode()
+
+    def _inject_route(self, loop, body, query):
+        """POST /inject[?rate=N]: a JSON object, a JSON list or NDJSON of deliver_sm to send"""
+        try:
+            rate = float(query.get('rate', 0))
+            if not rate >= 0:
+                raise ValueError(f"rate must be >= 0, got {query['rate']!r}")
+            items = parse_injection(body)
+        except ValueError as e:
+            return 400, 'text/plain', f'{e}\n'.encode()
+        accepted = call_in_loop(loop, self.inject, items, rate)
+        return 202, 'application/json', json.dumps({'accepted': accepted, 'rate': rate}).encode()
 
-        def generate_params(self):
-            """Generate binary data from the object"""
+    def _signal_handler(self):
+        """Handle shutdown signals."""
+        logger.info("Received shutdown signal, shutting down gracefully...")
+        if self._shutdown_event:
+            self._shutdown_event.set()
 
-            if hasattr(self, 'prep') and callable(self.prep):
-                self.prep()
 
-            body = consts.EMPTY_STRING
+def install_event_loop(choice='auto'):
+    """Select the event loop asyncio.run() will create; return its name.
 
-            for field in self.params_order:
-                param = self.params[field]
-                if self.field_is_optional(field):
-                    if param.type is int:
-                        value = self._generate_int_tlv(field)
-                        if value:
-                            body += value
-                    elif param.type is str:
-                        value = self._generate_string_tlv(field)
-                        if value:
-                            body += value
-                    elif param.type is ostr:
-                        value = self._generate_ostring_tlv(field)
-                        if value:
-                            body += value
-                else:
-                    if param.type is int:
-                        value = self._generate_int(field)
-                        body += value
-                    elif param.type is str:
-                        value = self._generate_string(field)
-                        body += value
-                    elif param.type is ostr:
-                        value = self._generate_ostring(field)
-                        if value:
-                            body += value
-            return body
-
-        def _generate_opt_header(self, field):
-            """Generate a header for an optional parameter"""
-
-            raise NotImplementedError('Vendors not supported')
-
-        def _generate_int(self, field):
-            """Generate integer value"""
-
-            fmt = self._int_pack_format(field)
-            data = getattr(self, field)
-            if data:
-                return struct.pack(">" + fmt, data)
+    'auto' uses uvloop when it is installed and the stock loop otherwise.
+    """
+    if choice in ('uvloop', 'auto'):
+        try:
+            import uvloop
+        except ImportError:
+            if choice == 'uvloop':
+                logger.warning("uvloop requested but not installed; using the asyncio loop")
+            return 'asyncio'
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return 'uvloop'
+    return 'asyncio'
+
+
+# Point-in-time values in a worker's stats(): None drops the whole entry,
+# a tuple the listed fields of a nested dict. Everything else is a running
+# total.
+GAUGE_STATS = {
+    'sessions': None,
+    'bound_sessions': None,
+    'binds': None,
+    'dlr_in_flight': None,
+    'dlr_queued': None,
+    'dlr_scheduler': ('pending', 'last_lag', 'max_lag'),
+    'redis_circuit': ('open',),
+    'activation_cache': ('size',),
+    'dlr_store': ('orphans',),
+    'message_index': ('size', 'bytes'),
+    'concat': ('pending',),
+}
+
+
+def retired_stats(snapshot):
+    """Keep the running totals of a worker's last stats() snapshot."""
+    totals = {}
+    for key, value in snapshot.items():
+        gauges = GAUGE_STATS.get(key, ())
+        if gauges is None:
+            continue
+        if gauges:
+            value = {field: v for field, v in value.items() if field not in gauges}
+        totals[key] = value
+    return totals
+
+
+def merge_stats(snapshots):
+    """Combine per-worker stats() dicts: counts add up, lags take the max."""
+    merged = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if isinstance(value, dict):
+                merged[key] = merge_stats([merged.get(key, {}), value])
+            elif 'lag' in key:
+                merged[key] = max(merged.get(key, 0), value)
             else:
-                return consts.NULL_STRING
+                merged[key] = merged.get(key, 0) + value
+    return merged
 
-        def _generate_string(self, field):
-            """Generate string value"""
 
-            field_value = getattr(self, field)
+def call_in_loop(loop, fn, *args, timeout=5.0):
+    """Run fn(*args) on `loop`'s thread from another thread; return its result."""
+    future = concurrent.futures.Future()
 
-            if hasattr(self.params[field], 'size'):
-                size = self.params[field].size
-                value = field_value.ljust(size, chr(0))
-            elif hasattr(self.params[field], 'max'):
-                if len(field_value or '') >= self.params[field].max:
-                    field_value = field_value[0:self.params[field].max - 1]
-
-                if field_value:
-                    value = field_value + chr(0)
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    loop.call_soon_threadsafe(run)
+    return future.result(timeout)
+
+
+def _prometheus_line(name, value, labels=None):
+    if labels:
+        label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+        return f'fake_smsc_{name}{{{label_text}}} {value:g}'
+    return f'fake_smsc_{name} {value:g}'
+
+
+def render_metrics(stats, dlr_delay=None):
+    """Render a stats(histograms=True) snapshot in Prometheus text format."""
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f'# HELP fake_smsc_{name} {help_text}')
+        lines.append(f'# TYPE fake_smsc_{name} {kind}')
+        for labels, value in samples:
+            lines.append(_prometheus_line(name, value, labels))
+
+    counters = stats.get('counters', {})
+    family('pdus_received_total', 'counter', 'PDUs received, by command.',
+           [({'command': command}, count)
+            for command, count in sorted(stats.get('pdus', {}).items())])
+    family('submit_sm_total', 'counter', 'submit_sm PDUs acknowledged.',
+           [(None, counters.get('submit_sm', 0))])
+    family('submit_sm_decisions_total', 'counter', 'Activation gating decisions.',
+           [({'decision': decision}, counters.get(decision, 0))
+            for decision in ('accepted', 'rejected')])
+    family('dlrs_sent_total', 'counter', 'Delivery receipts written, by stat.',
+           [({'stat': key[4:]}, count) for key, count in sorted(counters.items())
+            if key.startswith('dlr_') and key[4:].isupper()])
+    family('dlrs_dropped_total', 'counter', 'Receipts dropped because the session closed.',
+           [(None, counters.get('dlr_dropped', 0))])
+    family('submit_sm_pushed_back_total', 'counter', 'submit_sm answered with a throttling status.',
+           [({'status': 'ESME_RTHROTTLED'}, counters.get('throttled', 0)),
+            ({'status': 'ESME_RMSGQFUL'}, counters.get('queue_full', 0))])
+    family('dlrs_in_flight', 'gauge', 'deliver_sm sent and awaiting deliver_sm_resp.',
+           [(None, stats.get('dlr_in_flight', 0))])
+    family('dlrs_queued', 'gauge', 'Due receipts waiting for a free window slot.',
+           [(None, stats.get('dlr_queued', 0))])
+    family('dlr_retries_total', 'counter', 'Receipts resent after a timeout or error resp.',
+           [(None, counters.get('dlr_retried', 0))])
+    family('dlr_timeouts_total', 'counter', 'deliver_sm not answered within the resp timeout.',
+           [(None, counters.get('dlr_timeouts', 0))])
+    family('dlrs_expired_total', 'counter', 'Receipts given up on after the last retry.',
+           [(None, counters.get('dlr_expired', 0))])
+    family('injected_total', 'counter', 'deliver_sm accepted by POST /inject.',
+           [(None, counters.get('injected', 0))])
+    family('mo_sent_total', 'counter', 'Injected MO deliver_sm written.',
+           [(None, counters.get('mo_sent', 0))])
+    family('forced_unbinds_total', 'counter', 'Sessions sent an unbind through the admin routes.',
+           [(None, counters.get('forced_unbind', 0))])
+    capture = stats.get('capture')
+    if capture is not None:
+        family('capture_records_total', 'counter', 'PDUs captured.',
+               [(None, capture.get('records', 0))])
+        family('capture_bytes_total', 'counter', 'Bytes written to the capture files.',
+               [(None, capture.get('bytes', 0))])
+    store = stats.get('dlr_store')
+    if store is not None:
+        family('dlr_store_orphans', 'gauge', 'Receipts waiting for their system_id to bind again.',
+               [(None, store.get('orphans', 0))])
+        family('dlr_store_handed_over_total', 'counter', 'Stored receipts delivered to a new bind.',
+               [(None, store.get('handed_over', 0))])
+        family('dlr_store_recovered_total', 'counter', 'Receipts recovered from Redis after a restart.',
+               [(None, store.get('recovered', 0))])
+    index = stats.get('message_index')
+    if index is not None:
+        family('message_index_entries', 'gauge', 'Messages query_sm can answer for.',
+               [(None, index.get('size', 0))])
+        family('message_index_bytes', 'gauge', 'Memory held by the query_sm message index.',
+               [(None, index.get('bytes', 0))])
+    concat = stats.get('concat')
+    if concat is not None:
+        family('concat_pending_sets', 'gauge', 'Concatenated messages still missing segments.',
+               [(None, concat.get('pending', 0))])
+        family('concat_segments_total', 'counter', 'submit_sm segments of concatenated messages.',
+               [(None, concat.get('segments', 0))])
+        family('concat_completed_total', 'counter', 'Concatenated messages with every segment received.',
+               [(None, concat.get('completed', 0))])
+        family('concat_expired_total', 'counter', 'Concatenated messages given up on before completion.',
+               [(None, concat.get('expired', 0))])
+        family('concat_shared_decisions_total', 'counter',
+               'Segments that reused their message\'s gate decision instead of a lookup.',
+               [(None, concat.get('shared_decisions', 0))])
+    family('generic_nacks_total', 'counter', 'generic_nack responses to unknown commands.',
+           [(None, counters.get('generic_nack', 0))])
+    family('sessions', 'gauge', 'Open SMPP connections.',
+           [(None, stats.get('sessions', 0))])
+    family('bound_sessions', 'gauge', 'Bound SMPP sessions.',
+           [(None, stats.get('bound_sessions', 0))])
+    family('binds', 'gauge', 'Bound SMPP sessions by bind type.',
+           [({'type': bind}, count) for bind, count in sorted(stats.get('binds', {}).items())])
+    scheduler = stats.get('dlr_scheduler', {})
+    family('pending_dlrs', 'gauge', 'Receipts waiting in the DLR scheduler.',
+           [(None, scheduler.get('pending', 0))])
+    family('dlr_max_lag_seconds', 'gauge', 'Worst lateness of a receipt past its due time.',
+           [(None, scheduler.get('max_lag', 0))])
+    if dlr_delay is not None:
+        family('dlr_delay_configured_seconds', 'gauge', 'Configured --dlr-delay.',
+               [(None, dlr_delay)])
+    family('redis_batches_total', 'counter', 'Activation lookup round trips to Redis.',
+           [(None, stats.get('redis_batches', 0))])
+    family('redis_lookups_total', 'counter', 'Activation lookups sent to Redis.',
+           [(None, stats.get('redis_lookups', 0))])
+    circuit = stats.get('redis_circuit')
+    if circuit is not None:
+        family('redis_circuit_open', 'gauge', '1 while activation lookups skip Redis and fail open.',
+               [(None, circuit.get('open', 0))])
+        family('redis_circuit_opens_total', 'counter', 'Times the Redis circuit breaker opened.',
+               [(None, circuit.get('opens', 0))])
+        family('redis_short_circuited_total', 'counter', 'Lookups failed open while the circuit was open.',
+               [(None, circuit.get('short_circuited', 0))])
+    cache = stats.get('activation_cache')
+    if cache is not None:
+        family('activation_cache_entries', 'gauge', 'Cached activation lookups.',
+               [(None, cache.get('size', 0))])
+        for key in ('hits', 'misses', 'evictions', 'invalidations'):
+            family(f'activation_cache_{key}_total', 'counter', f'Activation cache {key}.',
+                   [(None, cache.get(key, 0))])
+
+    helps = {
+        'submit_sm_resp_latency_seconds': 'Time from reading a submit_sm to queuing its resp.',
+        'redis_lookup_latency_seconds': 'Activation lookup time seen by has_active_activation.',
+        'dlr_delay_seconds': 'Real time from scheduling a receipt to writing it.',
+        'redis_pool_wait_seconds': 'Time spent waiting for a Redis pool connection.',
+    }
+    for name, histogram in stats.get('histograms', {}).items():
+        lines.append(f'# HELP fake_smsc_{name} {helps.get(name, name)}')
+        lines.append(f'# TYPE fake_smsc_{name} histogram')
+        cumulative = 0
+        for bound, count in histogram['buckets'].items():
+            cumulative += count
+            lines.append(_prometheus_line(f'{name}_bucket', cumulative, {'le': bound}))
+        lines.append(_prometheus_line(f'{name}_sum', histogram['sum']))
+        lines.append(_prometheus_line(f'{name}_count', histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serve GET /metrics from a daemon thread, off the event loop.
+
+    `snapshot` is called on the HTTP thread and must be thread-safe (see
+    call_in_loop); rendering happens on that thread too. Other routes are
+    called as route(body, query) with the query string as a dict and return
+    (status, content type, payload). Without a snapshot there is no
+    /metrics, which is how the admin listener uses it.
+    """
+
+    def __init__(self, host, port, snapshot=None, dlr_delay=None, name='fake-smsc-metrics'):
+        self.host = host
+        self.port = port
+        self.snapshot = snapshot
+        self.dlr_delay = dlr_delay
+        self.name = name
+        self.routes = {('GET', '/metrics'): self._metrics} if snapshot is not None else {}
+        self._httpd = None
+        self._thread = None
+
+    def _metrics(self, body, query):
+        text = render_metrics(self.snapshot(), self.dlr_delay)
+        return 200, 'text/plain; version=0.0.4', text.encode()
+
+    def start(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qsl
+
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def _dispatch(self, method):
+                path, _, query = self.path.partition('?')
+                route = routes.get((method, path))
+                if route is None:
+                    status, content_type, payload = 404, 'text/plain', b'not found\n'
                 else:
-                    value = chr(0)
-
-            setattr(self, field, field_value)
-            return six.b(value)
-
-        def _generate_ostring(self, field):
-            """Generate octet string value (no null terminator)"""
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = self.rfile.read(length) if length else b''
+                    try:
+                        status, content_type, payload = route(body, dict(parse_qsl(query)))
+                    except Exception as e:
+                        status, content_type, payload = 503, 'text/plain', f'{e}\n'.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def log_message(self, format, *args):
+                logger.debug("[HTTP] " + format, *args)
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+def _worker_main(index, options, conn, report_interval, loop, logging_options, redis_options):
+    """Entry point of a forked worker: own Redis pool, scheduler and listener."""
+    global rc_client
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Until FakeSMSC.run() installs its reload handler, a forwarded SIGHUP must not kill us.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    install_event_loop(loop)
+    rc_client = make_redis_client(**redis_options)
+    # Listener threads do not survive fork(): each worker builds its own.
+    listener = configure_logging(worker=index, **logging_options)
+
+    if options.get('capture_path'):
+        # One capture per worker; session ids are only unique within a process.
+        options = dict(options, capture_path=f"{options['capture_path']}.w{index}")
+    smsc = FakeSMSC(reuse_port=True, worker_id=index, **options)
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            conn.send(smsc.stats(histograms=True))
+
+    async def main():
+        reporter = asyncio.ensure_future(report())
+        try:
+            await smsc.run()
+        finally:
+            reporter.cancel()
+            conn.send(smsc.stats(histograms=True))
 
-            value = getattr(self, field)
-            if value:
-                return value
-            else:
-                return None  # chr(0)
-
-        def _generate_int_tlv(self, field):
-            """Generate integer value"""
-            fmt = self._int_pack_format(field)
-            data = getattr(self, field)
-            field_code = get_optional_code(field)
-            field_length = self.params[field].size
-            value = None
-            if data is not None:
-                value = struct.pack(">HH" + fmt, field_code, field_length, data)
-            return value
-
-        def _generate_string_tlv(self, field):
-            """Generate string value"""
-
-            field_value = getattr(self, field)
-            field_code = get_optional_code(field)
-
-            if hasattr(self.params[field], 'size'):
-                size = self.params[field].size
-                fvalue = field_value.ljust(size, chr(0))
-                value = struct.pack(">HH", field_code, size) + fvalue
-            elif hasattr(self.params[field], 'max'):
-                if len(field_value or '') > self.params[field].max:
-                    field_value = field_value[0:self.params[field].max - 1]
-
-                if field_value:
-                    fvalue = field_value + chr(0)
-                    field_length = len(fvalue)
-                    value = struct.pack(">HH", field_code, field_length) + fvalue.encode()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if listener is not None:
+            listener.stop()
+
+
+class WorkerSupervisor:
+    """Fork N FakeSMSC workers that share one port via SO_REUSEPORT.
+
+    Crashed workers are restarted (with backoff if they keep dying),
+    SIGTERM/SIGINT are forwarded for a graceful shutdown, and the stats each
+    worker reports over its pipe are merged into one periodic log line.
+    """
+
+    def __init__(self, workers, options, stats_interval=30, report_interval=1.0,
+                 shutdown_timeout=10.0, loop='auto', logging_options=None,
+                 metrics_host=None, metrics_port=None, admin_host='127.0.0.1', admin_port=None,
+                 redis_options=None):
+        import multiprocessing
+        import threading
+        self._mp = multiprocessing.get_context('fork')
+        self.workers = workers
+        self.options = options
+        self.stats_interval = stats_interval
+        self.report_interval = report_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.loop = loop
+        self.logging_options = logging_options or {}
+        self.redis_options = redis_options or {}
+        self.metrics_host = metrics_host or options.get('host', '0.0.0.0')
+        self.metrics_port = metrics_port
+        self.admin_host = admin_host
+        self.admin_port = admin_port
+        self.procs = {}
+        self.conns = {}
+        self.latest = {}
+        # Totals of workers that have exited, so counters survive a restart.
+        # The lock keeps a scrape from seeing a worker in both or neither.
+        self.retired = {}
+        self._retire_lock = threading.Lock()
+        self._restart_at = {}
+        self._backoff = {}
+        self._started = {}
+        self._kill_at = None
+
+    def _spawn(self, index):
+        parent_conn, child_conn = self._mp.Pipe(duplex=False)
+        proc = self._mp.Process(
+            target=_worker_main,
+            args=(index, self.options, child_conn, self.report_interval, self.loop,
+                  self.logging_options, self.redis_options),
+            name=f'fake-smsc-w{index}',
+        )
+        proc.start()
+        child_conn.close()
+        self.procs[index] = proc
+        self.conns[index] = parent_conn
+        self._started[index] = time.monotonic()
+        logger.info(f"[SUPERVISOR] started worker {index} pid={proc.pid}")
+
+    def _signal_handler(self, signum, frame):
+        if self._kill_at is None:
+            logger.info("[SUPERVISOR] shutdown signal, stopping workers...")
+            self._kill_at = time.monotonic() + self.shutdown_timeout
+        self._restart_at.clear()
+        for proc in self.procs.values():
+            if proc.exitcode is None:
+                os.kill(proc.pid, signal.SIGTERM)
+
+    def _reload_handler(self, signum, frame):
+        self.reload()
+
+    def reload(self):
+        """Check the config file, then have every worker re-read it (SIGHUP)"""
+        path = self.options.get('config_path')
+        if path is None:
+            raise ValueError("no config file to reload (start with --config)")
+        RuntimeConfig.load(path, RuntimeConfig())
+        for proc in self.procs.values():
+            if proc.exitcode is None:
+                os.kill(proc.pid, signal.SIGHUP)
+        logger.info(f"[SUPERVISOR] reloading {path} in {len(self.procs)} workers")
+        return len(self.procs)
+
+    def _reload_route(self, body, query):
+        try:
+            workers = self.reload()
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.error(f"[SUPERVISOR] reload failed, workers keep their configuration: {e}")
+            return 400, 'text/plain', f'{e}\n'.encode()
+        return 202, 'application/json', json.dumps({'workers': workers}).encode()
+
+    def combined_stats(self, histograms=False):
+        with self._retire_lock:
+            snapshots = [self.retired] + list(self.latest.values())
+        stats = merge_stats(snapshots)
+        if not histograms:
+            stats.pop('pdus', None)
+            stats.pop('histograms', None)
+        return stats
+
+    def run(self):
+        from multiprocessing.connection import wait
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._signal_handler)
+        signal.signal(signal.SIGHUP, self._reload_handler)
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info(f"[SUPERVISOR] {self.workers} workers sharing port {self.options.get('port')}")
+        metrics_server = None
+        if self.metrics_port is not None:
+            # combined_stats() copies the reports under a lock before merging,
+            # so it is safe on the HTTP thread; histogram buckets add up.
+            metrics_server = MetricsServer(
+                self.metrics_host, self.metrics_port,
+                lambda: self.combined_stats(histograms=True),
+                dlr_delay=self.options.get('dlr_delay'),
+            )
+            metrics_server.start()
+            logger.info(f"[SUPERVISOR] metrics on http://{self.metrics_host}:{metrics_server.port}/metrics")
+        admin_server = None
+        if self.admin_port is not None:
+            admin_server = MetricsServer(self.admin_host, self.admin_port, name='fake-smsc-admin')
+            admin_server.routes[('POST', '/reload')] = self._reload_route
+            admin_server.start()
+            logger.info(f"[SUPERVISOR] admin on http://{self.admin_host}:{admin_server.port} (POST /reload)")
+
+        next_log = time.monotonic() + self.stats_interval
+        while self.procs or self._restart_at:
+            sentinels = {proc.sentinel: index for index, proc in self.procs.items()}
+            pipes = {conn: index for index, conn in self.conns.items()}
+            for ready in wait(list(sentinels) + list(pipes), timeout=0.5):
+                if ready in pipes:
+                    index = pipes[ready]
+                    if self.conns.get(index) is not ready:
+                        continue    # drained when its worker was reaped
+                    try:
+                        self.latest[index] = ready.recv()
+                    except (EOFError, OSError):
+                        del self.conns[index]
                 else:
-                    value = None  # chr(0)
-            return value
-
-        def _generate_ostring_tlv(self, field):
-            """Generate octet string value (no null terminator)"""
+                    self._reap(sentinels[ready])
+
+            now = time.monotonic()
+            for index, due in list(self._restart_at.items()):
+                if now >= due:
+                    del self._restart_at[index]
+                    self._spawn(index)
+            if self.stats_interval and now >= next_log:
+                logger.info(f"[STATS] workers={len(self.procs)} {self.combined_stats()}")
+                next_log = now + self.stats_interval
+            if self._kill_at is not None and now >= self._kill_at:
+                for proc in self.procs.values():
+                    proc.kill()
+
+        if metrics_server is not None:
+            metrics_server.stop()
+        if admin_server is not None:
+            admin_server.stop()
+        logger.info(f"[SUPERVISOR] all workers stopped. Stats: {self.combined_stats()}")
+
+    def _retire(self, index):
+        """Fold an exited worker's last report into the retired totals."""
+        conn = self.conns.pop(index, None)
+        if conn is not None:
             try:
-                field_value = getattr(self, field)
-            except:
-                return None
-            field_code = get_optional_code(field)
-
-            value = None
-            if field_value:
-                field_length = len(field_value)
-                value = struct.pack(">HH", field_code, field_length) + field_value
-            return value
-
-        def _int_pack_format(self, field):
-            """Return format type"""
-            return consts.INT_PACK_FORMATS[self.params[field].size]
-
-        def _parse_int(self, field, data, pos):
-            """
-            Parse fixed-length chunk from a PDU.
-            Return (data, pos) tuple.
-            """
-
-            size = self.params[field].size
-            fmt = self._int_pack_format(field)
-            field_value, = struct.unpack(">" + fmt, data[pos:pos + size])
-            setattr(self, field, field_value)
-            pos += size
-
-            return data, pos
-
-        def _parse_string(self, field, data, pos, length=None):
-            """
-            Parse variable-length string from a PDU.
-            Return (data, pos) tuple.
-            """
-
-            if length is None:
-                end = data.find(consts.NULL_STRING, pos)
-                length = end - pos
-            else:
-                length -= 1  # length includes trailing NULL character
-
-            setattr(self, field, data[pos:pos + length])
-            pos += length + 1
-
-            return data, pos
-
-        def _parse_ostring(self, field, data, pos, length=None):
-            """
-            Parse an octet string from a PDU.
-            Return (data, pos) tuple.
-            """
-
-            if length is None:
-                length_field = self.params[field].len_field
-                length = int(getattr(self, length_field))
-
-            setattr(self, field, data[pos:pos + length])
-            pos += length
-
-            return data, pos
-
-        def is_fixed(self, field):
-            """Return True if field has fixed length, False otherwise"""
-
-            if hasattr(self.params[field], 'size'):
-                return True
-            return False
-
-        def parse_params(self, data):
-            """Parse data into the object structure"""
-
-            pos = 0
-            dlen = len(data)
-
-            for field in self.params_order:
-                param = self.params[field]
-                if pos == dlen or self.field_is_optional(field):
-                    break
-
-                if param.type is int:
-                    data, pos = self._parse_int(field, data, pos)
-                elif param.type is str:
-                    data, pos = self._parse_string(field, data, pos)
-                elif param.type is ostr:
-                    data, pos = self._parse_ostring(field, data, pos)
-            if pos < dlen:
-                self.parse_optional_params(data[pos:])
-
-        def parse_optional_params(self, data):
-            """Parse optional parameters.
-
-            Optional parameters have the following format:
-                * type (2 bytes)
-                * length (2 bytes)
-                * value (variable, <length> bytes)
-            """
-            dlen = len(data)
-            pos = 0
-
-            while pos < dlen:
-                type_code, pos = unpack_short(data, pos)
-                length, pos = unpack_short(data, pos)
-
-                try:
-                    field = get_optional_name(type_code)
-                except exceptions.UnknownCommandError as e:
-                    if self.allow_unknown_opt_params:
-                        logger.warning("Unknown optional parameter type 0x%x, skipping", type_code)
-                        pos += length
-                        continue
-                    raise
-
-                param = self.params[field]
-                if param.type is int:
-                    data, pos = self._parse_int(field, data, pos)
-                elif param.type is str:
-                    data, pos = self._parse_string(field, data, pos, length)
-                elif param.type is ostr:
-                    data, pos = self._parse_ostring(field, data, pos, length)
-
-        def field_exists(self, field):
-            """Return True if field exists, False otherwise"""
-            return hasattr(self.params, field)
-
-        def field_is_optional(self, field):
-            """Return True if field is optional, False otherwise"""
-
-            if hasattr(self, 'mandatory_fields') and field in self.mandatory_fields:
-                return False
-            elif field in consts.OPTIONAL_PARAMS:
-                return True
-            elif self.is_vendor():
-                # FIXME: No vendor support yet
-                return False
-
-            return False
-
-
-    class Param(object):
-        """Command parameter info class"""
-
-        def __init__(self, **kwargs):
-            if 'type' not in kwargs:
-                raise KeyError('Parameter Type not defined')
-
-            if kwargs.get('type') not in (int, str, ostr, flag):
-                raise ValueError("Invalid parameter type: %s" % kwargs.get('type'))
-
-            valid_keys = ('type', 'size', 'min', 'max', 'len_field')
-            for k in kwargs:
-                if k not in valid_keys:
-                    raise KeyError("Key '%s' not allowed here" % k)
-
-            self.type = kwargs.get('type')
-
-            for param in ('size', 'min', 'max', 'len_field'):
-                if param in kwargs:
-                    setattr(self, param, kwargs[param])
-
-        def __repr__(self):
-            """Shows type of Param in console"""
-            return ''.join(('<Param of ', str(self.type), '>'))
-
-
-    class BindTransmitter(Command):
-        """Bind as a transmitter command"""
-
-        params = {
-            'system_id': Param(type=str, max=16),
-            'password': Param(type=str, max=9),
-            'system_type': Param(type=str, max=13),
-            'interface_version': Param(type=int, size=1),
-            'addr_ton': Param(type=int, size=1),
-            'addr_npi': Param(type=int, size=1),
-            'address_range': Param(type=str, max=41),
-        }
-
-        # Order is important, but params dictionary is unordered
-        params_order = (
-            'system_id', 'password', 'system_type',
-            'interface_version', 'addr_ton', 'addr_npi', 'address_range',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(BindTransmitter, self).__init__(command, **kwargs)
-
-            self._set_vars(**(dict.fromkeys(self.params)))
-            self.interface_version = consts.SMPP_VERSION_34
-
-
-    class BindReceiver(BindTransmitter):
-        """Bind as a receiver command"""
-
-        def __init__(self, command, **kwargs):
-            super(BindReceiver, self).__init__(command, **kwargs)
-
-
-    class BindTransceiver(BindTransmitter):
-        """Bind as receiver and transmitter command"""
-
-        def __init__(self, command, **kwargs):
-            super(BindTransceiver, self).__init__(command, **kwargs)
-
-
-    class BindTransmitterResp(Command):
-        """Response for bind as a transmitter command"""
-
-        params = {
-            'system_id': Param(type=str, max=16),
-            'sc_interface_version': Param(type=int, size=1),
-        }
-
-        params_order = ('system_id', 'sc_interface_version')
-
-        def __init__(self, command, **kwargs):
-            super(BindTransmitterResp, self).__init__(command, need_sequence=False,
-                                                      **kwargs)
-
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class BindReceiverResp(BindTransmitterResp):
-        """Response for bind as a reciever command"""
-
-        def __init__(self, command, **kwargs):
-            super(BindReceiverResp, self).__init__(command, **kwargs)
-
-
-    class BindTransceiverResp(BindTransmitterResp):
-        """Response for bind as a transceiver command"""
-
-        def __init__(self, command, **kwargs):
-            super(BindTransceiverResp, self).__init__(command, **kwargs)
-
-
-    class DataSM(Command):
-        """data_sm command is used to transfer data between SMSC and the ESME"""
-
-        params = {
-            'service_type': Param(type=str, max=6),
-            'source_addr_ton': Param(type=int, size=1),
-            'source_addr_npi': Param(type=int, size=1),
-            'source_addr': Param(type=str, max=21),
-            'dest_addr_ton': Param(type=int, size=1),
-            'dest_addr_npi': Param(type=int, size=1),
-            'destination_addr': Param(type=str, max=21),
-            'esm_class': Param(type=int, size=1),
-            'registered_delivery': Param(type=int, size=1),
-            'data_coding': Param(type=int, size=1),
-
-            # Optional params:
-            'source_port': Param(type=int, size=2),
-            'source_addr_subunit': Param(type=int, size=1),
-            'source_network_type': Param(type=int, size=1),
-            'source_bearer_type': Param(type=int, size=1),
-            'source_telematics_id': Param(type=int, size=2),
-            'destination_port': Param(type=int, size=2),
-            'dest_addr_subunit': Param(type=int, size=1),
-            'dest_network_type': Param(type=int, size=1),
-            'dest_bearer_type': Param(type=int, size=1),
-            'dest_telematics_id': Param(type=int, size=2),
-            'sar_msg_ref_num': Param(type=int, size=2),
-            'sar_total_segments': Param(type=int, size=1),
-            'sar_segment_seqnum': Param(type=int, size=1),
-            'more_messages_to_send': Param(type=int, size=1),
-            'qos_time_to_live': Param(type=int, size=4),
-            'payload_type': Param(type=int, size=1),
-            'message_payload': Param(type=ostr, max=260),
-            'receipted_message_id': Param(type=str, max=65),
-            'message_state': Param(type=int, size=1),
-            'network_error_code': Param(type=ostr, size=3),
-            'user_message_reference': Param(type=int, size=2),
-            'privacy_indicator': Param(type=int, size=1),
-            'callback_num': Param(type=ostr, min=4, max=19),
-            'callback_num_pres_ind': Param(type=int, size=1),
-            'callback_num_atag': Param(type=str, max=65),
-            'source_subaddress': Param(type=str, min=2, max=23),
-            'dest_subaddress': Param(type=str, min=2, max=23),
-            'user_response_code': Param(type=int, size=1),
-            'display_time': Param(type=int, size=1),
-            'sms_signal': Param(type=int, size=2),
-            'ms_validity': Param(type=int, size=1),
-            'ms_msg_wait_facilities': Param(type=int, size=1),
-            'number_of_messages': Param(type=int, size=1),
-            'alert_on_message_delivery': Param(type=flag),
-            'language_indicator': Param(type=int, size=1),
-            'its_reply_type': Param(type=int, size=1),
-            'its_session_info': Param(type=int, size=2),
-        }
-
-        params_order = (
-            'service_type', 'source_addr_ton', 'source_addr_npi',
-            'source_addr', 'dest_addr_ton', 'dest_addr_npi', 'destination_addr',
-            'esm_class', 'registered_delivery', 'data_coding',
-
-            # Optional params:
-            'source_port', 'source_addr_subunit', 'source_network_type',
-            'source_bearer_type', 'source_telematics_id', 'destination_port',
-            'dest_addr_subunit', 'dest_network_type', 'dest_bearer_type',
-            'dest_telematics_id', 'sar_msg_ref_num', 'sar_total_segments',
-            'sar_segment_seqnum', 'more_messages_to_send', 'qos_time_to_live',
-            'payload_type', 'message_payload', 'receipted_message_id',
-            'message_state', 'network_error_code', 'user_message_reference',
-            'privacy_indicator', 'callback_num', 'callback_num_pres_ind',
-            'callback_num_atag', 'source_subaddress', 'dest_subaddress',
-            'user_response_code', 'display_time', 'sms_signal',
-            'ms_validity', 'ms_msg_wait_facilities', 'number_of_messages',
-            'alert_on_message_delivery', 'language_indicator', 'its_reply_type',
-            'its_session_info',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(DataSM, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class DataSMResp(Command):
-        """Reponse command for data_sm"""
-        params = {
-            'message_id': Param(type=str, max=65),
-
-            # Optional params:
-            # type size is implementation specific.
-            'delivery_failure_reason': Param(type=str, max=256),
-            'network_error_code': Param(type=str, max=3),
-            'additional_status_info_text': Param(type=str, max=256),
-            'dpf_result': Param(type=int, size=1),
-        }
-
-        params_order = (
-            'message_id',
-
-            # Optional params:
-            'delivery_failure_reason', 'network_error_code', 'additional_status_info_text',
-            'dpf_result',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(DataSMResp, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class GenericNAck(Command):
-        """General Negative Acknowledgement class"""
-
-        params = {}
-        params_order = ()
-        _defs = []
-
-        def __init__(self, command, **kwargs):
-            super(GenericNAck, self).__init__(command, need_sequence=False, **kwargs)
-
-
-    class SubmitSM(Command):
-        """submit_sm command class
-
-        This command is used by an ESME to submit short message to the SMSC.
-        submit_sm PDU does not support the transaction mode."""
-
-        #
-        # Service type
-        # The following generic service types are defined:
-        #   '' -- default
-        #   'CMT' -- Cellural Messaging
-        #   'CPT' -- Cellural Paging
-        #   'VMN' -- Voice Mail Notification
-        #   'VMA' -- Voice Mail Alerting
-        #   'WAP' -- Wireless Application Protocol
-        #   'USSD' -- Unstructured Supplementary Services Data
-        service_type = None
-
-        # Type of Number for source address
-        source_addr_ton = None
-
-        # Numbering Plan Indicator for source address
-        source_addr_npi = None
-
-        # Address of SME which originated this message
-        source_addr = None
-
-        # TON for destination
-        dest_addr_ton = None
-
-        # NPI for destination
-        dest_addr_npi = None
-
-        # Destination address for this message
-        destination_addr = None
-
-        # Message mode and message type
-        esm_class = None  # SMPP_MSGMODE_DEFAULT
-
-        # Protocol Identifier
-        protocol_id = None
-
-        # Priority level of this message
-        priority_flag = None
-
-        # Message is to be scheduled by the SMSC for delivery
-        schedule_delivery_time = None
-
-        # Validity period of this message
-        validity_period = None
-
-        # Indicator to signify if an SMSC delivery receipt or and SME
-        # acknowledgement is required.
-        registered_delivery = None
-
-        # This flag indicates if submitted message should replace an existing
-        # message
-        replace_if_present_flag = None
-
-        # Encoding scheme of the short messaege data
-        data_coding = None  # SMPP_ENCODING_DEFAULT#ISO10646
-
-        # Indicates the short message to send from a list of predefined
-        # ('canned') short messages stored on the SMSC
-        sm_default_msg_id = None
-
-        # Message length in octets
-        sm_length = 0
-
-        # Up to 254 octets of short message user data
-        short_message = None
-
-        # Optional are taken from params list and are set dynamically when
-        # __init__ is called.
-        params = {
-            'service_type': Param(type=str, max=6),
-            'source_addr_ton': Param(type=int, size=1),
-            'source_addr_npi': Param(type=int, size=1),
-            'source_addr': Param(type=str, max=21),
-            'dest_addr_ton': Param(type=int, size=1),
-            'dest_addr_npi': Param(type=int, size=1),
-            'destination_addr': Param(type=str, max=21),
-            'esm_class': Param(type=int, size=1),
-            'protocol_id': Param(type=int, size=1),
-            'priority_flag': Param(type=int, size=1),
-            'schedule_delivery_time': Param(type=str, max=17),
-            'validity_period': Param(type=str, max=17),
-            'registered_delivery': Param(type=int, size=1),
-            'replace_if_present_flag': Param(type=int, size=1),
-            'data_coding': Param(type=int, size=1),
-            'sm_default_msg_id': Param(type=int, size=1),
-            'sm_length': Param(type=int, size=1),
-            'short_message': Param(type=ostr, max=254, len_field='sm_length'),
-
-            # Optional params
-            'user_message_reference': Param(type=int, size=2),
-            'source_port': Param(type=int, size=2),
-            'source_addr_subunit': Param(type=int, size=2),
-            'destination_port': Param(type=int, size=2),
-            'dest_addr_subunit': Param(type=int, size=1),
-            'sar_msg_ref_num': Param(type=int, size=2),
-            'sar_total_segments': Param(type=int, size=1),
-            'sar_segment_seqnum': Param(type=int, size=1),
-            'more_messages_to_send': Param(type=int, size=1),
-            'payload_type': Param(type=int, size=1),
-            'message_payload': Param(type=ostr, max=260),
-            'privacy_indicator': Param(type=int, size=1),
-            'callback_num': Param(type=ostr, min=4, max=19),
-            'callback_num_pres_ind': Param(type=int, size=1),
-            'source_subaddress': Param(type=str, min=2, max=23),
-            'dest_subaddress': Param(type=str, min=2, max=23),
-            'user_response_code': Param(type=int, size=1),
-            'display_time': Param(type=int, size=1),
-            'sms_signal': Param(type=int, size=2),
-            'ms_validity': Param(type=int, size=1),
-            'ms_msg_wait_facilities': Param(type=int, size=1),
-            'number_of_messages': Param(type=int, size=1),
-            'alert_on_message_delivery': Param(type=flag),
-            'language_indicator': Param(type=int, size=1),
-            'its_reply_type': Param(type=int, size=1),
-            'its_session_info': Param(type=int, size=2),
-            'ussd_service_op': Param(type=int, size=1),
-        }
-
-        params_order = (
-            'service_type', 'source_addr_ton', 'source_addr_npi',
-            'source_addr', 'dest_addr_ton', 'dest_addr_npi',
-            'destination_addr', 'esm_class', 'protocol_id', 'priority_flag',
-            'schedule_delivery_time', 'validity_period', 'registered_delivery',
-            'replace_if_present_flag', 'data_coding', 'sm_default_msg_id',
-            'sm_length', 'short_message',
-
-            # Optional params
-            'user_message_reference', 'source_port', 'source_addr_subunit',
-            'destination_port', 'dest_addr_subunit', 'sar_msg_ref_num',
-            'sar_total_segments', 'sar_segment_seqnum', 'more_messages_to_send',
-            'payload_type', 'message_payload', 'privacy_indicator',
-            'callback_num', 'callback_num_pres_ind', 'source_subaddress',
-            'dest_subaddress', 'user_response_code', 'display_time',
-            'sms_signal', 'ms_validity', 'ms_msg_wait_facilities',
-            'number_of_messages', 'alert_on_message_delivery',
-            'language_indicator', 'its_reply_type', 'its_session_info',
-            'ussd_service_op',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(SubmitSM, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-        def prep(self):
-            """Prepare to generate binary data"""
-
-            if self.short_message:
-                if getattr(self, 'message_payload', None):
-                    raise ValueError('`message_payload` can not be used with `short_message`')
-                self.sm_length = len(self.short_message)
-            else:
-                self.sm_length = 0
-
-
-    class SubmitSMResp(Command):
-        """Response command for submit_sm"""
-
-        params = {
-            'message_id': Param(type=str, max=65),
-        }
-
-        params_order = ('message_id',)
-
-        def __init__(self, command, **kwargs):
-            super(SubmitSMResp, self).__init__(command, need_sequence=False, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class DeliverSM(SubmitSM):
-        """deliver_sm command class, similar to submit_sm
-        but has different optional params"""
-
-        params = {
-            'service_type': Param(type=str, max=6),
-            'source_addr_ton': Param(type=int, size=1),
-            'source_addr_npi': Param(type=int, size=1),
-            'source_addr': Param(type=str, max=21),
-            'dest_addr_ton': Param(type=int, size=1),
-            'dest_addr_npi': Param(type=int, size=1),
-            'destination_addr': Param(type=str, max=21),
-            'esm_class': Param(type=int, size=1),
-            'protocol_id': Param(type=int, size=1),
-            'priority_flag': Param(type=int, size=1),
-            'schedule_delivery_time': Param(type=str, max=17),
-            'validity_period': Param(type=str, max=17),
-            'registered_delivery': Param(type=int, size=1),
-            'replace_if_present_flag': Param(type=int, size=1),
-            'data_coding': Param(type=int, size=1),
-            'sm_default_msg_id': Param(type=int, size=1),
-            'sm_length': Param(type=int, size=1),
-            'short_message': Param(type=ostr, max=254, len_field='sm_length'),
-
-            # Optional params
-            'user_message_reference': Param(type=int, size=2),
-            'source_port': Param(type=int, size=2),
-            'destination_port': Param(type=int, size=2),
-            'sar_msg_ref_num': Param(type=int, size=2),
-            'sar_total_segments': Param(type=int, size=1),
-            'sar_segment_seqnum': Param(type=int, size=1),
-            'user_response_code': Param(type=int, size=1),
-            'privacy_indicator': Param(type=int, size=1),
-            'payload_type': Param(type=int, size=1),
-            'message_payload': Param(type=ostr, max=260),
-            'callback_num': Param(type=ostr, min=4, max=19),
-            'source_subaddress': Param(type=str, min=2, max=23),
-            'dest_subaddress': Param(type=str, min=2, max=23),
-            'language_indicator': Param(type=int, size=1),
-            'its_session_info': Param(type=int, size=2),
-            'network_error_code': Param(type=ostr, size=3),
-            'message_state': Param(type=int, size=1),
-            'receipted_message_id': Param(type=str, max=65),
-            'source_network_type': Param(type=int, size=1),
-            'dest_network_type': Param(type=int, size=1),
-            'more_messages_to_send': Param(type=int, size=1),
-        }
-
-        params_order = (
-            'service_type', 'source_addr_ton', 'source_addr_npi',
-            'source_addr', 'dest_addr_ton', 'dest_addr_npi',
-            'destination_addr', 'esm_class', 'protocol_id', 'priority_flag',
-            'schedule_delivery_time', 'validity_period', 'registered_delivery',
-            'replace_if_present_flag', 'data_coding', 'sm_default_msg_id',
-            'sm_length', 'short_message',
-
-            # Optional params
-            'user_message_reference', 'source_port', 'destination_port',
-            'sar_msg_ref_num', 'sar_total_segments', 'sar_segment_seqnum',
-            'user_response_code', 'privacy_indicator',
-            'payload_type', 'message_payload',
-            'callback_num', 'source_subaddress',
-            'dest_subaddress', 'language_indicator', 'its_session_info',
-            'network_error_code', 'message_state', 'receipted_message_id',
-            'source_network_type', 'dest_network_type', 'more_messages_to_send',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(DeliverSM, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class DeliverSMResp(SubmitSMResp):
-        """deliver_sm_response response class, same as submit_sm"""
-        message_id = None
-
-        def __init__(self, command, **kwargs):
-            super(DeliverSMResp, self).__init__(command, **kwargs)
-
-
-    class QuerySM(Command):
-        """query_sm command class
-
-        This command is used by an ESME to query the state of a short message to the SMSC.
-        source_addr* values must match those supplied when the message was submitted."""
-
-        # Message ID of the message whose state is to be queried.
-        message_id = None
-
-        # Type of Number for source address
-        source_addr_ton = None
-
-        # Numbering Plan Indicator for source address
-        source_addr_npi = None
-
-        # Address of SME which originated this message
-        source_addr = None
-
-        # Optional are taken from params list and are set dynamically when
-        # __init__ is called.
-        params = {
-            'message_id': Param(type=str, max=65),
-            'source_addr_ton': Param(type=int, size=1),
-            'source_addr_npi': Param(type=int, size=1),
-            'source_addr': Param(type=str, max=21),
-        }
-
-        params_order = (
-            'message_id', 'source_addr_ton', 'source_addr_npi',
-            'source_addr',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(QuerySM, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-        def prep(self):
-            """Prepare to generate binary data"""
-
-            if not self.message_id:
-                raise ValueError('`message_id` is mandatory')
-
-
-    class QuerySMResp(Command):
-        """Response command for query_sm"""
-
-        mandatory_fields = ('message_state')
-
-        params = {
-            'message_id': Param(type=str, max=65),
-            'final_date': Param(type=str, max=17),
-            'message_state': Param(type=int, size=1),
-            'error_code': Param(type=int, size=1),
-        }
-
-        params_order = (
-            'message_id', 'final_date', 'message_state',
-            'error_code',
-        )
-
-        def __init__(self, command, **kwargs):
-            super(QuerySMResp, self).__init__(command, need_sequence=False, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
-
-
-    class Unbind(Command):
-        """Unbind command"""
-
-        params = {}
-        params_order = ()
-
-        def __init__(self, command, **kwargs):
-            super(Unbind, self).__init__(command, **kwargs)
-
-
-    class UnbindResp(Command):
-        """Unbind response command"""
-
-        params = {}
-        params_order = ()
-
-        def __init__(self, command, **kwargs):
-            super(UnbindResp, self).__init__(command, need_sequence=False, **kwargs)
-
-
-    class EnquireLink(Command):
-        """Enquire link command"""
-        params = {}
-        params_order = ()
-
-        def __init__(self, command, **kwargs):
-            super(EnquireLink, self).__init__(command, **kwargs)
-
-
-    class EnquireLinkResp(Command):
-        """Enquire link command response"""
-        params = {}
-        params_order = ()
-
-        def __init__(self, command, **kwargs):
-            super(EnquireLinkResp, self).__init__(command, need_sequence=False, **kwargs)
-
-
-    class AlertNotification(Command):
-        """`alert_notification` command class"""
-
-        # Type of Number for source address
-        source_addr_ton = None
-
-        # Numbering Plan Indicator for source address
-        source_addr_npi = None
-
-        # Address of SME which originated this message
-        source_addr = None
-
-        # TON for destination
-        esme_addr_ton = None
-
-        # NPI for destination
-        esme_addr_npi = None
-
-        # Destination address for this message
-        esme_addr = None
-
-        # Optional are taken from params list and are set dynamically when
-        # __init__ is called.
-        params = {
-            'source_addr_ton': Param(type=int, size=1),
-            'source_addr_npi': Param(type=int, size=1),
-            'source_addr': Param(type=str, max=21),
-            'esme_addr_ton': Param(type=int, size=1),
-            'esme_addr_npi': Param(type=int, size=1),
-            'esme_addr': Param(type=str, max=21),
-
-            # Optional params
-            'ms_availability_status': Param(type=int, size=1),
-        }
-
-        params_order = (
-            'source_addr_ton', 'source_addr_npi',
-            'source_addr', 'esme_addr_ton', 'esme_addr_npi',
-            'esme_addr',
-
-            # Optional params
-            'ms_availability_status',
-        )
+                while conn.poll():
+                    self.latest[index] = conn.recv()
+            except (EOFError, OSError):
+                pass
+            conn.close()
+        snapshot = self.latest.get(index)
+        if snapshot is not None:
+            retired = merge_stats([self.retired, retired_stats(snapshot)])
+            with self._retire_lock:
+                self.retired = retired
+                del self.latest[index]
+
+    def _reap(self, index):
+        proc = self.procs.pop(index)
+        proc.join()
+        self._retire(index)
+        if self._kill_at is not None:
+            logger.info(f"[SUPERVISOR] worker {index} exited ({proc.exitcode})")
+            return
+        # A worker that keeps dying backs off exponentially (capped at 30s);
+        # one that ran for a while is restarted straight away.
+        if time.monotonic() - self._started[index] > 30.0:
+            self._backoff.pop(index, None)
+        backoff = self._backoff.get(index, 0.5) * 2
+        self._backoff[index] = min(backoff, 30.0)
+        self._restart_at[index] = time.monotonic() + backoff
+        logger.error(f"[SUPERVISOR] worker {index} pid={proc.pid} died "
+                     f"(exit {proc.exitcode}), restarting in {backoff:g}s")
 
-        def __init__(self, command, **kwargs):
-            super(AlertNotification, self).__init__(command, **kwargs)
-            self._set_vars(**(dict.fromkeys(self.params)))
 
+if __name__ == '__main__':
+    import argparse
 
     parser = argparse.ArgumentParser(description='Fake SMSC Server')
     parser.add_argument('--host', default='0.0.0.0', help='Bind host')
     parser.add_argument('--port', type=int, default=2776, help='Bind port')
-    parser.add_argument('--dlr-delay', type=int, default=5, help='DLR delay in seconds')
+    parser.add_argument('--dlr-delay', type=float, default=5, help='DLR delay in seconds')
+    parser.add_argument('--config', default=None,
+                        help='JSON file with settings that can be reloaded live (SIGHUP or POST /reload); '
+                             'overrides the matching flags')
+    parser.add_argument('--dlr-profile', default=None,
+                        help='JSON file with delay distributions and outcome mixes per system_id / destination prefix')
+    parser.add_argument('--dlr-resolution-ms', type=float, default=100.0,
+                        help='DLR scheduler tick; receipts due within one tick are sent together')
+    parser.add_argument('--dlr-window', type=int, default=64,
+                        help='Max unacknowledged deliver_sm per session; the rest are queued (0 = unlimited)')
+    parser.add_argument('--dlr-resp-timeout', type=float, default=10.0,
+                        help='Seconds to wait for a deliver_sm_resp before retrying the DLR')
+    parser.add_argument('--dlr-retries', type=int, default=3,
+                        help='Times a timed-out or rejected DLR is resent before giving up')
+    parser.add_argument('--dlr-retry-backoff', type=float, default=1.0,
+                        help='Delay before the first DLR retry; doubles on each further retry')
+    parser.add_argument('--dlr-store', choices=('none', 'memory', 'redis'), default='memory',
+                        help='Keep receipts of closed sessions for the next bind of the same system_id '
+                             '(redis: also persist pending receipts across restarts)')
+    parser.add_argument('--dlr-store-max-age', type=float, default=3600.0,
+                        help='Forget stored receipts that have been due for longer than this (seconds)')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='Max submit_sm/s for the whole server; excess gets ESME_RTHROTTLED (0 = off)')
+    parser.add_argument('--throttle-burst', type=float, default=None,
+                        help='Token bucket size for --throttle-rate (default: one second of rate)')
+    parser.add_argument('--system-throttle-rate', type=float, default=0,
+                        help='Max submit_sm/s per system_id (0 = off)')
+    parser.add_argument('--system-throttle-burst', type=float, default=None,
+                        help='Token bucket size for --system-throttle-rate (default: one second of rate)')
+    parser.add_argument('--msgqful-pending', type=int, default=0,
+                        help='Answer ESME_RMSGQFUL while this many DLRs are pending (0 = off)')
+    parser.add_argument('--message-id-format', choices=('hex', 'decimal', 'uuid'), default='hex',
+                        help='submit_sm_resp message_id encoding (uuid: old random 8 hex digits, may collide)')
+    parser.add_argument('--message-id-width', type=int, default=18,
+                        help='message_id length in characters (max 64)')
+    parser.add_argument('--no-message-id-timestamp', action='store_true',
+                        help='Leave the start-time prefix out of message_ids (not unique across restarts)')
+    parser.add_argument('--query-index-size', type=int, default=1000000,
+                        help='Remember the state of this many recent messages for query_sm (0 = off)')
+    parser.add_argument('--concat-dlr', choices=('segment', 'message'), default='segment',
+                        help='Concatenated messages: one DLR per segment, or one per message')
+    parser.add_argument('--concat-timeout', type=float, default=60.0,
+                        help='Seconds before an incomplete concatenated message is given up on')
+    parser.add_argument('--concat-max-sets', type=int, default=100000,
+                        help='Max incomplete concatenated messages tracked (0 = treat segments independently)')
+    parser.add_argument('--write-buffer-kb', type=int, default=64,
+                        help='Flush a session\'s coalesced output once this much is buffered')
+    parser.add_argument('--max-pdu-size', type=int, default=MAX_PDU_SIZE,
+                        help='Reject PDUs whose command_length exceeds this many bytes')
+    parser.add_argument('--transport', choices=('stream', 'buffered'), default='stream',
+                        help='stream: StreamReader bulk reads; buffered: BufferedProtocol reads straight into the PDU buffer')
+    parser.add_argument('--redis-batch-window-ms', type=float, default=1.0,
+                        help='How long to collect activation lookups before one MGET (0 = same loop tick)')
+    parser.add_argument('--redis-batch-size', type=int, default=256,
+                        help='Flush an activation lookup batch early once this many keys are pending')
+    parser.add_argument('--activation-cache-size', type=int, default=100000,
+                        help='Max cached dlr:block lookups (LRU, 0 disables the cache)')
+    parser.add_argument('--activation-negative-ttl-ms', type=float, default=1000.0,
+                        help='How long a "no activation" result is cached')
+    parser.add_argument('--redis-pool-size', type=int, default=64,
+                        help='Max Redis connections per process; callers wait for a free one')
+    parser.add_argument('--redis-timeout-ms', type=float, default=2000.0,
+                        help='Redis socket/connect timeout, also the max wait for a pool connection')
+    parser.add_argument('--redis-protocol', type=int, choices=(2, 3), default=2,
+                        help='RESP protocol version to speak to Redis')
+    parser.add_argument('--redis-breaker-threshold', type=int, default=5,
+                        help='Fail open without calling Redis after this many consecutive errors (0 = off)')
+    parser.add_argument('--redis-probe-interval', type=float, default=1.0,
+                        help='Seconds between PINGs while the Redis circuit is open')
+    parser.add_argument('--activation-cache-tracking', action='store_true',
+                        help='Invalidate the activation cache with CLIENT TRACKING (Redis 6+) '
+                             'instead of keyspace notifications')
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop', 'auto'), default='auto',
+                        help='Event loop implementation (auto = uvloop when installed)')
+    parser.add_argument('--log-mode', choices=('sync', 'async'), default='sync',
+                        help='async: format and write log records on a background thread')
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text',
+                        help='Log line format')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='Only log per-message lines for 1 in N messages')
+    parser.add_argument('--log-summary-interval', type=float, default=0,
+                        help='Seconds between [SUMMARY] lines with counts per stat (0 = off)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Fork this many worker processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--stats-interval', type=float, default=30.0,
+                        help='Seconds between combined worker stats lines (--workers > 1)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve Prometheus metrics on this port at /metrics (0 = off)')
+    parser.add_argument('--metrics-host', default=None,
+                        help='Bind host for the metrics listener (default: --host)')
+    parser.add_argument('--capture', default=None, metavar='PATH',
+                        help='Write every PDU in and out to this binary capture file '
+                             '(see smpp_capture.py; PATH.wN per worker with --workers; '
+                             'an existing capture is kept and PATH.<time>-<pid> used instead)')
+    parser.add_argument('--capture-max-mb', type=float, default=256,
+                        help='Start a new capture file (PATH.1, PATH.2, ...) after this many MB')
+    parser.add_argument('--admin-port', type=int, default=0,
+                        help='Serve the mutating routes (throttle, reload, session list, forced unbind, '
+                             'deliver_sm injection) on this port (0 = off; only /reload with --workers)')
+    parser.add_argument('--admin-host', default='127.0.0.1',
+                        help='Bind host for the admin listener, which has no authentication')
     args = parser.parse_args()
 
-    smsc = FakeSMSC(
+    options = dict(
         host=args.host,
         port=args.port,
-        dlr_delay=args.dlr_delay
+        dlr_delay=args.dlr_delay,
+        dlr_resolution=args.dlr_resolution_ms / 1000.0,
+        dlr_window=args.dlr_window,
+        dlr_resp_timeout=args.dlr_resp_timeout,
+        dlr_retries=args.dlr_retries,
+        dlr_retry_backoff=args.dlr_retry_backoff,
+        dlr_store=args.dlr_store,
+        dlr_store_max_age=args.dlr_store_max_age,
+        # Each worker enforces its share of the configured rates.
+        throttle_rate=args.throttle_rate / max(args.workers, 1),
+        throttle_burst=args.throttle_burst and args.throttle_burst / max(args.workers, 1),
+        system_throttle_rate=args.system_throttle_rate / max(args.workers, 1),
+        system_throttle_burst=args.system_throttle_burst and args.system_throttle_burst / max(args.workers, 1),
+        msgqful_pending=args.msgqful_pending,
+        dlr_profile=args.dlr_profile,
+        config_path=args.config,
+        throttle_share=1.0 / max(args.workers, 1),
+        message_id_format=args.message_id_format,
+        message_id_width=args.message_id_width,
+        message_id_timestamp=not args.no_message_id_timestamp,
+        query_index_size=args.query_index_size,
+        concat_dlr=args.concat_dlr,
+        concat_timeout=args.concat_timeout,
+        concat_max_sets=args.concat_max_sets,
+        capture_path=args.capture,
+        capture_max_bytes=int(args.capture_max_mb * 1024 * 1024),
+        write_high_water=args.write_buffer_kb * 1024,
+        max_pdu_size=args.max_pdu_size,
+        transport=args.transport,
+        redis_batch_window=args.redis_batch_window_ms / 1000.0,
+        redis_batch_size=args.redis_batch_size,
+        cache_size=args.activation_cache_size,
+        cache_negative_ttl=args.activation_negative_ttl_ms / 1000.0,
+        cache_tracking=args.activation_cache_tracking,
+        redis_breaker_threshold=args.redis_breaker_threshold,
+        redis_probe_interval=args.redis_probe_interval,
+        summary_interval=args.log_summary_interval,
     )
+    logging_options = dict(mode=args.log_mode, fmt=args.log_format, sample=args.log_sample)
+    redis_options = dict(max_connections=args.redis_pool_size,
+                         socket_timeout=args.redis_timeout_ms / 1000.0,
+                         protocol=args.redis_protocol)
+    # Fail on a bad message_id layout before forking workers.
+    MessageIdGenerator(worker_id=max(args.workers, 1) - 1, fmt=args.message_id_format,
+                       width=args.message_id_width, timestamp=not args.no_message_id_timestamp)
+    if args.dlr_profile:
+        # Fail on a bad profile here rather than in every (restarting) worker.
+        DLRProfiles.load(args.dlr_profile, args.dlr_delay)
+    if args.config:
+        RuntimeConfig.load(args.config, RuntimeConfig(dlr_delay=args.dlr_delay, dlr_profile=args.dlr_profile))
+
+    if args.workers > 1:
+        configure_logging(fmt=args.log_format)
+        WorkerSupervisor(args.workers, options, stats_interval=args.stats_interval,
+                         loop=args.loop, logging_options=logging_options,
+                         metrics_host=args.metrics_host,
+                         metrics_port=args.metrics_port or None,
+                         admin_host=args.admin_host,
+                         admin_port=args.admin_port or None,
+                         redis_options=redis_options).run()
+        sys.exit(0)
+
+    listener = configure_logging(**logging_options)
+    install_event_loop(args.loop)
+    rc_client = make_redis_client(**redis_options)
+    smsc = FakeSMSC(metrics_host=args.metrics_host, metrics_port=args.metrics_port or None,
+                    admin_host=args.admin_host, admin_port=args.admin_port or None, **options)
     
     try:
         asyncio.run(smsc.run())
     except KeyboardInterrupt:
         logger.info("Shutting down gracefully...")
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)
+    finally:
+        if listener is not None:
+            listener.stop()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Read, index, slice and replay FakeSMSC PDU captures (fake_smsc.py --capture)
+
+A capture is one file plus its continuations PATH.1, PATH.2, ... The index
+is a .idx file next to each of them: the time and offset of every Nth record
+and the offsets of every PDU that names a message_id, so a slice does not
+have to scan the capture.
+
+    python smpp_capture.py index capture.bin
+    python smpp_capture.py dump capture.bin --from 30 --to 31
+    python smpp_capture.py slice capture.bin -o one.bin --message-id 00675f3c2a000000a1
+    python smpp_capture.py replay capture.bin --host 127.0.0.1 --port 2776 --speed 4
+"""
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+from array import array
+from collections import Counter
+
+from fake_smsc import (
+    CAPTURE_HEADER,
+    CAPTURE_IN,
+    CAPTURE_MAGIC,
+    CAPTURE_RECORD,
+    COMMAND_NAMES,
+    DELIVER_SM,
+    DELIVER_SM_RESP,
+    ENQUIRE_LINK,
+    ENQUIRE_LINK_RESP,
+    ESME_ROK,
+    PDU_HEADER,
+    QUERY_SM,
+    QUERY_SM_RESP,
+    SUBMIT_SM,
+    SUBMIT_SM_RESP,
+    UNBIND,
+    UNBIND_RESP,
+)
+
+INDEX_MAGIC = b'SMPPIDX\x01'
+INDEX_HEADER = struct.Struct('>8sIII')     # magic, time stride, time entries, id entries
+_RECEIPT_ID = re.compile(rb'id:(\S+)')
+
+
+def capture_files(path):
+    """`path` and its continuations path.1, path.2, ... in order
+
+    A continuation belongs to `path` only if it has the same t=0.
+    """
+    files = [path]
+    epoch = read_epoch(path)
+    while os.path.exists(f'{path}.{len(files)}'):
+        name = f'{path}.{len(files)}'
+        try:
+            if read_epoch(name) != epoch:
+                break
+        except ValueError:
+            break
+        files.append(name)
+    return files
+
+
+def read_epoch(path):
+    """Wall-clock time (epoch seconds) of t=0 of a capture file"""
+    with open(path, 'rb') as f:
+        return _read_header(f, path)
+
+
+def _read_header(f, path):
+    header = f.read(CAPTURE_HEADER.size)
+    if len(header) < CAPTURE_HEADER.size or not header.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{path} is not a FakeSMSC capture")
+    return CAPTURE_HEADER.unpack(header)[1]
+
+
+def read_records(path, offset=None):
+    """Yield (offset, t_us, session_id, direction, pdu) from one capture file
+
+    A record cut short at the end (the server was still writing) ends the file.
+    """
+    with open(path, 'rb') as f:
+        _read_header(f, path)
+        if offset is not None:
+            f.seek(offset)
+        position = f.tell()
+        size = CAPTURE_RECORD.size
+        while True:
+            head = f.read(size)
+            if len(head) < size:
+                return
+            length, t_us, session_id, direction = CAPTURE_RECORD.unpack(head)
+            pdu = f.read(length)
+            if len(pdu) < length:
+                return
+            yield position, t_us, session_id, direction, pdu
+            position += size + length
+
+
+def write_capture(path, records, epoch):
+    """Write `records` (as read_records yields them) to a new capture file; return how many"""
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, epoch))
+        for _, t_us, session_id, direction, pdu in records:
+            f.write(CAPTURE_RECORD.pack(len(pdu), t_us, session_id, direction))
+            f.write(pdu)
+            count += 1
+    return count
+
+
+def message_id_hash(message_id):
+    """Stable 64-bit hash of a message_id (str or bytes) for the index"""
+    if isinstance(message_id, str):
+        message_id = message_id.encode('latin-1')
+    return int.from_bytes(hashlib.blake2b(message_id, digest_size=8).digest(), 'big', signed=True)
+
+
+class CaptureIndex:
+    """Time and message_id index of one capture file.
+
+    `times`/`time_offsets` hold the time and offset of every `stride`-th
+    record. `id_hashes` (sorted) and `id_offsets` list every PDU that names
+    a message_id: submit_sm_resp, receipt deliver_sm, query_sm and its resp,
+    plus the submit_sm and deliver_sm_resp paired with them by session and
+    sequence number. Ids are matched by their 64-bit hash only. On disk it
+    is INDEX_HEADER followed by big-endian int64 pairs.
+    """
+
+    def __init__(self, stride, times, time_offsets, id_hashes, id_offsets):
+        self.stride = stride
+        self.times = times
+        self.time_offsets = time_offsets
+        self.id_hashes = id_hashes
+        self.id_offsets = id_offsets
+
+    @classmethod
+    def build(cls, path, stride=1024):
+        """Scan a capture file once and index it"""
+        times, time_offsets = array('q'), array('q')
+        entries = []
+        submits = {}        # (session, sequence) -> offset of an unanswered submit_sm
+        receipts = {}       # (session, sequence) -> id hash of an unanswered receipt
+        for count, (offset, t_us, session_id, _, pdu) in enumerate(read_records(path)):
+            if count % stride == 0:
+                times.append(t_us)
+                time_offsets.append(offset)
+            _, cmd, _, seq = PDU_HEADER.unpack_from(pdu)
+            key = (session_id, seq)
+            if cmd == SUBMIT_SM:
+                submits[key] = offset
+            elif cmd == SUBMIT_SM_RESP:
+                submit = submits.pop(key, None)
+                message_id = pdu[16:].split(b'\x00', 1)[0]
+                if message_id:
+                    h = message_id_hash(message_id)
+                    if submit is not None:
+                        entries.append((h, submit))
+                    entries.append((h, offset))
+            elif cmd == DELIVER_SM:
+                match = _RECEIPT_ID.search(pdu, 16)
+                if match:
+                    h = message_id_hash(match.group(1))
+                    receipts[key] = h
+                    entries.append((h, offset))
+            elif cmd == DELIVER_SM_RESP:
+                h = receipts.pop(key, None)
+                if h is not None:
+                    entries.append((h, offset))
+            elif cmd in (QUERY_SM, QUERY_SM_RESP):
+                message_id = pdu[16:].split(b'\x00', 1)[0]
+                if message_id:
+                    entries.append((message_id_hash(message_id), offset))
+        entries.sort()
+        return cls(stride, times, time_offsets,
+                   array('q', (h for h, _ in entries)), array('q', (offset for _, offset in entries)))
+
+    @classmethod
+    def load(cls, path):
+        """Read path.idx; None if it is missing or older than the capture file"""
+        name = path + '.idx'
+        if not os.path.exists(name) or os.path.getmtime(name) < os.path.getmtime(path):
+            return None
+        with open(name, 'rb') as f:
+            data = f.read()
+        magic, stride, n_times, n_ids = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{name} is not a capture index")
+        values = array('q')
+        values.frombytes(data[INDEX_HEADER.size:])
+        if sys.byteorder == 'little':
+            values.byteswap()
+        ids = values[2 * n_times:]
+        return cls(stride, values[0:2 * n_times:2], values[1:2 * n_times:2], ids[0::2], ids[1::2])
+
+    def save(self, path):
+        """Write path.idx"""
+        values = array('q')
+        for pair in zip(self.times, self.time_offsets):
+            values.extend(pair)
+        for pair in zip(self.id_hashes, self.id_offsets):
+            values.extend(pair)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        with open(path + '.idx', 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.stride, len(self.times), len(self.id_hashes)))
+            f.write(values.tobytes())
+
+    def offset_before(self, t_us):
+        """Offset of an indexed record no later than the first record at `t_us` (None: start of file)"""
+        i = bisect.bisect_left(self.times, t_us) - 1
+        return self.time_offsets[i] if i >= 0 else None
+
+    def offsets_of(self, message_id):
+        """Offsets of the PDUs naming `message_id`, in file order"""
+        h = message_id_hash(message_id)
+        i = bisect.bisect_left(self.id_hashes, h)
+        offsets = []
+        while i < len(self.id_hashes) and self.id_hashes[i] == h:
+            offsets.append(self.id_offsets[i])
+            i += 1
+        return sorted(offsets)
+
+
+def _first_time(path):
+    for _, t_us, _, _, _ in read_records(path):
+        return t_us
+    return None
+
+
+def select_records(path, start=None, end=None, message_id=None):
+    """Yield the records of a capture (every file) from `start` to `end` seconds after t=0
+
+    With `message_id` only the PDUs naming it are yielded. Each file's .idx
+    is used when it is up to date; otherwise the file is scanned.
+    """
+    start_us = None if start is None else int(start * 1e6)
+    end_us = None if end is None else int(end * 1e6)
+    files = capture_files(path)
+    for i, name in enumerate(files):
+        if start_us is not None and i + 1 < len(files):
+            following = _first_time(files[i + 1])
+            if following is not None and following <= start_us:
+                continue
+        index = CaptureIndex.load(name)
+        if message_id is not None:
+            if index is None:
+                index = CaptureIndex.build(name)
+            with open(name, 'rb') as f:
+                for offset in index.offsets_of(message_id):
+                    f.seek(offset)
+                    length, t_us, session_id, direction = CAPTURE_RECORD.unpack(f.read(CAPTURE_RECORD.size))
+                    if (start_us is None or t_us >= start_us) and (end_us is None or t_us <= end_us):
+                        yield offset, t_us, session_id, direction, f.read(length)
+            continue
+        offset = index.offset_before(start_us) if index is not None and start_us is not None else None
+        for record in read_records(name, offset):
+            t_us = record[1]
+            if start_us is not None and t_us < start_us:
+                continue
+            if end_us is not None and t_us > end_us:
+                return
+            yield record
+
+
+def describe_record(record):
+    """One line for `dump`"""
+    offset, t_us, session_id, direction, pdu = record
+    length, cmd, status, seq = PDU_HEADER.unpack_from(pdu)
+    line = (f"{t_us / 1e6:14.6f}  s{session_id:<6d} {'in ' if direction == CAPTURE_IN else 'out'} "
+            f"{COMMAND_NAMES.get(cmd, f'0x{cmd:08x}'):22s} seq={seq} len={length}")
+    if status:
+        line += f" status=0x{status:08x}"
+    if cmd in (SUBMIT_SM_RESP, QUERY_SM, QUERY_SM_RESP):
+        message_id = pdu[16:].split(b'\x00', 1)[0]
+        line += f" id={message_id.decode('latin-1')}"
+    elif cmd == DELIVER_SM:
+        match = _RECEIPT_ID.search(pdu, 16)
+        if match:
+            line += f" id={match.group(1).decode('latin-1')}"
+    return line
+
+
+class ReplayConnection:
+    """One captured session replayed over its own connection; answers the server live."""
+
+    def __init__(self, reader, writer, received):
+        self.writer = writer
+        self.received = received
+        self.acked = 0
+        self._ack_waiter = None
+        self.task = asyncio.ensure_future(self._receive(reader))
+
+    async def _receive(self, reader):
+        writer = self.writer
+        try:
+            while True:
+                header = await reader.readexactly(16)
+                length, cmd, status, seq = PDU_HEADER.unpack(header)
+                if length > 16:
+                    await reader.readexactly(length - 16)
+                self.received[cmd] += 1
+                if cmd == DELIVER_SM:
+                    writer.write(PDU_HEADER.pack(16, DELIVER_SM_RESP, ESME_ROK, seq))
+                    self.acked += 1
+                    self._wake(self.acked)
+                elif cmd == ENQUIRE_LINK:
+                    writer.write(PDU_HEADER.pack(16, ENQUIRE_LINK_RESP, ESME_ROK, seq))
+                elif cmd == UNBIND:
+                    writer.write(PDU_HEADER.pack(16, UNBIND_RESP, ESME_ROK, seq))
+                    return
+                elif cmd == UNBIND_RESP:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            self._wake(None)
+
+    def _wake(self, acked):
+        waiter = self._ack_waiter
+        if waiter is not None and (acked is None or acked >= waiter[0]) and not waiter[1].done():
+            waiter[1].set_result(None)
+
+    async def wait_acked(self, count, timeout):
+        """Wait until `count` deliver_sm have been answered; False on timeout or a closed connection"""
+        if self.acked < count and not self.task.done():
+            self._ack_waiter = (count, asyncio.get_running_loop().create_future())
+            try:
+                await asyncio.wait_for(self._ack_waiter[1], timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._ack_waiter = None
+        if self.acked >= count:
+            # The acks are written before whatever is sent next.
+            await self.writer.drain()
+            return True
+        return False
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+async def replay(records, host, port, speed=1.0, linger=2.0):
+    """Send the ESME side of `records` to host:port; return a summary dict
+
+    Each captured session gets its own connection, opened when its first
+    PDU is due. A PDU is sent at its captured time after the first one,
+    divided by `speed` (0 = as fast as possible). Captured responses
+    (deliver_sm_resp, enquire_link_resp, ...) are not sent: the server's
+    own deliver_sm, enquire_link and unbind are answered live instead, as
+    their sequence numbers will differ. A captured unbind waits (up to
+    `linger` seconds) until the session has answered as many deliver_sm as
+    the capture had answered by then, so the server sees those acks before
+    it closes the session. Sessions that did not unbind get `linger`
+    seconds for late receipts before they are closed.
+    """
+    loop = asyncio.get_running_loop()
+    connections = {}
+    received = Counter()
+    acks = Counter()
+    sent = skipped = unacked = 0
+    max_lag = 0.0
+    first = started = None
+    try:
+        for _, t_us, session_id, direction, pdu in records:
+            if direction != CAPTURE_IN:
+                continue
+            cmd = PDU_HEADER.unpack_from(pdu)[1]
+            if cmd & 0x80000000:
+                if cmd == DELIVER_SM_RESP:
+                    acks[session_id] += 1
+                skipped += 1
+                continue
+            if first is None:
+                first, started = t_us, loop.time()
+            if speed > 0:
+                delay = started + (t_us - first) / 1e6 / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+            connection = connections.get(session_id)
+            if connection is None:
+                reader, writer = await asyncio.open_connection(host, port)
+                connection = connections[session_id] = ReplayConnection(reader, writer, received)
+            if cmd == UNBIND and not await connection.wait_acked(acks[session_id], linger):
+                unacked += 1
+            connection.writer.write(pdu)
+            sent += 1
+            if connection.writer.transport.get_write_buffer_size() > 65536:
+                await connection.writer.drain()
+        if connections:
+            await asyncio.wait([connection.task for connection in connections.values()], timeout=linger)
+    finally:
+        for connection in connections.values():
+            connection.close()
+    return {
+        'sessions': len(connections),
+        'sent': sent,
+        'skipped_responses': skipped,
+        'unbinds_before_acks': unacked,
+        'received': {COMMAND_NAMES.get(cmd, f'0x{cmd:08x}'): count for cmd, count in received.items()},
+        'elapsed': round(loop.time() - started, 3) if started is not None else 0.0,
+        'max_lag_ms': round(max_lag * 1e3, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_selection(command):
+        command.add_argument('capture', help='Capture file (its .1, .2, ... continuations are read too)')
+        command.add_argument('--from', dest='start', type=float, default=None,
+                             help='Seconds after the start of the capture')
+        command.add_argument('--to', dest='end', type=float, default=None,
+                             help='Seconds after the start of the capture')
+        command.add_argument('--message-id', default=None,
+                             help='Only the PDUs naming this message_id')
+
+    index = commands.add_parser('index', help='Write a .idx next to every file of a capture')
+    index.add_argument('capture')
+    index.add_argument('--stride', type=int, default=1024, help='Index the time of every Nth record')
+    add_selection(commands.add_parser('dump', help='Print the selected PDUs, one per line'))
+    slicer = commands.add_parser('slice', help='Copy the selected PDUs to a new capture file')
+    add_selection(slicer)
+    slicer.add_argument('-o', '--output', required=True, help='Capture file to write')
+    player = commands.add_parser('replay', help='Send the ESME side of a capture to an SMSC')
+    add_selection(player)
+    player.add_argument('--host', default='127.0.0.1', help='SMSC host')
+    player.add_argument('--port', type=int, default=2776, help='SMSC port')
+    player.add_argument('--speed', type=float, default=1.0,
+                        help='Replay N times faster than captured (0 = as fast as possible)')
+    player.add_argument('--linger', type=float, default=2.0,
+                        help='Seconds to wait for late receipts after the last PDU')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        for name in capture_files(args.capture):
+            built = CaptureIndex.build(name, args.stride)
+            built.save(name)
+            print(f"{name}.idx: {len(built.times)} time entries, {len(built.id_hashes)} message_id entries")
+        return
+
+    records = select_records(args.capture, args.start, args.end, args.message_id)
+    if args.command == 'dump':
+        for record in records:
+            print(describe_record(record))
+    elif args.command == 'slice':
+        count = write_capture(args.output, records, read_epoch(args.capture))
+        print(f"{count} records written to {args.output}")
+    else:
+        print(json.dumps(asyncio.run(replay(records, args.host, args.port, args.speed, args.linger)),
+                         indent=2))
+
+
+if __name__ == '__main__':
+    main()
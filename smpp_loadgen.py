@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+SMPP load generator for FakeSMSC
+
+Opens N transceiver binds, keeps a window of outstanding submit_sm per bind,
+acknowledges every DLR with deliver_sm_resp and reports throughput,
+submit_sm_resp / DLR latency percentiles and DLR correctness.
+
+    python smpp_loadgen.py --in-process --binds 8 --window 32 --messages 5000
+    python smpp_loadgen.py --host 127.0.0.1 --port 2776 --seed-redis
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import struct
+import sys
+import time
+
+import fake_smsc
+from fake_smsc import (
+    BIND_TRANSCEIVER,
+    BIND_TRANSCEIVER_RESP,
+    DELIVER_SM,
+    DELIVER_SM_RESP,
+    ENQUIRE_LINK,
+    ENQUIRE_LINK_RESP,
+    ESME_ROK,
+    PDU_HEADER,
+    SUBMIT_SM,
+    SUBMIT_SM_RESP,
+    UNBIND,
+    UNBIND_RESP,
+    FakeSMSC,
+)
+
+_RECEIPT = re.compile(rb'id:(\S+) .*stat:(\w+)')
+
+
+class MemoryRedis:
+    """Just enough of redis.asyncio.Redis for the activation lookup path."""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    """MGET + PTTL pipeline used when the activation cache is on (keys never expire)."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def mget(self, keys):
+        self.commands.append(('mget', list(keys)))
+        return self
+
+    def pttl(self, key):
+        self.commands.append(('pttl', key))
+        return self
+
+    async def execute(self):
+        store = self.client.store
+        results = [
+            [store.get(key) for key in arg] if name == 'mget'
+            else (-1 if arg in store else -2)
+            for name, arg in self.commands
+        ]
+        self.commands = []
+        return results
+
+
+def cstring(value):
+    return value.encode('latin-1') + b'\x00'
+
+
+def build_bind(seq, system_id='loadgen', password='loadgen'):
+    body = cstring(system_id) + cstring(password) + cstring('') + b'\x34\x00\x00' + cstring('')
+    return PDU_HEADER.pack(16 + len(body), BIND_TRANSCEIVER, ESME_ROK, seq) + body
+
+
+def build_submit_sm(seq, source, dest, message=b'loadgen', registered_delivery=1):
+    body = cstring('') + b'\x05\x00' + cstring(source) + b'\x01\x01' + cstring(dest)
+    body += b'\x00\x00\x00' + cstring('') + cstring('')
+    body += struct.pack('BBBBB', registered_delivery, 0, 0, 0, len(message)) + message
+    return PDU_HEADER.pack(16 + len(body), SUBMIT_SM, ESME_ROK, seq) + body
+
+
+def make_numbers(count, active_ratio, seed=None):
+    """Return (numbers, active set): `active_ratio` of them have an activation."""
+    rng = random.Random(seed)
+    numbers = [f'59399{i:07d}' for i in range(count)]
+    active = set(rng.sample(numbers, round(count * active_ratio)))
+    return numbers, active
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class LoadResult:
+    """Counters and latency samples collected across all binds."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.responses = 0
+        self.errors = 0
+        self.dlrs = 0
+        self.dlr_correct = 0
+        self.dlr_wrong = 0
+        self.dlr_unknown = 0
+        self.stats = {}
+        self.submit_latencies = []
+        self.dlr_latencies = []
+        self.elapsed = 0.0
+
+    def summary(self):
+        submit = sorted(self.submit_latencies)
+        dlr = sorted(self.dlr_latencies)
+        elapsed = self.elapsed or 1e-9
+        return {
+            'submitted': self.submitted,
+            'responses': self.responses,
+            'errors': self.errors,
+            'dlrs': self.dlrs,
+            'dlr_correct': self.dlr_correct,
+            'dlr_wrong': self.dlr_wrong,
+            'dlr_unknown': self.dlr_unknown,
+            'dlr_stats': dict(self.stats),
+            'elapsed': round(self.elapsed, 3),
+            'submit_rate': round(self.responses / elapsed, 1),
+            'dlr_rate': round(self.dlrs / elapsed, 1),
+            'submit_resp_ms': {
+                name: round(percentile(submit, q) * 1e3, 3)
+                for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+            },
+            'dlr_ms': {
+                name: round(percentile(dlr, q) * 1e3, 3)
+                for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+            },
+        }
+
+
+class LoadBind:
+    """One transceiver bind driving `messages` submit_sm with a send window."""
+
+    def __init__(self, host, port, result, numbers, active, messages, window=1,
+                 source='LOADGEN', expect_dlr=True, system_id='loadgen', rng=None):
+        self.host = host
+        self.port = port
+        self.result = result
+        self.numbers = numbers
+        self.active = active
+        self.messages = messages
+        self.window = window
+        self.source = source
+        self.expect_dlr = expect_dlr
+        self.system_id = system_id
+        self.rng = rng or random.Random()
+        self.sequence = 1
+        self.in_flight = {}         # seq -> (sent_at, dest)
+        self.awaiting_dlr = {}      # message_id -> (sent_at, destination active?)
+        self.responded = 0
+        self.received_dlrs = 0
+        self._slots = None
+        self._done = None
+        self._unbound = None
+
+    def _next_sequence(self):
+        self.sequence += 1
+        return self.sequence
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.window)
+        self._done = loop.create_future()
+        self._unbound = loop.create_future()
+        writer.write(build_bind(1, self.system_id))
+        header = await reader.readexactly(16)
+        length, cmd, status, _ = PDU_HEADER.unpack(header)
+        await reader.readexactly(length - 16)
+        if cmd != BIND_TRANSCEIVER_RESP or status != ESME_ROK:
+            raise RuntimeError(f'bind failed: cmd=0x{cmd:08x} status=0x{status:08x}')
+
+        receiver = asyncio.ensure_future(self._receive(reader, writer))
+        try:
+            for _ in range(self.messages):
+                await self._slots.acquire()
+                dest = self.rng.choice(self.numbers)
+                seq = self._next_sequence()
+                self.in_flight[seq] = (time.perf_counter(), dest)
+                writer.write(build_submit_sm(seq, self.source, dest,
+                                             registered_delivery=int(self.expect_dlr)))
+                self.result.submitted += 1
+                await writer.drain()
+            if self.messages:
+                await self._done
+            writer.write(PDU_HEADER.pack(16, UNBIND, ESME_ROK, self._next_sequence()))
+            await asyncio.wait_for(self._unbound, 5)
+        finally:
+            receiver.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def _check_done(self):
+        if self.responded == self.messages and (
+                not self.expect_dlr or self.received_dlrs == self.messages):
+            if not self._done.done():
+                self._done.set_result(None)
+
+    async def _receive(self, reader, writer):
+        result = self.result
+        while True:
+            header = await reader.readexactly(16)
+            length, cmd, status, seq = PDU_HEADER.unpack(header)
+            body = await reader.readexactly(length - 16) if length > 16 else b''
+            now = time.perf_counter()
+
+            if cmd == SUBMIT_SM_RESP:
+                sent_at, dest = self.in_flight.pop(seq)
+                result.submit_latencies.append(now - sent_at)
+                result.responses += 1
+                self.responded += 1
+                self._slots.release()
+                if status != ESME_ROK:
+                    result.errors += 1
+                    if self.expect_dlr:
+                        self.received_dlrs += 1     # no receipt will follow
+                elif self.expect_dlr:
+                    message_id = body.split(b'\x00', 1)[0]
+                    active = dest in self.active if self.active is not None else None
+                    self.awaiting_dlr[message_id] = (sent_at, active)
+                self._check_done()
+
+            elif cmd == DELIVER_SM:
+                writer.write(PDU_HEADER.pack(16, DELIVER_SM_RESP, ESME_ROK, seq))
+                match = _RECEIPT.search(body)
+                pending = self.awaiting_dlr.pop(match.group(1), None) if match else None
+                if pending is None:
+                    result.dlr_unknown += 1
+                    continue
+                sent_at, active = pending
+                stat = match.group(2).decode('latin-1')
+                result.dlr_latencies.append(now - sent_at)
+                result.dlrs += 1
+                result.stats[stat] = result.stats.get(stat, 0) + 1
+                # Inactive destinations must get REJECTD; active ones anything
+                # else (DELIVRD, or whatever a --dlr-profile outcome mix says).
+                if active is None or (stat != 'REJECTD') == active:
+                    result.dlr_correct += 1
+                else:
+                    result.dlr_wrong += 1
+                self.received_dlrs += 1
+                self._check_done()
+
+            elif cmd == ENQUIRE_LINK:
+                writer.write(PDU_HEADER.pack(16, ENQUIRE_LINK_RESP, ESME_ROK, seq))
+
+            elif cmd == UNBIND_RESP:
+                if not self._unbound.done():
+                    self._unbound.set_result(None)
+                return
+
+
+async def run_load(host, port, binds=4, window=16, messages=1000, numbers=1000,
+                   active_ratio=0.5, expect_dlr=True, check=True, seed=None):
+    """Drive `binds` concurrent LoadBinds against host:port; return a LoadResult.
+
+    With `check` the expected stat of every receipt is derived from which
+    numbers were generated as active (the target must use the same set).
+    """
+    pool, active = make_numbers(numbers, active_ratio, seed)
+    result = LoadResult()
+    rng = random.Random(seed)
+    workers = [
+        LoadBind(host, port, result, pool, active if check else None, messages,
+                 window=window, expect_dlr=expect_dlr, system_id=f'loadgen{i}',
+                 rng=random.Random(rng.random()))
+        for i in range(binds)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*(worker.run() for worker in workers))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def run_in_process(binds=4, window=16, messages=1000, numbers=1000, active_ratio=0.5,
+                         expect_dlr=True, seed=None, **smsc_options):
+    """Run the load against an in-process FakeSMSC backed by MemoryRedis.
+
+    Returns (LoadResult, server stats) - the regression suite for the PDU and
+    DLR paths, independent of a real Redis.
+    """
+    if seed is None:
+        seed = random.randrange(1 << 30)
+    _, active = make_numbers(numbers, active_ratio, seed)
+    fake_smsc.rc_client = MemoryRedis({f'dlr:block:{number}': b'1' for number in active})
+    options = dict(dlr_delay=0, dlr_resolution=0.001)
+    options.update(smsc_options)
+    smsc = FakeSMSC(host='127.0.0.1', port=0, **options)
+    server = asyncio.ensure_future(smsc.run())
+    while smsc.server is None:
+        await asyncio.sleep(0.01)
+    port = smsc.server.sockets[0].getsockname()[1]
+    try:
+        result = await run_load('127.0.0.1', port, binds, window, messages, numbers,
+                                active_ratio, expect_dlr, seed=seed)
+    finally:
+        smsc._signal_handler()
+        await server
+    return result, smsc.stats()
+
+
+async def seed_redis(numbers, active, ttl=1200):
+    """Create dlr:block keys for the active numbers on the configured Redis."""
+    client = fake_smsc.make_redis_client()
+    pipe = client.pipeline(transaction=False)
+    for number in numbers:
+        key = f'dlr:block:{number}'
+        if number in active:
+            pipe.set(key, b'1', ex=ttl)
+        else:
+            pipe.delete(key)
+    await pipe.execute()
+    await client.aclose()
+
+
+def format_report(summary):
+    submit, dlr = summary['submit_resp_ms'], summary['dlr_ms']
+    lines = [
+        f"submitted {summary['submitted']}  responses {summary['responses']}  "
+        f"errors {summary['errors']}  in {summary['elapsed']:.2f}s",
+        f"throughput  {summary['submit_rate']:.0f} submit_sm/s  {summary['dlr_rate']:.0f} DLR/s",
+        f"submit_resp p50 {submit['p50']:.2f} ms  p95 {submit['p95']:.2f} ms  p99 {submit['p99']:.2f} ms",
+        f"DLR         p50 {dlr['p50']:.2f} ms  p95 {dlr['p95']:.2f} ms  p99 {dlr['p99']:.2f} ms",
+        f"DLRs {summary['dlrs']} {summary['dlr_stats']}  correct {summary['dlr_correct']}  "
+        f"wrong {summary['dlr_wrong']}  unknown {summary['dlr_unknown']}",
+    ]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMPP load generator for FakeSMSC')
+    parser.add_argument('--host', default='127.0.0.1', help='SMSC host')
+    parser.add_argument('--port', type=int, default=2776, help='SMSC port')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Start a FakeSMSC with an in-memory Redis in this process')
+    parser.add_argument('--binds', type=int, default=4, help='Concurrent transceiver binds')
+    parser.add_argument('--window', type=int, default=16, help='Outstanding submit_sm per bind')
+    parser.add_argument('--messages', type=int, default=1000, help='submit_sm per bind')
+    parser.add_argument('--numbers', type=int, default=1000, help='Distinct destination numbers')
+    parser.add_argument('--active-ratio', type=float, default=0.5,
+                        help='Share of destinations with an active activation')
+    parser.add_argument('--no-dlr', action='store_true', help='Send registered_delivery=0')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for numbers and picks')
+    parser.add_argument('--seed-redis', action='store_true',
+                        help='Write/delete dlr:block keys on REDIS_HOST before the run')
+    parser.add_argument('--dlr-delay', type=float, default=0,
+                        help='DLR delay of the in-process server')
+    parser.add_argument('--transport', choices=('stream', 'buffered'), default='stream',
+                        help='Transport of the in-process server')
+    parser.add_argument('--dlr-profile', default=None,
+                        help='DLR profile JSON for the in-process server (see fake_smsc.DLRProfiles)')
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop', 'auto'), default='auto',
+                        help='Event loop implementation')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+    logging.getLogger('fake_smsc').setLevel(logging.ERROR)
+    fake_smsc.install_event_loop(args.loop)
+
+    if args.in_process:
+        result, server_stats = asyncio.run(run_in_process(
+            args.binds, args.window, args.messages, args.numbers, args.active_ratio,
+            not args.no_dlr, seed=args.seed, dlr_delay=args.dlr_delay,
+            transport=args.transport, dlr_profile=args.dlr_profile))
+    else:
+        if args.seed_redis:
+            # The run must regenerate the same active set it seeded.
+            if args.seed is None:
+                args.seed = random.randrange(1 << 30)
+            pool, active = make_numbers(args.numbers, args.active_ratio, args.seed)
+            asyncio.run(seed_redis(pool, active))
+        result = asyncio.run(run_load(
+            args.host, args.port, args.binds, args.window, args.messages, args.numbers,
+            args.active_ratio, not args.no_dlr, check=args.seed_redis, seed=args.seed))
+        server_stats = None
+
+    summary = result.summary()
+    if args.json:
+        if server_stats is not None:
+            summary['server'] = server_stats
+        print(json.dumps(summary, indent=2))
+    else:
+        print(format_report(summary))
+    sys.exit(1 if summary['dlr_wrong'] or summary['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,54 @@ active activation (Redis key `dlr:block:{number}`) gets a DELIVRD DLR; otherwise
 REJECTD. On a Redis error the harness fails open (DELIVRD).
 """
 import asyncio
+import json
+import logging
 import struct
 import re
+import sys
+import time
 
 import fake_smsc
 from fake_smsc import (
+    ActivationCache,
+    ActivationLookupBatcher,
+    DelayDistribution,
+    DLREncoder,
+    DLRProfiles,
+    DLRScheduler,
+    FakeSMSC,
+    Histogram,
+    MessageIdGenerator,
+    MessageStateIndex,
+    Metrics,
+    OutcomeMix,
+    PDUFramer,
+    PDUFramingError,
+    PendingDLR,
+    RedisCircuitBreaker,
+    RedisDLRStore,
+    SegmentReassembler,
+    SessionRegistry,
+    SubmitThrottle,
+    SMPPBufferedProtocol,
+    JsonLogFormatter,
+    LogSampler,
+    SubmitSM,
+    configure_logging,
+    install_event_loop,
+    merge_stats,
+    render_metrics,
     SMPPSession,
     normalize_msisdn,
+    parse_injection,
     BIND_TRANSCEIVER,
     BIND_TRANSCEIVER_RESP,
     SUBMIT_SM,
     SUBMIT_SM_RESP,
     DELIVER_SM,
     DELIVER_SM_RESP,
+    UNBIND,
+    UNBIND_RESP,
 )
 
 
@@ -27,12 +62,62 @@ class FakeRedis:
     def __init__(self, store=None, raise_error=False):
         self.store = store or {}
         self.raise_error = raise_error
+        self.calls = []
 
     async def get(self, key):
+        self.calls.append(("get", key))
         if self.raise_error:
             raise ConnectionError("redis down")
         return self.store.get(key)
 
+    async def mget(self, keys):
+        self.calls.append(("mget", list(keys)))
+        if self.raise_error:
+            raise ConnectionError("redis down")
+        return [self.store.get(k) for k in keys]
+
+    async def ping(self):
+        self.calls.append(("ping",))
+        if self.raise_error:
+            raise ConnectionError("redis down")
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Queues mget/pttl and answers them in one execute(), like redis-py."""
+
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def mget(self, keys):
+        self.ops.append(("mget", list(keys)))
+
+    def pttl(self, key):
+        self.ops.append(("pttl", key))
+
+    async def execute(self):
+        self.client.calls.append(("pipeline", [op for op, _ in self.ops]))
+        if self.client.raise_error:
+            raise ConnectionError("redis down")
+        ttls = getattr(self.client, "ttls", {})
+        replies = []
+        for op, arg in self.ops:
+            if op == "mget":
+                replies.append([self.client.store.get(k) for k in arg])
+            elif arg not in self.client.store:
+                replies.append(-2)
+            else:
+                replies.append(ttls.get(arg, -1))
+        # Lets a test change things while the round trip is "in flight".
+        on_reply = getattr(self.client, "on_reply", None)
+        if on_reply is not None:
+            on_reply()
+        return replies
+
 
 def _cstring(s):
     if isinstance(s, str):
@@ -46,23 +131,31 @@ def _build_bind():
     return struct.pack(">IIII", 16 + len(body), BIND_TRANSCEIVER, 0, 1) + body
 
 
-def _build_submit_sm(source, dest, message, registered_delivery=1, seq=2):
+def _build_submit_sm(source, dest, message, registered_delivery=1, seq=2,
+                     esm_class=0, tlvs=b""):
     body = b""
     body += _cstring("")                      # service_type
     body += struct.pack("BB", 0, 0)           # source ton/npi
     body += _cstring(source)
     body += struct.pack("BB", 1, 1)           # dest ton/npi
     body += _cstring(dest)
-    body += struct.pack("BBB", 0, 0, 0)       # esm_class, protocol_id, priority
+    body += struct.pack("BBB", esm_class, 0, 0)  # esm_class, protocol_id, priority
     body += _cstring("")                      # schedule_delivery_time
     body += _cstring("")                      # validity_period
     body += struct.pack(
         "BBBBB", registered_delivery, 0, 0, 0, len(message)
     )
-    body += message.encode("latin-1")
+    body += message.encode("latin-1") if isinstance(message, str) else message
+    body += tlvs
     return struct.pack(">IIII", 16 + len(body), SUBMIT_SM, 0, seq) + body
 
 
+def _tlv(tag, value, size=None):
+    if isinstance(value, int):
+        value = value.to_bytes(size, "big")
+    return struct.pack(">HH", tag, len(value)) + value
+
+
 async def _read_pdu(reader):
     header = await reader.readexactly(16)
     length, cmd, status, seq = struct.unpack(">IIII", header)
@@ -71,12 +164,13 @@ async def _read_pdu(reader):
 
 
 async def _run_submit_scenario(store=None, raise_error=False, registered_delivery=1,
-                               source="NETFLIX", dest="593996844442", timeout=2.0):
+                               source="NETFLIX", dest="593996844442", timeout=2.0,
+                               lookup=None, profiles=None):
     """Drive a real SMPPSession over a socket; return the DLR stat string or None."""
     fake_smsc.rc_client = FakeRedis(store=store, raise_error=raise_error)
 
     server = await asyncio.start_server(
-        lambda r, w: SMPPSession(r, w, dlr_delay=0).handle(),
+        lambda r, w: SMPPSession(r, w, dlr_delay=0, lookup=lookup, profiles=profiles).handle(),
         "127.0.0.1", 0,
     )
     port = server.sockets[0].getsockname()[1]
@@ -164,3 +258,1713 @@ def test_no_dlr_when_not_requested():
     stat = asyncio.run(_run_submit_scenario(
         store={"dlr:block:593996844442": b"1"}, registered_delivery=0))
     assert stat is None
+
+
+# --------------------------------------------------------------------------- #
+# batched lookups
+
+def test_batched_lookups_share_one_mget():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:1": b"1"})
+        batcher = ActivationLookupBatcher(window=0.01, max_batch=100)
+        keys = ["dlr:block:1", "dlr:block:2", "dlr:block:1"] * 10
+        results = await asyncio.gather(*(batcher.lookup(k) for k in keys))
+        return results, fake_smsc.rc_client.calls
+
+    results, calls = asyncio.run(scenario())
+    assert results == [True, False, True] * 10
+    assert calls == [("mget", ["dlr:block:1", "dlr:block:2"])]
+
+
+def test_batch_flushes_early_at_max_size():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis()
+        batcher = ActivationLookupBatcher(window=60, max_batch=4)
+        results = await asyncio.wait_for(
+            asyncio.gather(*(batcher.lookup(f"dlr:block:{i}") for i in range(8))), 1)
+        return results, fake_smsc.rc_client.calls
+
+    results, calls = asyncio.run(scenario())
+    assert results == [False] * 8
+    assert [len(keys) for _, keys in calls] == [4, 4]
+
+
+def test_batched_fail_open_on_redis_error():
+    stat = asyncio.run(_run_submit_scenario(
+        raise_error=True, lookup=ActivationLookupBatcher()))
+    assert stat == "DELIVRD"
+
+
+def test_batched_lookup_keeps_gating_decision():
+    store = {"dlr:block:593996844442": b"1"}
+    assert asyncio.run(_run_submit_scenario(
+        store=store, lookup=ActivationLookupBatcher())) == "DELIVRD"
+    assert asyncio.run(_run_submit_scenario(
+        store=store, dest="593990000000", lookup=ActivationLookupBatcher())) == "REJECTD"
+
+
+def test_pending_lookups_do_not_hold_up_the_read_loop():
+    async def scenario():
+        store = {"dlr:block:593990000001": b"1", "dlr:block:593990000003": b"1"}
+        fake_smsc.rc_client = FakeRedis(store=store)
+        # A window long enough that a read loop awaiting each lookup would
+        # take a second for the five submits.
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                        redis_batch_window=0.2, cache_size=0)
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.server is None:
+            await asyncio.sleep(0.01)
+        port = smsc.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind())
+        await _read_pdu(reader)
+        started = time.perf_counter()
+        for i in range(5):
+            writer.write(_build_submit_sm("NETFLIX", f"59399000000{i}", "hi", seq=2 + i))
+        message_ids, receipts = [], []
+        while len(receipts) < 5:
+            cmd, _, seq, body = await asyncio.wait_for(_read_pdu(reader), 2)
+            if cmd == SUBMIT_SM_RESP:
+                message_ids.append(body.rstrip(b"\x00").decode())
+                if len(message_ids) == 5:
+                    answered = time.perf_counter() - started
+            elif cmd == DELIVER_SM:
+                receipt = re.search(rb"id:(\S+) .* stat:(\w+)", body)
+                receipts.append((receipt.group(1).decode(), receipt.group(2).decode()))
+                writer.write(struct.pack(">IIII", 16, DELIVER_SM_RESP, 0, seq))
+        writer.write(struct.pack(">IIII", 16, UNBIND, 0, 99))
+        await asyncio.wait_for(_read_pdu(reader), 2)
+        writer.close()
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+        smsc._signal_handler()
+        await server
+        return answered, message_ids, receipts, fake_smsc.rc_client.calls
+
+    answered, message_ids, receipts, calls = asyncio.run(scenario())
+    assert answered < 0.15
+    assert [call[0] for call in calls] == ["mget"] and len(calls[0][1]) == 5
+    # Outcomes are applied in submit order, so the receipts follow it too.
+    assert [message_id for message_id, _ in receipts] == message_ids
+    assert [stat for _, stat in receipts] == ["REJECTD", "DELIVRD", "REJECTD", "DELIVRD", "REJECTD"]
+
+
+def test_circuit_opens_after_consecutive_errors_and_probe_closes_it():
+    async def scenario():
+        redis_down = FakeRedis(raise_error=True)
+        fake_smsc.rc_client = redis_down
+        breaker = RedisCircuitBreaker(threshold=2, probe_interval=0.01)
+        batcher = ActivationLookupBatcher(window=0, breaker=breaker)
+        assert await batcher.lookup("dlr:block:1") is True
+        assert await batcher.lookup("dlr:block:1") is True
+        assert breaker.is_open
+        calls = len(redis_down.calls)
+        # Open circuit: fail open straight away, Redis only sees probes.
+        assert await batcher.lookup("dlr:block:1") is True
+        assert [c for c in redis_down.calls[calls:] if c[0] != "ping"] == []
+        redis_down.raise_error = False
+        await asyncio.sleep(0.05)
+        assert not breaker.is_open
+        assert await batcher.lookup("dlr:block:1") is False
+        breaker.close()
+        return breaker.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats == {"open": 0, "opens": 1, "short_circuited": 1}
+
+
+# --------------------------------------------------------------------------- #
+# activation cache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_serves_repeat_lookups_without_redis():
+    async def scenario():
+        client = FakeRedis(store={"dlr:block:1": b"1"})
+        client.ttls = {"dlr:block:1": 60000}
+        fake_smsc.rc_client = client
+        cache = ActivationCache(max_size=10, negative_ttl=5)
+        cache.live = True
+        batcher = ActivationLookupBatcher(cache=cache)
+        first = await asyncio.gather(batcher.lookup("dlr:block:1"), batcher.lookup("dlr:block:2"))
+        second = await asyncio.gather(batcher.lookup("dlr:block:1"), batcher.lookup("dlr:block:2"))
+        return first, second, client.calls, cache.stats()
+
+    first, second, calls, stats = asyncio.run(scenario())
+    assert first == second == [True, False]
+    assert calls == [("pipeline", ["mget", "pttl", "pttl"])]
+    assert stats["hits"] == 2 and stats["misses"] == 2
+
+
+def test_cache_positive_entry_follows_key_ttl():
+    clock = FakeClock()
+    cache = ActivationCache(negative_ttl=1, clock=clock)
+    cache.live = True
+    cache.put("dlr:block:1", True, pttl=30000)
+    cache.put("dlr:block:2", False)
+    clock.now += 2
+    assert cache.get("dlr:block:1") is True
+    assert cache.get("dlr:block:2") is None
+    clock.now += 29
+    assert cache.get("dlr:block:1") is None
+
+
+def test_cache_caps_positive_ttl_until_notifications_are_live():
+    clock = FakeClock()
+    cache = ActivationCache(negative_ttl=1, clock=clock)
+    cache.put("dlr:block:1", True, pttl=30000)
+    clock.now += 2
+    assert cache.get("dlr:block:1") is None
+
+
+def test_cache_lru_eviction_and_invalidation():
+    cache = ActivationCache(max_size=2, negative_ttl=60)
+    cache.put("a", False)
+    cache.put("b", False)
+    cache.get("a")
+    cache.put("c", False)
+    assert cache.get("b") is None
+    assert cache.get("a") is False
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["invalidations"] == 1 and stats["size"] == 1
+
+
+def test_cache_does_not_store_fail_open_results():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(raise_error=True)
+        cache = ActivationCache()
+        batcher = ActivationLookupBatcher(cache=cache)
+        assert await batcher.lookup("dlr:block:1") is True
+        return cache.stats()["size"]
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_cache_drops_lookups_that_raced_an_invalidation():
+    async def scenario():
+        client = FakeRedis(store={"dlr:block:1": b"1", "dlr:block:2": b"1"})
+        client.ttls = {"dlr:block:1": 60000, "dlr:block:2": 60000}
+        fake_smsc.rc_client = client
+        cache = ActivationCache(negative_ttl=5)
+        cache.live = True
+        batcher = ActivationLookupBatcher(cache=cache)
+        # The DEL notification for key 1 lands before the MGET reply.
+        client.on_reply = lambda: cache._on_invalidation(
+            {"type": "pmessage", "channel": b"__keyspace@0__:dlr:block:1", "data": b"del"})
+        first = await asyncio.gather(batcher.lookup("dlr:block:1"), batcher.lookup("dlr:block:2"))
+        cached = cache.get("dlr:block:1"), cache.get("dlr:block:2")
+        # A FLUSHALL (nil invalidation) voids every lookup in flight.
+        client.on_reply = cache.clear
+        third = await batcher.lookup("dlr:block:3")
+        return first, cached, third, cache
+
+    first, cached, third, cache = asyncio.run(scenario())
+    assert first == [True, True] and third is False
+    assert cached == (None, True)
+    assert cache.stats()["stale_fills"] == 2 and cache.stats()["size"] == 0
+    assert cache._fills == {}
+
+
+def test_cache_applies_client_tracking_invalidations():
+    cache = ActivationCache(negative_ttl=60)
+    for key in ("dlr:block:1", "dlr:block:2", "dlr:block:3"):
+        cache.put(key, False)
+    cache._on_invalidation({"type": "message", "channel": b"__redis__:invalidate",
+                            "data": [b"dlr:block:1"]})
+    assert cache.get("dlr:block:1") is None and cache.get("dlr:block:2") is False
+    cache._on_invalidation({"type": "pmessage", "channel": b"__keyspace@0__:dlr:block:2",
+                            "data": b"del"})
+    assert cache.get("dlr:block:2") is None
+    # FLUSHALL / FLUSHDB arrive as a nil key list.
+    cache._on_invalidation({"type": "message", "channel": b"__redis__:invalidate", "data": None})
+    assert cache.get("dlr:block:3") is None
+
+
+# --------------------------------------------------------------------------- #
+# DLR scheduler
+
+class RecordingSession:
+    system_id = "test"
+
+    def __init__(self):
+        self.batches = []
+
+    def send_dlrs(self, dlrs):
+        self.batches.append([d.message_id for d in dlrs])
+
+
+def test_scheduler_fires_due_bucket_grouped_by_session():
+    async def scenario():
+        scheduler = DLRScheduler(resolution=0.05)
+        a, b = RecordingSession(), RecordingSession()
+        for i, session in enumerate([a, b, a, b, a]):
+            scheduler.schedule(PendingDLR(session, "src", "dst", f"m{i}"), 0.05)
+        pending = scheduler.pending
+        await asyncio.sleep(0.3)
+        scheduler.close()
+        return pending, scheduler.stats(), a.batches, b.batches
+
+    pending, stats, a_batches, b_batches = asyncio.run(scenario())
+    assert pending == 5
+    assert stats["pending"] == 0 and stats["fired"] == 5
+    assert a_batches == [["m0", "m2", "m4"]]
+    assert b_batches == [["m1", "m3"]]
+    assert 0 <= stats["max_lag"] < 0.2
+
+
+def test_scheduler_respects_delay_ordering():
+    async def scenario():
+        scheduler = DLRScheduler(resolution=0.02)
+        session = RecordingSession()
+        scheduler.schedule(PendingDLR(session, "s", "d", "late"), 0.2)
+        scheduler.schedule(PendingDLR(session, "s", "d", "early"), 0.02)
+        await asyncio.sleep(0.1)
+        early = list(session.batches)
+        await asyncio.sleep(0.25)
+        scheduler.close()
+        return early, session.batches
+
+    early, final = asyncio.run(scenario())
+    assert early == [["early"]]
+    assert final == [["early"], ["late"]]
+
+
+# --------------------------------------------------------------------------- #
+# coalesced output
+
+class RecordingWriter:
+    transport = None
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return False
+
+
+def test_pdus_written_in_one_batch_share_one_socket_write():
+    async def scenario():
+        writer = RecordingWriter()
+        session = SMPPSession(None, writer)
+        for seq in range(1, 11):
+            session.write_pdu(fake_smsc.ENQUIRE_LINK_RESP, seq)
+        assert writer.writes == []
+        await asyncio.sleep(0)
+        return writer.writes
+
+    writes = asyncio.run(scenario())
+    assert len(writes) == 1
+    assert len(writes[0]) == 160
+    assert [struct.unpack_from(">IIII", writes[0], i)[3] for i in range(0, 160, 16)] == list(range(1, 11))
+
+
+def test_output_flushes_at_high_water_mark():
+    async def scenario():
+        writer = RecordingWriter()
+        session = SMPPSession(None, writer, write_high_water=64)
+        for seq in range(6):
+            session.write_pdu(fake_smsc.ENQUIRE_LINK_RESP, seq)
+        immediate = [len(w) for w in writer.writes]
+        await asyncio.sleep(0)
+        return immediate, [len(w) for w in writer.writes]
+
+    immediate, final = asyncio.run(scenario())
+    assert immediate == [64]
+    assert final == [64, 32]
+
+
+# --------------------------------------------------------------------------- #
+# deliver_sm window
+
+def _dlr_sequences(writer):
+    data = b"".join(writer.writes)
+    sequences, offset = [], 0
+    while offset < len(data):
+        length, cmd, _, seq = struct.unpack_from(">IIII", data, offset)
+        assert cmd == DELIVER_SM
+        sequences.append(seq)
+        offset += length
+    return sequences
+
+
+def test_dlr_window_queues_excess_until_resp_frees_a_slot():
+    async def scenario():
+        writer = RecordingWriter()
+        session = SMPPSession(None, writer, dlr_window=2)
+        session.send_dlrs([PendingDLR(session, "src", "dst", f"m{i}") for i in range(5)])
+        await asyncio.sleep(0)
+        first = _dlr_sequences(writer)
+        queued = len(session.dlr_queue)
+        session.dlr_acknowledged(first[0], fake_smsc.ESME_ROK)
+        await asyncio.sleep(0)
+        session._abandon_dlrs()
+        return first, queued, _dlr_sequences(writer), session.counters
+
+    first, queued, sent, counters = asyncio.run(scenario())
+    assert first == [1, 2]
+    assert queued == 3
+    assert sent == [1, 2, 3]
+    assert counters["dlr_acked"] == 1
+    assert counters["dlr_dropped"] == 4
+
+
+def test_unacknowledged_dlr_is_retried_with_backoff_then_expires():
+    async def scenario():
+        writer = RecordingWriter()
+        scheduler = DLRScheduler(resolution=0.01)
+        session = SMPPSession(None, writer, scheduler=scheduler, dlr_resp_timeout=0.05,
+                              dlr_retries=2, dlr_retry_backoff=0.02)
+        session.send_dlrs([PendingDLR(session, "src", "dst", "m0")])
+        await asyncio.sleep(0.5)
+        scheduler.close()
+        return _dlr_sequences(writer), session.counters, session.dlr_in_flight
+
+    sent, counters, in_flight = asyncio.run(scenario())
+    assert sent == [1, 2, 3]
+    assert counters["dlr_timeouts"] == 3
+    assert counters["dlr_retried"] == 2
+    assert counters["dlr_expired"] == 1
+    assert in_flight == {}
+
+
+def test_error_resp_retries_the_receipt():
+    async def scenario():
+        writer = RecordingWriter()
+        scheduler = DLRScheduler(resolution=0.01)
+        session = SMPPSession(None, writer, scheduler=scheduler, dlr_retry_backoff=0.01)
+        session.send_dlrs([PendingDLR(session, "src", "dst", "m0")])
+        await asyncio.sleep(0)
+        session.dlr_acknowledged(1, 0x58)
+        await asyncio.sleep(0.1)
+        session.dlr_acknowledged(2, fake_smsc.ESME_ROK)
+        scheduler.close()
+        return _dlr_sequences(writer), session.counters
+
+    sent, counters = asyncio.run(scenario())
+    assert sent == [1, 2]
+    assert counters["dlr_nacked"] == 1 and counters["dlr_acked"] == 1
+
+
+# --------------------------------------------------------------------------- #
+# pending DLR store
+
+def test_unacknowledged_dlr_is_handed_to_next_bind_of_same_system_id():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                        redis_batch_window=0, cache_size=0)
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.server is None:
+            await asyncio.sleep(0.01)
+        port = smsc.server.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind() + _build_submit_sm("NETFLIX", "593996844442", "hi"))
+        await _read_pdu(reader)
+        _, _, _, resp = await _read_pdu(reader)
+        cmd, _, _, first = await asyncio.wait_for(_read_pdu(reader), 2)
+        assert cmd == DELIVER_SM
+        writer.close()      # without a deliver_sm_resp
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind())
+        await _read_pdu(reader)
+        cmd, _, seq, second = await asyncio.wait_for(_read_pdu(reader), 2)
+        writer.write(struct.pack(">IIII", 16, DELIVER_SM_RESP, 0, seq))
+        await asyncio.sleep(0.05)
+        stats = smsc.stats()
+        writer.close()
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+        smsc._signal_handler()
+        await server
+        return resp, first, cmd, second, stats
+
+    resp, first, cmd, second, stats = asyncio.run(scenario())
+    message_id = resp.rstrip(b"\x00").decode()
+    assert cmd == DELIVER_SM
+    assert f"id:{message_id} ".encode() in first and f"id:{message_id} ".encode() in second
+    assert stats["dlr_store"]["handed_over"] == 1
+    assert stats["counters"]["dlr_acked"] == 1 and "dlr_dropped" not in stats["counters"]
+
+
+class FakeZSetRedis:
+    """Sorted sets and lease keys behind a pipeline, for RedisDLRStore."""
+
+    def __init__(self):
+        self.zsets = {}
+        self.strings = {}
+        self.pipelines = 0
+        self.fail = False
+
+    def pipeline(self, transaction=True):
+        return FakeZSetPipeline(self)
+
+    async def set(self, key, value, ex=None):
+        self.strings[key] = value
+
+    async def delete(self, key):
+        return int(self.strings.pop(key, None) is not None)
+
+    async def scan_iter(self, match):
+        import fnmatch
+
+        for key in list(self.zsets):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+
+class FakeZSetPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.ops.append((name, args, kwargs))
+
+    async def execute(self):
+        if self.client.fail:
+            raise ConnectionError("redis down")
+        self.client.pipelines += 1
+        zsets, strings, replies = self.client.zsets, self.client.strings, []
+        for name, args, kwargs in self.ops:
+            if name == "zadd":
+                zsets.setdefault(args[0], {}).update(args[1])
+                replies.append(len(args[1]))
+            elif name == "zrem":
+                replies.append(sum(zsets.get(args[0], {}).pop(m, None) is not None for m in args[1:]))
+            elif name == "zrange":
+                replies.append(sorted(zsets.get(args[0], {}).items(), key=lambda item: item[1]))
+            elif name == "delete":
+                replies.append(int(zsets.pop(args[0], None) is not None))
+            elif name == "set":
+                strings[args[0]] = args[1]
+                replies.append(True)
+            elif name == "exists":
+                replies.append(int(args[0] in strings))
+        return replies
+
+
+def _pending_ids(zsets):
+    return sorted(member.split("\x1f")[0] for zset in zsets.values() for member in zset)
+
+
+def test_redis_dlr_store_coalesces_updates_and_recovers_after_restart():
+    async def scenario():
+        fake_smsc.rc_client = redis = FakeZSetRedis()
+        store = RedisDLRStore(flush_interval=0.01)
+        dlrs = [PendingDLR(None, "src", "dst", f"m{i}", message_state=2) for i in range(3)]
+        for dlr in dlrs:
+            store.add("jasmin", dlr, 5.0)
+        store.remove("jasmin", dlrs[1])         # acked before the flush
+        await asyncio.sleep(0.05)
+        persisted = dict(redis.zsets)
+        await store.close()                     # a clean stop gives up the lease
+
+        restarted = RedisDLRStore(flush_interval=0.01)
+        claimed = await restarted.claim("jasmin")
+        again = await restarted.claim("jasmin")
+        await asyncio.sleep(0.05)
+        return store, restarted, redis.pipelines, persisted, claimed, again, redis.zsets
+
+    store, restarted, pipelines, persisted, claimed, again, zsets = asyncio.run(scenario())
+    assert list(persisted) == [f"dlr:pending:jasmin:{store.owner}"]
+    assert _pending_ids(persisted) == ["m0", "m2"]
+    assert sorted(dlr.message_id for dlr, _ in claimed) == ["m0", "m2"]
+    assert all(4.0 < delay <= 5.0 for _, delay in claimed)
+    assert claimed[0][0].message_state == 2
+    assert again == []
+    # Recovered receipts are re-added under the new process.
+    assert list(zsets) == [f"dlr:pending:jasmin:{restarted.owner}"]
+    assert _pending_ids(zsets) == ["m0", "m2"]
+
+
+def test_redis_dlr_store_claims_only_receipts_without_a_live_owner():
+    async def scenario():
+        fake_smsc.rc_client = redis = FakeZSetRedis()
+        worker1 = RedisDLRStore(flush_interval=0.01)
+        worker2 = RedisDLRStore(flush_interval=0.01)
+        worker1.add("jasmin", PendingDLR(None, "src", "dst", "w1"), 5.0)
+        worker2.add("jasmin", PendingDLR(None, "src", "dst", "w2"), 5.0)
+        # Written by a build that did not key sets by owner.
+        redis.zsets["dlr:pending:jasmin"] = {"old\x1fsrc\x1fdst\x1fDELIVRD\x1f000\x1f": 1.0}
+        await asyncio.sleep(0.05)
+        # Both workers are alive: each only finds the ownerless set.
+        first = await worker2.claim("jasmin")
+        live = await worker1.claim("jasmin")
+        del redis.strings[worker1.lease_key]    # worker1 died, its lease ran out
+        taken = await worker2.claim("jasmin")
+        return first, live, taken
+
+    first, live, taken = asyncio.run(scenario())
+    assert [dlr.message_id for dlr, _ in first] == ["old"]
+    assert live == []
+    assert [dlr.message_id for dlr, _ in taken] == ["w1"]
+
+
+def test_redis_dlr_store_retries_a_failed_flush():
+    async def scenario():
+        fake_smsc.rc_client = redis = FakeZSetRedis()
+        store = RedisDLRStore(flush_interval=0.01, retry_interval=0.05)
+        dlrs = [PendingDLR(None, "src", "dst", f"m{i}") for i in range(3)]
+        store.add("jasmin", dlrs[0], 5.0)
+        store.add("jasmin", dlrs[1], 5.0)
+        redis.fail = True
+        await asyncio.sleep(0.03)
+        failed = dict(redis.zsets), store.errors
+        # Buffered while Redis was down; the retry writes both batches.
+        store.remove("jasmin", dlrs[0])
+        store.add("jasmin", dlrs[2], 5.0)
+        redis.fail = False
+        await asyncio.sleep(0.1)
+        return failed, redis.zsets
+
+    (failed_zsets, errors), zsets = asyncio.run(scenario())
+    assert failed_zsets == {} and errors == 1
+    assert _pending_ids(zsets) == ["m1", "m2"]
+
+
+# --------------------------------------------------------------------------- #
+# session registry
+
+def test_dlrs_route_to_least_loaded_receiver_binds_of_system_id():
+    async def scenario():
+        registry = SessionRegistry()
+
+        def bound(bind_type, system_id="jasmin"):
+            session = SMPPSession(None, RecordingWriter(), registry=registry)
+            session.system_id, session.bind_type, session.bound = system_id, bind_type, True
+            registry.add(session)
+            return session
+
+        tx = bound(fake_smsc.BIND_TRANSMITTER)
+        rx1 = bound(fake_smsc.BIND_RECEIVER)
+        rx2 = bound(BIND_TRANSCEIVER)
+        other = bound(fake_smsc.BIND_RECEIVER, system_id="other")
+        rx1.queue_dlrs([PendingDLR(rx1, "s", "d", f"old{i}") for i in range(4)])
+        tx.send_dlrs([PendingDLR(tx, "s", "d", f"m{i}") for i in range(6)])
+        await asyncio.sleep(0)
+        loads = [len(s.dlr_in_flight) for s in (tx, rx1, rx2, other)]
+
+        lone = SMPPSession(None, RecordingWriter(), registry=registry)
+        lone.system_id, lone.bind_type = "nobody", fake_smsc.BIND_TRANSMITTER
+        lone.send_dlrs([PendingDLR(lone, "s", "d", "x")])
+        return loads, [len(s.writer.writes) for s in (tx, other)], lone.counters, registry.stats()
+
+    loads, writes, lone_counters, binds = asyncio.run(scenario())
+    assert loads == [0, 5, 5, 0]
+    assert writes == [0, 0]
+    assert lone_counters["dlr_dropped"] == 1
+    assert binds == {"transmitter": 1, "receiver": 2, "transceiver": 1}
+
+
+# --------------------------------------------------------------------------- #
+# throttling
+
+def test_throttle_token_buckets_global_and_per_system_id():
+    clock = FakeClock()
+    throttle = SubmitThrottle(rate=10, burst=3, system_rate=1, system_burst=2, clock=clock)
+    THROTTLED = fake_smsc.ESME_RTHROTTLED
+    assert [throttle.check("a", 0) for _ in range(3)] == [0, 0, THROTTLED]
+    assert throttle.check("b", 0) == 0
+    assert throttle.check("c", 0) == THROTTLED      # global bucket empty
+    clock.now += 0.1
+    assert throttle.check("c", 0) == 0
+    clock.now += 1.0
+    assert throttle.check("a", 0) == 0
+
+    throttle.configure(rate=0, system_rate=0, msgqful_pending=100)
+    assert throttle.check("a", 99) == 0
+    assert throttle.check("a", 100) == fake_smsc.ESME_RMSGQFUL
+    assert throttle.config()["msgqful_pending"] == 100
+
+
+def test_throttle_rejects_bad_limits_without_applying_any():
+    throttle = SubmitThrottle(rate=10, system_rate=2)
+    before = throttle.config()
+    for changes in ({"rate": "abc"}, {"rate": -1}, {"rate": 5, "system_rate": "x"},
+                    {"system_burst": True}, {"msgqful_pending": 2.5}, {"burst": float("nan")}):
+        try:
+            throttle.configure(**changes)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{changes} was accepted")
+        assert throttle.config() == before
+    throttle.configure(rate="20", msgqful_pending=50.0)
+    assert throttle.config()["rate"] == 20.0 and throttle.config()["msgqful_pending"] == 50
+
+
+def test_throttled_submit_sm_gets_rthrottled_and_no_dlr():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        throttle = SubmitThrottle(system_rate=0.001, system_burst=1)
+        server = await asyncio.start_server(
+            lambda r, w: SMPPSession(r, w, dlr_delay=0, throttle=throttle).handle(),
+            "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(_build_bind()
+                         + _build_submit_sm("NETFLIX", "593996844442", "one", seq=2)
+                         + _build_submit_sm("NETFLIX", "593996844442", "two", seq=3))
+            pdus = [await asyncio.wait_for(_read_pdu(reader), 2) for _ in range(4)]
+            try:
+                extra = await asyncio.wait_for(_read_pdu(reader), 0.3)
+            except asyncio.TimeoutError:
+                extra = None
+            writer.close()
+            return pdus, extra
+
+    pdus, extra = asyncio.run(scenario())
+    by_seq = {(cmd, seq): (status, body) for cmd, status, seq, body in pdus}
+    assert by_seq[(SUBMIT_SM_RESP, 2)][0] == 0
+    assert by_seq[(SUBMIT_SM_RESP, 3)] == (fake_smsc.ESME_RTHROTTLED, b"")
+    assert sum(cmd == DELIVER_SM for cmd, _, _, _ in pdus) == 1
+    assert extra is None
+
+
+# --------------------------------------------------------------------------- #
+# DLR profiles
+
+def test_delay_distributions_sample_in_blocks_within_bounds():
+    fixed = DelayDistribution.from_spec(2.5)
+    assert [fixed.sample() for _ in range(3)] == [2.5, 2.5, 2.5]
+
+    expo = DelayDistribution("exponential", mean=4.0, max=30.0, seed=1, block_size=1000)
+    samples = [expo.sample() for _ in range(20000)]
+    assert 3.6 < sum(samples) / len(samples) < 4.4
+    assert 0.0 <= min(samples) and max(samples) <= 30.0
+
+    lognormal = DelayDistribution.from_spec({"dist": "lognormal", "mu": 0.0, "sigma": 0.5, "seed": 2})
+    samples = sorted(lognormal.sample() for _ in range(5001))
+    assert 0.9 < samples[2500] < 1.1                # median = exp(mu)
+
+    empirical = DelayDistribution("empirical", values=[1, 2, 30], seed=3)
+    assert {empirical.sample() for _ in range(200)} == {1.0, 2.0, 30.0}
+
+
+def test_numpy_is_only_imported_for_sampled_delays():
+    fake_smsc._numpy = False
+    DelayDistribution("fixed", value=5)
+    assert fake_smsc._numpy is False
+    DelayDistribution("uniform", low=1, high=2, block_size=8)
+    assert fake_smsc._numpy is not False
+
+
+def test_bad_delay_specs_are_refused_when_built(tmp_path):
+    for spec in ({"dist": "exponential", "meen": 5},
+                 {"dist": "exponential"},
+                 {"dist": "exponential", "mean": 0},
+                 {"dist": "uniform", "low": 10, "high": 1},
+                 {"dist": "lognormal", "mu": 1, "sigma": "wide"},
+                 {"dist": "empirical", "values": [1, "x"]},
+                 {"dist": "fixed", "value": 1, "min": 5, "max": 2}):
+        try:
+            DelayDistribution.from_spec(spec)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{spec} accepted")
+    # A reload with such a profile fails and leaves the running config alone.
+    config_path = tmp_path / "smsc.json"
+    config_path.write_text(json.dumps({"dlr_profile": {"default": {"delay": {"dist": "uniform", "low": 3}}}}))
+    try:
+        fake_smsc.RuntimeConfig.load(str(config_path), fake_smsc.RuntimeConfig())
+    except ValueError as e:
+        assert "high" in str(e)
+    else:
+        raise AssertionError("profile without high accepted")
+
+
+def test_outcome_mix_weights_and_error_codes():
+    mix = OutcomeMix({"DELIVRD": 8, "UNDELIV:011": 1, "EXPIRED": 1}, seed=4)
+    draws = [mix.sample() for _ in range(10000)]
+    assert 7600 < sum(d[0] == "DELIVRD" for d in draws) < 8400
+    assert ("UNDELIV", "011", 5) in draws and ("EXPIRED", "000", 3) in draws
+    try:
+        OutcomeMix({"BOGUS": 1})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown stat accepted")
+
+
+def test_profiles_resolve_longest_prefix_then_system_id_then_default():
+    profiles = DLRProfiles.from_dict({
+        "default": {"delay": 1},
+        "system_id": {"jasmin": {"delay": 2}},
+        "prefix": {"593": {"delay": 3}, "59399": {"delay": 4}},
+    })
+    assert profiles.resolve("jasmin", "593996844442").delay.sample() == 4
+    assert profiles.resolve("jasmin", "593123").delay.sample() == 3
+    assert profiles.resolve("jasmin", "447700").delay.sample() == 2
+    assert profiles.resolve("other", "447700").delay.sample() == 1
+
+
+def test_profile_outcome_applies_to_accepted_messages_only():
+    profiles = DLRProfiles.from_dict({"default": {"delay": 0, "outcomes": {"UNDELIV:011": 1}}})
+    assert asyncio.run(_run_submit_scenario(
+        store={"dlr:block:593996844442": b"1"}, profiles=profiles)) == "UNDELIV"
+    assert asyncio.run(_run_submit_scenario(store={}, profiles=profiles)) == "REJECTD"
+
+
+# --------------------------------------------------------------------------- #
+# message ids
+
+def test_message_ids_are_sortable_and_distinct_per_worker():
+    clock = FakeClock()
+    first = MessageIdGenerator(worker_id=0, clock=clock)
+    second = MessageIdGenerator(worker_id=1, clock=clock)
+    ids = [first.next() for _ in range(1000)]
+    assert len(set(ids)) == 1000 and ids == sorted(ids)
+    assert all(len(i) == 18 for i in ids)
+    assert not set(ids) & {second.next() for _ in range(1000)}
+    assert ids[0] == "000003e8" + "00" + "00000000"
+
+
+def test_message_id_counter_overflow_moves_to_a_later_timestamp():
+    clock = FakeClock()
+    gen = MessageIdGenerator(worker_id=7, fmt="decimal", width=17, clock=clock)
+    ids = [gen.next() for _ in range(10001)]
+    assert len(set(ids)) == 10001 and ids == sorted(ids)
+    # The clock did not move, the roll-over still bumps the timestamp.
+    assert ids[-1] == "0000001001" + "007" + "0000"
+    for bad in (dict(fmt="hex", width=65), dict(worker_id=256), dict(width=12)):
+        try:
+            MessageIdGenerator(**bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"accepted {bad}")
+
+
+# --------------------------------------------------------------------------- #
+# query_sm
+
+def _build_query_sm(message_id, seq):
+    body = _cstring(message_id) + struct.pack("BB", 0, 0) + _cstring("NETFLIX")
+    return struct.pack(">IIII", 16 + len(body), fake_smsc.QUERY_SM, 0, seq) + body
+
+
+def test_message_index_ring_evicts_oldest_and_keeps_probe_runs_intact():
+    index = MessageStateIndex(capacity=3000)
+    ids = [f"id{n}" for n in range(10000)]
+    for n, message_id in enumerate(ids):
+        index.add(message_id, 2, n % 256, n, n + 1)
+    # Every backward-shifted entry must still be reachable.
+    assert all(index.get(ids[n])[1] == n % 256 for n in range(7000, 10000))
+    assert all(index.get(ids[n]) is None for n in range(7000))
+    index.add("id9999", 5, 1, 0.0, 0.0)
+    assert index.get("id9999") == (5, 1, 0.0, 0.0)
+    stats = index.stats()
+    assert stats["size"] == 3000 and stats["evicted"] == 7001
+    assert stats["bytes"] < 3000 * 40
+
+
+def test_query_sm_reports_enroute_until_done_then_final_state():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        index = MessageStateIndex()
+        server = await asyncio.start_server(
+            lambda r, w: SMPPSession(r, w, dlr_delay=0.2, message_index=index).handle(),
+            "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(_build_bind() + _build_submit_sm(
+                "NETFLIX", "593990000000", "hi", registered_delivery=0))
+            await _read_pdu(reader)
+            _, _, _, body = await _read_pdu(reader)
+            message_id = body.rstrip(b"\x00").decode()
+            await asyncio.sleep(0.05)     # let the activation lookup finish
+            writer.write(_build_query_sm(message_id, 3))
+            early = await asyncio.wait_for(_read_pdu(reader), 2)
+            await asyncio.sleep(0.3)
+            writer.write(_build_query_sm(message_id, 4) + _build_query_sm("nope", 5))
+            final = await asyncio.wait_for(_read_pdu(reader), 2)
+            unknown = await asyncio.wait_for(_read_pdu(reader), 2)
+            writer.close()
+            return message_id, early, final, unknown
+
+    message_id, early, final, unknown = asyncio.run(scenario())
+    assert early[:3] == (fake_smsc.QUERY_SM_RESP, 0, 3)
+    assert early[3] == message_id.encode() + b"\x00\x00" + bytes((1, 0))
+    resp_id, final_date, tail = final[3].split(b"\x00", 2)
+    assert resp_id == message_id.encode() and len(final_date) == 16
+    assert tail == bytes((fake_smsc.STATE_REJECTED, 0))
+    assert unknown[:3] == (fake_smsc.QUERY_SM_RESP, fake_smsc.ESME_RQUERYFAIL, 5)
+
+
+# --------------------------------------------------------------------------- #
+# concatenated messages
+
+def _udh_segment(ref, total, seqnum, text, wide=False):
+    if wide:
+        udh = bytes((6, 0x08, 4, ref >> 8, ref & 0xff, total, seqnum))
+    else:
+        udh = bytes((5, 0x00, 3, ref, total, seqnum))
+    return udh + text
+
+
+def test_concat_read_from_udh_or_sar_tlvs():
+    def concat(message, esm_class=0, tlvs=b""):
+        return SubmitSM(_build_submit_sm("A", "1", message, esm_class=esm_class, tlvs=tlvs)[16:]).concat
+
+    assert concat(_udh_segment(7, 3, 2, b"part"), esm_class=0x40) == (7, 3, 2)
+    assert concat(_udh_segment(0x1234, 2, 1, b"part", wide=True), esm_class=0x40) == (0x1234, 2, 1)
+    # Without UDHI the same bytes are just text.
+    assert concat(_udh_segment(7, 3, 2, b"part")) is None
+    sar = (_tlv(fake_smsc.TLV_SAR_MSG_REF_NUM, 513, 2) + _tlv(fake_smsc.TLV_SAR_TOTAL_SEGMENTS, 3, 1)
+           + _tlv(fake_smsc.TLV_SAR_SEGMENT_SEQNUM, 3, 1))
+    assert concat(b"part", tlvs=sar) == (513, 3, 3)
+    assert concat(_udh_segment(7, 1, 1, b"single"), esm_class=0x40) is None
+    assert concat(b"plain") is None
+
+
+async def _submit_segments(reassembler, store, messages):
+    """Send segments in one bind; return (submit_sm_resp ids, deliver_sm bodies, redis calls)."""
+    fake_smsc.rc_client = FakeRedis(store=store)
+    server = await asyncio.start_server(
+        lambda r, w: SMPPSession(r, w, dlr_delay=0, reassembler=reassembler).handle(),
+        "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind() + b"".join(
+            _build_submit_sm("NETFLIX", "593996844442", message, seq=seq, esm_class=0x40)
+            for seq, message in enumerate(messages, 2)))
+        ids, receipts = [], []
+        while True:
+            try:
+                cmd, _, seq, body = await asyncio.wait_for(_read_pdu(reader), 0.3)
+            except asyncio.TimeoutError:
+                break
+            if cmd == SUBMIT_SM_RESP:
+                ids.append(body.rstrip(b"\x00").decode())
+            elif cmd == DELIVER_SM:
+                receipts.append(body)
+                writer.write(struct.pack(">IIII", 16, DELIVER_SM_RESP, 0, seq))
+        writer.close()
+    return ids, receipts, fake_smsc.rc_client.calls
+
+
+def test_concatenated_message_gets_one_lookup_and_one_dlr_per_message():
+    segments = [_udh_segment(9, 3, n, b"part%d" % n) for n in (1, 3, 2)]
+    store = {"dlr:block:593996844442": b"1"}
+
+    reassembler = SegmentReassembler(dlr_policy="message")
+    ids, receipts, calls = asyncio.run(_submit_segments(reassembler, store, segments))
+    assert len(ids) == 3 and len(calls) == 1
+    assert len(receipts) == 1 and b"id:%s " % ids[-1].encode() in receipts[0]
+    assert reassembler.stats()["completed"] == 1 and reassembler.stats()["shared_decisions"] == 2
+
+    ids, receipts, calls = asyncio.run(_submit_segments(
+        SegmentReassembler(dlr_policy="segment"), store, segments))
+    assert len(calls) == 1 and len(receipts) == 3
+    assert all(b"stat:DELIVRD" in body for body in receipts)
+
+
+def test_incomplete_concatenated_message_expires_with_one_receipt():
+    class Submitter:
+        def __init__(self):
+            self.receipts = []
+
+        def schedule_dlr(self, source_addr, dest_addr, message_id, stat, message_state, delay):
+            self.receipts.append((message_id, stat))
+
+    async def scenario():
+        clock = FakeClock()
+        reassembler = SegmentReassembler(timeout=30, dlr_policy="message", clock=clock)
+        session = Submitter()
+        segments, first, complete = reassembler.segment("test", "A", "1", 5, 3, 1)
+        assert first and not complete
+        segments.decided.set_result((True, ("DELIVRD", "000", 2, 0.0)))
+        segments.requested_dlr, segments.session, segments.message_id = True, session, "m1"
+        reassembler.sweep()
+        assert session.receipts == []
+        clock.now += 31
+        reassembler.sweep()
+        return session.receipts, reassembler.stats()
+
+    receipts, stats = asyncio.run(scenario())
+    assert receipts == [("m1", "EXPIRED")]
+    assert stats["pending"] == 0 and stats["expired"] == 1
+
+
+# --------------------------------------------------------------------------- #
+# PDU framing
+
+def test_framer_yields_every_pdu_in_a_chunk_and_waits_for_partials():
+    framer = PDUFramer()
+    bind = _build_bind()
+    stream = bind + _build_submit_sm("A", "1", "hello", seq=7)
+    framer.feed(stream[:len(bind) + 20])
+    assert framer.next_pdu() is not None
+    assert framer.next_pdu() is None
+    framer.feed(stream[len(bind) + 20:])
+    pdu = framer.next_pdu()
+    assert framer.next_pdu() is None
+    cmd, status, seq, body = pdu
+    assert (cmd, status, seq) == (SUBMIT_SM, 0, 7)
+    assert isinstance(body, memoryview)
+    assert bytes(body).endswith(b"hello")
+
+
+def test_framer_grows_for_large_pdu_without_invalidating_old_views():
+    framer = PDUFramer(size=32)
+    framer.feed(_build_bind())
+    _, _, _, first = framer.next_pdu()
+    before = bytes(first)
+    big = _build_submit_sm("A", "1", "x" * 200, seq=3) * 50
+    framer.feed(big)
+    assert bytes(first) == before
+    assert framer.next_pdu()[2] == 3
+
+
+def test_framer_rejects_oversized_command_length():
+    framer = PDUFramer(max_pdu_size=1024)
+    framer.feed(struct.pack(">IIII", 0xFFFFFFF0, SUBMIT_SM, 0, 9))
+    try:
+        framer.next_pdu()
+    except PDUFramingError as e:
+        assert e.sequence_number == 9
+    else:
+        raise AssertionError("expected PDUFramingError")
+
+
+def test_oversized_pdu_gets_generic_nack_and_close():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis()
+        server = await asyncio.start_server(
+            lambda r, w: SMPPSession(r, w, dlr_delay=0, max_pdu_size=1024).handle(),
+            "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(struct.pack(">IIII", 1 << 30, SUBMIT_SM, 0, 5))
+            await writer.drain()
+            cmd, status, seq, _ = await _read_pdu(reader)
+            eof = await reader.read()
+            writer.close()
+            return cmd, status, seq, eof
+
+    cmd, status, seq, eof = asyncio.run(scenario())
+    assert (cmd, status, seq) == (fake_smsc.GENERIC_NACK, fake_smsc.ESME_RINVCMDLEN, 5)
+    assert eof == b""
+
+
+def test_buffered_protocol_transport_round_trip():
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        smsc = FakeSMSC(dlr_delay=0, cache_size=0, dlr_resolution=0.01)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: SMPPBufferedProtocol(smsc), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            # Bind and submit in one segment: both must come out of one read.
+            writer.write(_build_bind() + _build_submit_sm("NETFLIX", "593996844442", "hi"))
+            await writer.drain()
+            cmds = [(await _read_pdu(reader))[0] for _ in range(3)]
+            writer.close()
+            smsc.scheduler.close()
+            return cmds
+
+    assert asyncio.run(scenario()) == [BIND_TRANSCEIVER_RESP, SUBMIT_SM_RESP, DELIVER_SM]
+
+
+class StalledTransport:
+    """Transport whose peer never reads: every write stays buffered."""
+
+    def __init__(self):
+        self.written = []
+        self.calls = []
+
+    def get_write_buffer_limits(self):
+        return 0, 0
+
+    def get_write_buffer_size(self):
+        return sum(map(len, self.written))
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def pause_reading(self):
+        self.calls.append("pause")
+
+    def resume_reading(self):
+        self.calls.append("resume")
+
+    def close(self):
+        pass
+
+
+def test_buffered_protocol_pauses_reading_until_the_session_catches_up():
+    async def scenario():
+        smsc = FakeSMSC(dlr_delay=0, cache_size=0, dlr_resolution=0.01)
+        protocol = SMPPBufferedProtocol(smsc, read_high_water=8192)
+        transport = StalledTransport()
+        protocol.connection_made(transport)
+        protocol.pause_writing()
+        enquire_link = struct.pack(">IIII", 16, fake_smsc.ENQUIRE_LINK, 0, 1)
+        # The first PDU blocks the session on its write; the rest pile up.
+        for _ in range(20):
+            data = enquire_link * 500
+            protocol.get_buffer(len(data))[:len(data)] = data
+            protocol.buffer_updated(len(data))
+            await asyncio.sleep(0)
+        paused = list(transport.calls), protocol.session.framer.pending
+        protocol.resume_writing()
+        for _ in range(100):
+            await asyncio.sleep(0)
+        resumed = list(transport.calls), protocol.session.framer.pending
+        protocol.connection_lost(None)
+        await protocol._task
+        smsc.scheduler.close()
+        return paused, resumed
+
+    (paused_calls, buffered), (resumed_calls, left) = asyncio.run(scenario())
+    # The transport would have stopped calling get_buffer after the pause.
+    assert paused_calls == ["pause"] and buffered > 8192
+    assert resumed_calls == ["pause", "resume"] and left == 0
+
+
+# --------------------------------------------------------------------------- #
+# submit_sm parser
+
+def test_submit_sm_parser_reads_mandatory_fields_from_memoryview():
+    pdu = _build_submit_sm("NETFLIX", "+593996844442", "code 1234",
+                           registered_delivery=1, esm_class=0x40)
+    sm = SubmitSM(memoryview(bytearray(pdu))[16:])
+    assert sm.source_addr == "NETFLIX"
+    assert sm.destination_addr == "+593996844442"
+    assert sm.registered_delivery == 1
+    assert sm.esm_class == 0x40
+    assert sm.data_coding == 0
+    assert sm.short_message == b"code 1234"
+    assert sm.message == b"code 1234"
+
+
+def test_submit_sm_parser_reads_tlvs_and_message_payload():
+    tlvs = (
+        _tlv(fake_smsc.TLV_USER_MESSAGE_REFERENCE, 77, 2)
+        + _tlv(fake_smsc.TLV_SAR_MSG_REF_NUM, 513, 2)
+        + _tlv(fake_smsc.TLV_SAR_TOTAL_SEGMENTS, 3, 1)
+        + _tlv(fake_smsc.TLV_SAR_SEGMENT_SEQNUM, 2, 1)
+        + _tlv(fake_smsc.TLV_MESSAGE_PAYLOAD, b"long " * 60)
+    )
+    sm = SubmitSM(_build_submit_sm("A", "1", b"", tlvs=tlvs)[16:])
+    options = sm.options
+    assert options.user_message_reference == 77
+    assert (options.sar_msg_ref_num, options.sar_total_segments, options.sar_segment_seqnum) == (513, 3, 2)
+    assert options.message_payload == b"long " * 60
+    assert sm.short_message == b""
+    assert sm.message == b"long " * 60
+
+
+def test_submit_sm_parser_rejects_truncated_body():
+    try:
+        SubmitSM(b"\x00\x00\x00NETFLIX")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
+
+
+# --------------------------------------------------------------------------- #
+# DLR encoder
+
+GOLDEN_NOW = 1760000000
+GOLDEN_DLR = (
+    b"\x00\x00\x00\x9d\x00\x00\x00\x05\x00\x00\x00\x00\x00\x00\x00\x2a"
+    b"\x00\x00\x00593996844442\x00\x00\x00NETFLIX\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00\x00\x64"
+    b"id:a1b2c3d4 sub:001 dlvrd:001 submit date:{date} done date:{date} stat:DELIVRD err:000 text:"
+    b"\x04\x27\x00\x01\x02"
+)
+
+
+def test_dlr_encoder_matches_golden_pdu():
+    date = time.strftime("%y%m%d%H%M", time.localtime(GOLDEN_NOW)).encode()
+    pdu = DLREncoder().encode(42, "593996844442", "NETFLIX", "a1b2c3d4", "DELIVRD",
+                              message_state=fake_smsc.STATE_DELIVERED, now=GOLDEN_NOW)
+    assert bytes(pdu) == GOLDEN_DLR.replace(b"{date}", date)
+
+
+def test_dlr_encoder_matches_make_deliver_sm():
+    now = time.time()
+    date = time.strftime("%y%m%d%H%M", time.localtime(now))
+    session = SMPPSession(None, RecordingWriter())
+    encoder = DLREncoder()
+    for stat, err, state in (("DELIVRD", "000", 2), ("REJECTD", "000", 8), ("UNDELIV", "001", None)):
+        text = (f"id:msg-{stat} sub:001 dlvrd:001 submit date:{date} "
+                f"done date:{date} stat:{stat} err:{err} text:")
+        body = session.make_deliver_sm("+79156537788", "SENDER", text, message_state=state)
+        legacy = struct.pack(">IIII", 16 + len(body), DELIVER_SM, 0, 7) + body
+        assert bytes(encoder.encode(7, "+79156537788", "SENDER", f"msg-{stat}", stat, err,
+                                    message_state=state, now=now)) == legacy
+
+
+# --------------------------------------------------------------------------- #
+# multi-worker stats
+
+def test_merge_stats_sums_counts_and_keeps_worst_lag():
+    w0 = {"sessions": 2, "counters": {"submit_sm": 10, "accepted": 7},
+          "dlr_scheduler": {"pending": 3, "max_lag": 0.02}}
+    w1 = {"sessions": 1, "counters": {"submit_sm": 5, "rejected": 1},
+          "dlr_scheduler": {"pending": 4, "max_lag": 0.5}}
+    assert merge_stats([w0, w1]) == {
+        "sessions": 3,
+        "counters": {"submit_sm": 15, "accepted": 7, "rejected": 1},
+        "dlr_scheduler": {"pending": 7, "max_lag": 0.5},
+    }
+
+
+def test_restarted_worker_does_not_reset_merged_counters():
+    supervisor = fake_smsc.WorkerSupervisor(2, {"port": 0})
+
+    def report(submits, sessions, pending):
+        return {"sessions": sessions, "counters": {"submit_sm": submits},
+                "dlr_scheduler": {"pending": pending, "fired": submits, "max_lag": 0.1},
+                "pdus": {"submit_sm": submits}}
+
+    supervisor.latest = {0: report(10, 2, 3), 1: report(5, 1, 1)}
+    before = supervisor.combined_stats(histograms=True)
+    supervisor._retire(0)
+    supervisor.latest[0] = report(0, 0, 0)      # the replacement's first report
+    after = supervisor.combined_stats(histograms=True)
+    assert before["counters"]["submit_sm"] == after["counters"]["submit_sm"] == 15
+    assert after["pdus"] == {"submit_sm": 15}
+    assert after["dlr_scheduler"]["fired"] == 15
+    # Gauges only count live workers.
+    assert after["sessions"] == 1 and after["dlr_scheduler"]["pending"] == 1
+    supervisor.latest[0] = report(4, 1, 0)
+    assert supervisor.combined_stats()["counters"]["submit_sm"] == 19
+
+
+# --------------------------------------------------------------------------- #
+# event loop selection
+
+def test_install_event_loop_falls_back_without_uvloop(monkeypatch):
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    assert install_event_loop("auto") == "asyncio"
+    assert install_event_loop("uvloop") == "asyncio"
+    assert install_event_loop("asyncio") == "asyncio"
+
+
+# --------------------------------------------------------------------------- #
+# logging
+
+def test_log_sampler_keeps_one_in_n_ids_consistently():
+    sampler = LogSampler(every=10)
+    ids = [f"{i:08x}" for i in range(5000)]
+    kept = [mid for mid in ids if sampler.keep(mid)]
+    assert 300 < len(kept) < 700
+    assert kept == [mid for mid in ids if sampler.keep(mid)]
+    assert all(LogSampler(1).keep(mid) for mid in ids[:100])
+
+
+def test_json_log_formatter_emits_one_object_per_line():
+    record = logging.LogRecord("fake_smsc", logging.INFO, __file__, 1,
+                               "[DLR SENT] msg_id=%s stat=%s", ("abc", "DELIVRD"), None)
+    entry = json.loads(JsonLogFormatter(worker=3).format(record))
+    assert entry["msg"] == "[DLR SENT] msg_id=abc stat=DELIVRD"
+    assert entry["level"] == "INFO" and entry["worker"] == 3
+
+
+def test_async_logging_formats_on_listener_thread(capsys):
+    root = logging.getLogger()
+    saved = list(root.handlers)
+    try:
+        listener = configure_logging(mode="async", sample=1)
+        assert listener is not None
+        fake_smsc.logger.warning("[REJECT] dest=%s (no active activation) msg_id=%s", "1", "m1")
+        listener.stop()
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved:
+            root.addHandler(handler)
+    assert "[REJECT] dest=1 (no active activation) msg_id=m1" in capsys.readouterr().err
+
+
+# --------------------------------------------------------------------------- #
+# metrics
+
+def test_histogram_buckets_are_upper_bounds():
+    histogram = Histogram((0.001, 0.01, 0.1))
+    for value in (0.0005, 0.001, 0.002, 0.5):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {"0.001": 2, "0.01": 1, "0.1": 0, "+Inf": 1}
+    assert snapshot["count"] == 4
+    assert abs(snapshot["sum"] - 0.5035) < 1e-9
+
+
+def test_merged_worker_histograms_render_cumulative_buckets():
+    def worker(values):
+        metrics = Metrics()
+        for value in values:
+            metrics.dlr_delay.observe(value)
+        metrics.pdus[SUBMIT_SM] += len(values)
+        return {"counters": {"submit_sm": len(values), "dlr_DELIVRD": len(values)},
+                **metrics.snapshot()}
+
+    text = render_metrics(merge_stats([worker([0.2, 5.0]), worker([5.0])]), dlr_delay=5)
+    assert 'fake_smsc_pdus_received_total{command="submit_sm"} 3' in text
+    assert 'fake_smsc_dlrs_sent_total{stat="DELIVRD"} 3' in text
+    assert 'fake_smsc_dlr_delay_seconds_bucket{le="0.25"} 1' in text
+    assert 'fake_smsc_dlr_delay_seconds_bucket{le="5"} 3' in text
+    assert 'fake_smsc_dlr_delay_seconds_bucket{le="+Inf"} 3' in text
+    assert "fake_smsc_dlr_delay_seconds_count 3" in text
+    assert "fake_smsc_dlr_delay_configured_seconds 5" in text
+
+
+def test_metrics_endpoint_reports_submit_and_dlr():
+    import urllib.request
+
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                        redis_batch_window=0, cache_size=0, metrics_port=0)
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.metrics_server is None:
+            await asyncio.sleep(0.01)
+        port = smsc.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind() + _build_submit_sm("NETFLIX", "593996844442", "hi"))
+        for expected in (BIND_TRANSCEIVER_RESP, SUBMIT_SM_RESP, DELIVER_SM):
+            cmd, _, _, _ = await asyncio.wait_for(_read_pdu(reader), 2)
+            assert cmd == expected
+
+        url = f"http://127.0.0.1:{smsc.metrics_server.port}/metrics"
+        text = await asyncio.to_thread(
+            lambda: urllib.request.urlopen(url, timeout=5).read().decode())
+        writer.close()
+        smsc._signal_handler()
+        await server
+        return text
+
+    text = asyncio.run(scenario())
+    assert 'fake_smsc_pdus_received_total{command="submit_sm"} 1' in text
+    assert 'fake_smsc_submit_sm_decisions_total{decision="accepted"} 1' in text
+    assert 'fake_smsc_dlrs_sent_total{stat="DELIVRD"} 1' in text
+    assert "fake_smsc_bound_sessions 1" in text
+    assert "fake_smsc_pending_dlrs 0" in text
+    assert "fake_smsc_submit_sm_resp_latency_seconds_count 1" in text
+    assert "fake_smsc_redis_lookup_latency_seconds_count 1" in text
+    assert "fake_smsc_dlr_delay_seconds_count 1" in text
+
+
+# --------------------------------------------------------------------------- #
+# admin routes
+
+def test_parse_injection_accepts_json_list_and_ndjson():
+    receipt = {"system_id": "test", "source_addr": "NETFLIX", "dest_addr": "593996844442",
+               "message_id": "abc", "stat": "UNDELIV", "err": "11"}
+    mo = {"system_id": "test", "source_addr": "593996844442", "dest_addr": "1234",
+          "short_message": "STOP"}
+    (system_id, dlr), = parse_injection(json.dumps(receipt).encode())
+    assert system_id == "test"
+    assert (dlr.message_id, dlr.stat, dlr.err, dlr.short_message) == ("abc", "UNDELIV", "011", None)
+    assert [d.short_message for _, d in parse_injection(json.dumps([receipt, mo]))] == [None, b"STOP"]
+    ndjson = "\n".join(json.dumps(item) for item in (mo, receipt, mo)) + "\n"
+    assert len(parse_injection(ndjson.encode())) == 3
+
+    try:
+        parse_injection(json.dumps([receipt, dict(receipt, message_id="")]))
+    except ValueError as e:
+        assert "item 2" in str(e) and "message_id" in str(e)
+    else:
+        raise AssertionError("a receipt without message_id was accepted")
+    for body in (b"5", b'"x"', b"null", b"true"):
+        try:
+            parse_injection(body)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{body!r} was accepted")
+
+
+def test_admin_routes_list_inject_and_force_unbind():
+    import urllib.error
+    import urllib.request
+
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis()
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                        redis_batch_window=0, cache_size=0, metrics_port=0, admin_port=0)
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.admin_server is None:
+            await asyncio.sleep(0.01)
+        assert smsc.admin_server.host == "127.0.0.1"
+        base = f"http://127.0.0.1:{smsc.admin_server.port}"
+
+        def http(path, body=None, base=base):
+            with urllib.request.urlopen(base + path, data=body, timeout=5) as resp:
+                return resp.status, json.loads(resp.read())
+
+        # The metrics listener only reads.
+        metrics = f"http://127.0.0.1:{smsc.metrics_server.port}"
+        for path in ("/inject", "/sessions/unbind", "/throttle", "/reload"):
+            try:
+                await asyncio.to_thread(http, path, b"{}", metrics)
+            except urllib.error.HTTPError as e:
+                assert e.code == 404
+            else:
+                raise AssertionError(f"POST {path} served on the metrics listener")
+        assert (await asyncio.to_thread(http, "/throttle", None, metrics))[0] == 200
+
+        port = smsc.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind())
+        assert (await asyncio.wait_for(_read_pdu(reader), 2))[0] == BIND_TRANSCEIVER_RESP
+
+        items = [{"system_id": "test", "source_addr": "NETFLIX", "dest_addr": "593996844442",
+                  "message_id": "cafe01"},
+                 {"system_id": "test", "source_addr": "593996844442", "dest_addr": "1234",
+                  "short_message": "HELLO"},
+                 {"system_id": "nobody", "source_addr": "X", "dest_addr": "1", "message_id": "ff"}]
+        ndjson = "\n".join(json.dumps(item) for item in items).encode()
+        status, accepted = await asyncio.to_thread(http, "/inject?rate=100", ndjson)
+        assert (status, accepted["accepted"]) == (202, 3)
+
+        bodies = []
+        for _ in range(2):
+            cmd, _, seq, body = await asyncio.wait_for(_read_pdu(reader), 2)
+            assert cmd == DELIVER_SM
+            bodies.append(body)
+            writer.write(struct.pack(">IIII", 17, DELIVER_SM_RESP, 0, seq) + b"\x00")
+        assert b"id:cafe01" in bodies[0]
+        assert bodies[1].endswith(b"HELLO") and b"\x00593996844442\x00" in bodies[1]
+        while smsc.counters["mo_acked"] < 1:
+            await asyncio.sleep(0.01)
+
+        _, sessions = await asyncio.to_thread(http, "/sessions")
+        session, = sessions
+        assert session["system_id"] == "test" and session["bind_type"] == "transceiver"
+        assert (session["dlrs_sent"], session["dlrs_acked"], session["mo_sent"]) == (1, 1, 1)
+
+        _, unbound = await asyncio.to_thread(http, "/sessions/unbind", b'{"system_id": "test"}')
+        assert unbound == {"unbound": 1}
+        cmd, _, seq, _ = await asyncio.wait_for(_read_pdu(reader), 2)
+        assert cmd == UNBIND
+        writer.write(struct.pack(">IIII", 16, UNBIND_RESP, 0, seq))
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        writer.close()
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+        stats = smsc.stats()
+        smsc._signal_handler()
+        await server
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats["counters"]["injected"] == 3
+    assert stats["counters"]["injected_orphaned"] == 1
+    assert stats["counters"]["forced_unbind"] == 1
+    assert stats["dlr_store"]["orphans"] == 1
+
+
+# --------------------------------------------------------------------------- #
+# capture and replay
+
+async def _captured_run(path):
+    """Bind, submit three messages and ack their receipts on a capturing server."""
+    fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+    smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                    redis_batch_window=0, cache_size=0,
+                    capture_path=str(path), capture_max_bytes=300)
+    smsc.capture.flush_interval = 0.001
+    server = asyncio.ensure_future(smsc.run())
+    while smsc.server is None:
+        await asyncio.sleep(0.01)
+    port = smsc.server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(_build_bind())
+    await _read_pdu(reader)
+    message_ids = []
+    receipts = 0
+    for seq in (2, 3, 4):
+        writer.write(_build_submit_sm("NETFLIX", "593996844442", "hi", seq=seq))
+        # Wait for this message's receipt too, spreading the traffic over several files.
+        while len(message_ids) < seq - 1 or receipts < seq - 1:
+            cmd, _, pdu_seq, body = await asyncio.wait_for(_read_pdu(reader), 2)
+            if cmd == SUBMIT_SM_RESP:
+                message_ids.append(body.rstrip(b"\x00").decode())
+            elif cmd == DELIVER_SM:
+                receipts += 1
+                writer.write(struct.pack(">IIII", 16, DELIVER_SM_RESP, 0, pdu_seq))
+        await asyncio.sleep(0.01)
+    writer.write(struct.pack(">IIII", 16, UNBIND, 0, 5))
+    await asyncio.wait_for(_read_pdu(reader), 2)
+    writer.close()
+    while smsc.sessions:
+        await asyncio.sleep(0.01)
+    smsc._signal_handler()
+    await server
+    return message_ids, smsc.stats()
+
+
+def test_capture_rotates_and_index_slices_by_message_id(tmp_path):
+    import smpp_capture
+
+    path = tmp_path / "smsc.cap"
+    message_ids, stats = asyncio.run(_captured_run(path))
+    files = smpp_capture.capture_files(str(path))
+    assert len(files) == stats["capture"]["files"] > 1
+    records = [record for name in files for record in smpp_capture.read_records(name)]
+    assert len(records) == stats["capture"]["records"]
+    times = [t_us for _, t_us, _, _, _ in records]
+    assert times == sorted(times)
+
+    def commands(selected):
+        return [struct.unpack_from(">I", pdu, 4)[0] for _, _, _, _, pdu in selected]
+
+    expected = [SUBMIT_SM, SUBMIT_SM_RESP, DELIVER_SM, DELIVER_SM_RESP]
+    # Without a .idx the files are scanned; with one the offsets come from it.
+    assert commands(smpp_capture.select_records(str(path), message_id=message_ids[1])) == expected
+    for name in files:
+        smpp_capture.CaptureIndex.build(name, stride=2).save(name)
+    assert commands(smpp_capture.select_records(str(path), message_id=message_ids[1])) == expected
+
+    middle = times[len(times) // 2] / 1e6
+    sliced = list(smpp_capture.select_records(str(path), start=middle))
+    assert sliced == [record for record in records if record[1] >= times[len(times) // 2]]
+
+
+def test_capture_never_overwrites_or_removes_earlier_files(tmp_path):
+    import smpp_capture
+
+    pdu = struct.pack(">IIII", 16, fake_smsc.ENQUIRE_LINK_RESP, 0, 1)
+
+    async def write(chunks):
+        capture = fake_smsc.PDUCapture(str(path), max_bytes=1)
+        capture.start()
+        for _ in range(chunks):
+            capture.record(1, fake_smsc.CAPTURE_OUT, pdu)
+            capture.flush()
+        capture.close()
+        return capture.path
+
+    path = tmp_path / "smsc.cap"
+    first = asyncio.run(write(2))
+    before = [(tmp_path / name).read_bytes() for name in ("smsc.cap", "smsc.cap.1")]
+    # A restarted worker writes next to the crashed one's capture.
+    second = asyncio.run(write(1))
+    assert first == str(path) and second.startswith(str(path) + ".") and second != first
+    assert [(tmp_path / name).read_bytes() for name in ("smsc.cap", "smsc.cap.1")] == before
+    assert smpp_capture.capture_files(second) == [second]
+
+    path.unlink()                   # smsc.cap.1 is left without its first file
+    third = asyncio.run(write(1))
+    assert third.startswith(str(path) + ".") and third not in (first, second)
+    assert (tmp_path / "smsc.cap.1").read_bytes() == before[1]
+    assert smpp_capture.capture_files(third) == [third]
+    # Two captures in the same second from the same pid.
+    stamped = fake_smsc.PDUCapture._free_path(str(path), 1e9)
+    open(stamped + ".1", "wb").close()
+    assert fake_smsc.PDUCapture._free_path(str(path), 1e9) == stamped + "-2"
+
+
+def test_replay_resends_captured_traffic_to_a_fresh_server(tmp_path):
+    import smpp_capture
+
+    path = tmp_path / "smsc.cap"
+    asyncio.run(_captured_run(path))
+
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1"})
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=0, dlr_resolution=0.01,
+                        redis_batch_window=0, cache_size=0)
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.server is None:
+            await asyncio.sleep(0.01)
+        port = smsc.server.sockets[0].getsockname()[1]
+        # No pauses: the captured unbind is only held back by the receipts
+        # the capture had acknowledged before it.
+        summary = await smpp_capture.replay(smpp_capture.select_records(str(path)),
+                                            "127.0.0.1", port, speed=0)
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+        smsc._signal_handler()
+        await server
+        return summary, smsc.stats()
+
+    summary, stats = asyncio.run(scenario())
+    assert summary["sessions"] == 1
+    assert summary["sent"] == 5 and summary["skipped_responses"] == 3
+    assert summary["unbinds_before_acks"] == 0
+    assert summary["received"]["deliver_sm"] == 3
+    assert summary["received"]["unbind_resp"] == 1
+    assert stats["counters"]["submit_sm"] == 3
+    assert stats["counters"]["dlr_acked"] == 3
+
+
+# --------------------------------------------------------------------------- #
+# offline analysis
+
+def test_analysis_of_a_capture_is_the_same_without_numpy(tmp_path):
+    import dlr_analyze
+
+    path = tmp_path / "smsc.cap"
+    asyncio.run(_captured_run(path))
+    summary = dlr_analyze.analyze([str(path)], chunk_size=3).summary(grace=0)
+    numpy = dlr_analyze.numpy
+    dlr_analyze.numpy = None
+    try:
+        fallback = dlr_analyze.analyze([str(path)], chunk_size=3).summary(grace=0)
+    finally:
+        dlr_analyze.numpy = numpy
+    assert fallback == summary
+    assert summary["submitted"] == summary["receipts"] == 3
+    assert summary["missing_receipts"] == summary["unmatched_receipts"] == 0
+    assert summary["stats"] == {"DELIVRD": 3}
+    assert summary["prefixes"] == [{"prefix": "59399", "accepted": 3, "rejected": 0, "reject_ratio": 0.0}]
+    assert 0 < summary["latency_s"]["p50"] <= summary["latency_max_s"] < 1
+
+
+def test_log_analysis_counts_decisions_latency_and_missing_receipts(tmp_path):
+    import dlr_analyze
+
+    lines = []
+    for i, (dest, accepted) in enumerate([("593991000001", True), ("593991000002", False),
+                                          ("593992000003", False), ("593992000004", True)]):
+        lines.append(f"2026-10-18 12:00:0{i},000 [INFO] [SUBMIT_SM] NETFLIX -> {dest} msg_id=m{i}")
+        if accepted:
+            lines.append(f"2026-10-18 12:00:0{i},000 [INFO] [ACCEPT] dest={dest} (active activation) msg_id=m{i}")
+        else:
+            lines.append(f"2026-10-18 12:00:0{i},000 [WARNING] [REJECT] dest={dest} (no active activation) msg_id=m{i}")
+    # m0 never gets a receipt; the others arrive 0.5 s after their submit.
+    for i, stat in [(1, "REJECTD"), (2, "REJECTD"), (3, "DELIVRD")]:
+        lines.append(f"2026-10-18 12:00:0{i},500 [INFO] [DLR SENT] msg_id=m{i} stat={stat}")
+    lines.append("2026-10-18 12:01:00,000 [INFO] Session closed: NETFLIX")
+    text_log = tmp_path / "fake_smsc.log"
+    text_log.write_text("\n".join(lines) + "\n")
+    json_log = tmp_path / "fake_smsc.json.log"
+    json_log.write_text("".join(
+        json.dumps({"ts": line[:23], "level": line.split()[2][1:-1], "msg": line.split("] ", 1)[1]}) + "\n"
+        for line in lines))
+
+    summaries = [dlr_analyze.analyze([str(path)], prefix_digits=6, chunk_size=2).summary(grace=1)
+                 for path in (text_log, json_log)]
+    assert summaries[0] == summaries[1]
+    summary = summaries[0]
+    assert summary["submitted"] == 4 and summary["receipts"] == 3
+    assert summary["missing_receipts"] == 1 and summary["missing_sample"] == ["m0"]
+    assert summary["stats"] == {"DELIVRD": 1, "REJECTD": 2}
+    assert abs(summary["latency_s"]["p99"] - 0.5) < 0.01
+    assert {p["prefix"]: p["rejected"] for p in summary["prefixes"]} == {"593991": 1, "593992": 1}
+
+
+# --------------------------------------------------------------------------- #
+# hot reload
+
+def test_sighup_reload_applies_to_bound_sessions_and_spares_scheduled_dlrs(tmp_path):
+    import os
+    import signal
+
+    config_path = tmp_path / "smsc.json"
+    config_path.write_text(json.dumps({"dlr_delay": 0.3}))
+
+    async def scenario():
+        fake_smsc.rc_client = FakeRedis(store={"dlr:block:593996844442": b"1",
+                                               "act:593990000000": b"1"})
+        smsc = FakeSMSC(host="127.0.0.1", port=0, dlr_delay=5, dlr_resolution=0.01,
+                        redis_batch_window=0, cache_size=0, config_path=str(config_path))
+        server = asyncio.ensure_future(smsc.run())
+        while smsc.server is None:
+            await asyncio.sleep(0.01)
+        port = smsc.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(_build_bind() + _build_submit_sm("NETFLIX", "593996844442", "old", seq=2))
+        await _read_pdu(reader)
+        _, _, _, old_id = await _read_pdu(reader)
+
+        config_path.write_text(json.dumps({"dlr_delay": 0, "redis_key_prefix": "act:",
+                                           "log_sample": 3, "throttle": {"rate": 1000}}))
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.sleep(0.05)
+        reloaded = smsc.describe_config()
+        # Same bind, new settings: the new prefix gates this one.
+        writer.write(_build_submit_sm("NETFLIX", "593990000000", "new", seq=3))
+        _, _, _, new_id = await _read_pdu(reader)
+        receipts = []
+        for _ in range(2):
+            cmd, _, seq, body = await asyncio.wait_for(_read_pdu(reader), 2)
+            assert cmd == DELIVER_SM
+            receipts.append(body)
+            writer.write(struct.pack(">IIII", 16, DELIVER_SM_RESP, 0, seq))
+
+        config_path.write_text(json.dumps({"bogus": 1}))
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.sleep(0.05)
+        after_bad_reload = smsc.describe_config()
+        writer.close()
+        while smsc.sessions:
+            await asyncio.sleep(0.01)
+        smsc._signal_handler()
+        await server
+        return old_id, new_id, receipts, reloaded, after_bad_reload
+
+    try:
+        old_id, new_id, receipts, reloaded, after_bad_reload = asyncio.run(scenario())
+    finally:
+        fake_smsc.log_sampler.every = 1
+    assert b"id:" + new_id.rstrip(b"\x00") + b" " in receipts[0]
+    assert b"id:" + old_id.rstrip(b"\x00") + b" " in receipts[1]
+    assert all(b"stat:DELIVRD" in body for body in receipts)
+    assert reloaded["dlr_delay"] == 0 and reloaded["redis_key_prefix"] == "act:"
+    assert reloaded["log_sample"] == 3 and reloaded["throttle"]["rate"] == 1000
+    assert after_bad_reload == reloaded
+
+
+def test_runtime_config_is_immutable_and_resolves_profile_next_to_file(tmp_path):
+    (tmp_path / "profiles.json").write_text(json.dumps({"default": {"outcomes": {"EXPIRED": 1}}}))
+    config_path = tmp_path / "smsc.json"
+    config_path.write_text(json.dumps({"dlr_profile": "profiles.json"}))
+    config, throttle = fake_smsc.RuntimeConfig.load(str(config_path), fake_smsc.RuntimeConfig())
+    assert throttle == {}
+    assert config.profiles.resolve("test", "1").outcomes.sample()[0] == "EXPIRED"
+    try:
+        config.dlr_delay = 1
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("RuntimeConfig accepted an assignment")
+
+
+# --------------------------------------------------------------------------- #
+# load generator
+
+def test_loadgen_in_process_receipts_match_activations():
+    from smpp_loadgen import run_in_process
+
+    result, server = asyncio.run(run_in_process(
+        binds=3, window=8, messages=50, numbers=40, active_ratio=0.25, seed=7))
+    summary = result.summary()
+    assert summary["responses"] == summary["dlrs"] == 150
+    assert summary["dlr_wrong"] == 0 and summary["dlr_unknown"] == 0
+    assert set(summary["dlr_stats"]) == {"DELIVRD", "REJECTD"}
+    assert server["counters"]["submit_sm"] == 150
+    assert summary["submit_resp_ms"]["p50"] <= summary["submit_resp_ms"]["p99"]